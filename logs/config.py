@@ -5,6 +5,7 @@ import logging.config as logs_config
 from lucky_bot.helpers.constants import (
     TESTING, LOG_EVENTS_FILE, LOG_TELEBOT_FILE,
     LOG_WERKZEUG_FILE, LOG_EXCEPTIONS_FILE, LOG_LIMIT,
+    TRACE_TO_FILE, TRACE_FILE, TRACE_FILE_SIZE, TRACE_FILE_BACKUPS,
 )
 
 
@@ -55,6 +56,10 @@ def normal_logger():
                           '[MESSAGE] {message}',
                 'style': '{',
             },
+            'trace_to_file': {
+                'format': '{message}',
+                'style': '{',
+            },
         },
         'handlers': {
             'werkzeug_console': {
@@ -112,6 +117,15 @@ def normal_logger():
                 'formatter': 'exception_to_file',
                 'filters': ['default_exception_filter'],
             },
+
+            'trace': {
+                'level': 'INFO',
+                'class': 'logging.handlers.RotatingFileHandler',
+                'filename': TRACE_FILE,
+                'maxBytes': TRACE_FILE_SIZE,
+                'backupCount': TRACE_FILE_BACKUPS,
+                'formatter': 'trace_to_file',
+            } if TRACE_TO_FILE else {'class': 'logging.NullHandler'},
         },
         'loggers': {
             'werkzeug': {
@@ -130,6 +144,11 @@ def normal_logger():
                 'handlers': ['event'],
                 'level': 'INFO',
             },
+            'trace': {
+                'handlers': ['trace'],
+                'level': 'INFO',
+                'propagate': False,
+            },
             '': {
                 'handlers': ['default_console', 'default_exception'],
                 'level': 'ERROR',
@@ -151,6 +170,7 @@ def dummy_logger():
             'TeleBot': {'handlers': ['nullifier'], 'level': 'CRITICAL'},
             'debug': {'handlers': ['nullifier'], 'level': 'CRITICAL'},
             'event': {'handlers': ['nullifier'], 'level': 'CRITICAL'},
+            'trace': {'handlers': ['nullifier'], 'level': 'CRITICAL', 'propagate': False},
             '': {'handlers': ['nullifier'], 'level': 'CRITICAL'},
         }
     }
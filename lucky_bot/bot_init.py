@@ -1,7 +1,9 @@
 """ pyTelegramBotAPI initialisation for another modules. """
 import telebot
+from telebot import apihelper
 
-from lucky_bot.helpers.constants import API
+from lucky_bot.helpers.constants import API, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from lucky_bot.helpers.http_session import HTTP_SESSION
 
 import logging
 logger = logging.getLogger(__name__)
@@ -13,4 +15,8 @@ class ExceptionHandler(telebot.ExceptionHandler):
         pass
 
 
+apihelper.CUSTOM_REQUEST_SENDER = HTTP_SESSION.request
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
 BOT = telebot.TeleBot(API, threaded=False)
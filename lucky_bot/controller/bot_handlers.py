@@ -24,6 +24,7 @@ pyTelegramBotAPI update handlers.
 Exceptions go through:
     DatabaseException
     OMQException
+    IMQException
 """
 import re
 
@@ -135,6 +136,18 @@ def admin_commands(message):
         Log.info('handler: /admin errors')
         respond.admin_total_errors()
 
+    elif match := re.search(r'(/admin)\s+(dlq)\s+(list|replay|drop)\s*(\d*)', message.text):
+        Log.info(f'handler: /admin dlq {match.group(3)}')
+        action, letter_id = match.group(3), match.group(4)
+        if action == 'list':
+            respond.admin_list_dead_letters()
+        elif not letter_id:
+            return
+        elif action == 'replay':
+            respond.admin_replay_dead_letter(letter_id)
+        else:
+            respond.admin_drop_dead_letter(letter_id)
+
     elif re.search(r'(/admin)\s+(mail)', message.text):
         Log.info('handler: /admin mail')
         parts = re.findall(r'(/admin)\s+(mail)\s+(.+)', message.text, flags=re.DOTALL)
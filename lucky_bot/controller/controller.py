@@ -1,14 +1,22 @@
+import os
+import socket
+from time import time as current_time
+
 import telebot
 
 from lucky_bot.helpers.constants import (
-    ControllerException, TelebotHandlerException,
+    IMQ_BATCH_SIZE, IMQ_LEASE_TIME, ControllerException, TelebotHandlerException,
     DatabaseException, OMQException, IMQException, AdminExitSignal,
 )
 from lucky_bot.helpers.signals import (
     CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED,
     INCOMING_MESSAGE, EXIT_SIGNAL,
+    SignalThreadStarted, SignalThreadStopped,
 )
 from lucky_bot.helpers.misc import ThreadTemplate
+from lucky_bot.helpers.records import MessageRecord, is_record, unpack_record
+from lucky_bot.helpers.metrics import MESSAGES, STAGE_LATENCY
+from lucky_bot.helpers import tracing
 
 from lucky_bot import BOT
 from lucky_bot.receiver import InputQueue
@@ -24,82 +32,153 @@ from logs import Log
 Internal
 /sender delete [tg_uid] -> responder deletes data
 
-TODO FEATURE admin
-/admin something
+Admin, through the bot handlers
+/admin dlq list -> responder lists the dead letters
+/admin dlq replay [id] -> responder returns a dead letter to the queue
+/admin dlq drop [id] -> responder deletes a dead letter
 '''
 
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+
+PROCESSED = MESSAGES.labels(stage='controller')
+CONTROLLER_LATENCY = STAGE_LATENCY.labels(stage='controller')
+
+
 class Controller:
     """ Gets messages from the input message queue and handles them. """
     responder = Respond()
 
     @classmethod
-    def check_new_messages(cls):
+    def check_new_messages(cls, worker_id: str = WORKER_ID):
         """
+        Claims the messages for the worker_id, so several controllers can share the queue.
+
+        A message that raises TelebotHandlerException is returned to the queue,
+        and goes to the dead letters after IMQ_MAX_ATTEMPTS.
+        The trace of a message is current while it's processed, see helpers.tracing.
+
         Exceptions go through:
             IMQException
             OMQException
             DatabaseException
-            TelebotHandlerException
             AdminExitSignal: propagation
         """
         while True:
-            result = InputQueue.get_first_message()
-            if not result:
+            messages = InputQueue.claim_messages(worker_id, IMQ_BATCH_SIZE)
+            if not messages:
                 break
 
-            message_id, data = result
+            # the processed messages are deleted in one transaction per batch,
+            # even if the next message in the batch raises;
+            # the rest of the batch goes back to the queue
+            processed = []
+            handled = 0
+            renew_at = current_time() + IMQ_LEASE_TIME / 2
             try:
-                cls._process_the_message(data)
-                InputQueue.delete_message(message_id)
+                for message_id, data, trace in messages:
+                    if current_time() > renew_at:
+                        InputQueue.renew_lease(worker_id, [msg[0] for msg in messages[handled:]])
+                        renew_at = current_time() + IMQ_LEASE_TIME / 2
+                    try:
+                        tracing.set_current(trace and tracing.Trace.loads(trace).mark())
+                        with CONTROLLER_LATENCY.timer():
+                            cls._process_the_message(data)
+                    except AdminExitSignal as exc:
+                        processed.append(message_id)
+                        handled += 1
+                        raise exc
+                    except TelebotHandlerException as exc:
+                        # a poison message must not stop the others
+                        cls._fail_the_message(message_id, worker_id, exc)
+                    else:
+                        processed.append(message_id)
+                        PROCESSED.increment()
+                    handled += 1
+            finally:
+                tracing.set_current(None)
+                InputQueue.delete_messages(processed, worker_id)
+                InputQueue.release_messages(worker_id, [msg[0] for msg in messages[handled:]])
 
-            except AdminExitSignal as exc:
-                InputQueue.delete_message(message_id)
-                raise exc
+    @staticmethod
+    def _fail_the_message(message_id: int, worker_id: str, exc: TelebotHandlerException):
+        error = type(exc.args[0]).__name__ if exc.args else type(exc).__name__
+        if InputQueue.fail_message(message_id, worker_id, error) is True:
+            msg = f'controller: message id-{message_id} moved to the dead letters ({error})'
+            Log.error(msg)
 
     @classmethod
-    def _process_the_message(cls, data: str):
+    def _process_the_message(cls, data: str | bytes):
         """
-        Calls the responder or the bot processor, depending on message data.
+        Calls the responder or the bot processor, depending on message data:
+        an internal command, a compact record of a text message, or an Update json.
 
         Raises:
             TelebotHandlerException
             DatabaseException: propagation
+            IMQException: propagation
             OMQException: propagation
             AdminExitSignal: propagation
         """
-        if data.startswith('/'):
+        if not is_record(data) and data.startswith('/'):
             if data.startswith('/sender delete'):
                 uid = data.removeprefix('/sender delete ')
                 cls.responder.delete_user(uid)
         else:
             try:
-                update = telebot.types.Update.de_json(data)
-                BOT.process_new_updates([update])
+                if is_record(data):
+                    BOT.process_new_messages([cls._make_message(unpack_record(data))])
+                else:
+                    update = telebot.types.Update.de_json(data)
+                    BOT.process_new_updates([update])
 
             except AdminExitSignal as exc:
                 raise exc
-            except (DatabaseException, OMQException) as exc:
+            except (DatabaseException, IMQException, OMQException) as exc:
                 raise exc
             except Exception as exc:
                 msg = 'controller: exception in a telebot handler'
                 Log.error(msg)
                 raise TelebotHandlerException(exc)
 
+    @staticmethod
+    def _make_message(record: MessageRecord) -> telebot.types.Message:
+        """ The same telebot Message the handlers get from a full Update of a private chat. """
+        user = telebot.types.User(record.user_id, is_bot=False, first_name='', username=record.username or None)
+        chat = telebot.types.Chat(record.chat_id, 'private', username=record.username or None)
+        return telebot.types.Message(
+            record.message_id, user, record.date, chat, 'text', {'text': record.text}, None,
+        )
+
 
 class ControllerThread(ThreadTemplate):
+    """
+    The first worker sets CONTROLLER_IS_RUNNING and CONTROLLER_IS_STOPPED,
+    the others have their own signals, so each worker is started and stopped by itself.
+    """
     is_running_signal = CONTROLLER_IS_RUNNING
     is_stopped_signal = CONTROLLER_IS_STOPPED
     signal_after_exit = INCOMING_MESSAGE
     controller = Controller()
 
+    def __init__(self, worker: int = 0):
+        super().__init__()
+        self.worker = worker
+        if worker > 0:
+            self.is_running_signal = SignalThreadStarted()
+            self.is_stopped_signal = SignalThreadStopped()
+
     def __str__(self):
-        return 'controller thread'
+        return f'controller thread {self.worker}' if self.worker else 'controller thread'
+
+    @property
+    def worker_id(self) -> str:
+        return f'{WORKER_ID}-{self.name}'
 
     def body(self):
         """
         Description:
-            0. Check the Input Message Queue, respond or parse any messages;
-            1. Clear INCOMING_MESSAGE signal, if set;
+            0. Clear INCOMING_MESSAGE signal, if set;
+            1. Check the Input Message Queue, respond or parse any messages;
             2. Set the CONTROLLER_IS_RUNNING signal;
             3. Loop and wait for the NEW_INCOMING_MESSAGE signal.
 
@@ -108,7 +187,6 @@ class ControllerThread(ThreadTemplate):
 
         Raises:
             ControllerException
-            TelebotHandlerException: propagation
             DatabaseException: propagation
             IMQException: propagation
             OMQException: propagation
@@ -123,22 +201,22 @@ class ControllerThread(ThreadTemplate):
                 if EXIT_SIGNAL.is_set():
                     break
                 else:
-                    self.controller.check_new_messages()
+                    # cleared before the check, so a message that arrives during the check keeps its signal
                     INCOMING_MESSAGE.clear()
+                    self.controller.check_new_messages(self.worker_id)
                     self._test_controller_cycle()
 
         except AdminExitSignal as exc:
             EXIT_SIGNAL.set()
-        except (OMQException, IMQException,
-                TelebotHandlerException, DatabaseException) as exc:
+        except (OMQException, IMQException, DatabaseException) as exc:
             raise exc
         except Exception as exc:
             Log.error('controller: a normal exception')
             raise ControllerException(exc)
 
     def work_before_the_loop(self):
-        self.controller.check_new_messages()
         INCOMING_MESSAGE.clear()
+        self.controller.check_new_messages(self.worker_id)
         self._set_the_signal()
         self._test_exception_after_signal()
 
@@ -5,12 +5,15 @@ It makes queries to the main database and sends messages to the output messages
 Exceptions go through:
     DatabaseException
     OMQException
+    IMQException
 """
-from lucky_bot.helpers.constants import DatabaseException, ERRORS_TOTAL, MASTER
-from lucky_bot.helpers.misc import encrypt, decrypt, make_hash
+from lucky_bot.helpers.constants import DatabaseException, ERRORS_TOTAL, MASTER, INTERACTIVE, BULK
+from lucky_bot.helpers.misc import encrypt, decrypt_many, make_hash
 from lucky_bot.helpers.signals import NEW_MESSAGE_TO_SEND
+from lucky_bot.helpers import tracing
 from lucky_bot import MainDB
 from lucky_bot.sender import OutputQueue
+from lucky_bot.receiver import InputQueue
 
 import logging
 logger = logging.getLogger(__name__)
@@ -20,9 +23,14 @@ from logs import Log
 class Respond:
     @staticmethod
     def send_message(uid: str | int | bytes, message: str | bytes,
-                     markup=False, encrypted=False):
-        """ Pass message to the sender module. """
-        OutputQueue.add_message(uid, message, markup=markup, encrypted=encrypted)
+                     markup=False, encrypted=False, priority=INTERACTIVE):
+        """
+        Pass message to the sender module.
+        An interactive reply carries the trace of the message it answers, a bulk one doesn't.
+        """
+        trace = tracing.forward(tracing.current()) if priority == INTERACTIVE else None
+        OutputQueue.add_message(uid, message, markup=markup, encrypted=encrypted,
+                                trace=trace, priority=priority)
         NEW_MESSAGE_TO_SEND.set() if not NEW_MESSAGE_TO_SEND.is_set() else None
 
     def add_user(self, uid: str | int):
@@ -39,8 +47,8 @@ class Respond:
             return
 
         message = 'Your notes:\n'
-        for note_obj in result:
-            decrypted_text = decrypt(note_obj.text)
+        texts = decrypt_many([note_obj.text for note_obj in result])
+        for note_obj, decrypted_text in zip(result, texts):
 
             lines = decrypted_text[:40].splitlines()
             text1 = '_'.join([l for l in lines if l])
@@ -99,5 +107,28 @@ class Respond:
             self.send_message(MASTER, f'Users: {users}, notes total: {notes}.')
 
     def admin_mail_users(self, msg: str):
+        text = encrypt(f'Notification:\n{msg}')
         for user in MainDB.get_all_users():
-            self.send_message(user.c_id, encrypt(f'Notification:\n{msg}'), encrypted=True)
+            self.send_message(user.c_id, text, encrypted=True, priority=BULK)
+
+    def admin_list_dead_letters(self):
+        if not (letters := InputQueue.get_dead_letters()):
+            self.send_message(MASTER, 'No dead letters.')
+            return
+
+        message = 'Dead letters:\n'
+        for letter_id, time, attempts, error in letters:
+            message += f'* id-{letter_id} :: {error}, {attempts} attempts, date {time}\n'
+        self.send_message(MASTER, message)
+
+    def admin_replay_dead_letter(self, letter_id: str | int):
+        if InputQueue.replay_dead_letter(int(letter_id)) is True:
+            self.send_message(MASTER, f'Dead letter id-{letter_id} returned to the queue.')
+        else:
+            self.send_message(MASTER, f'Dead letter id-{letter_id} not found.')
+
+    def admin_drop_dead_letter(self, letter_id: str | int):
+        if InputQueue.drop_dead_letter(int(letter_id)) is True:
+            self.send_message(MASTER, f'Dead letter id-{letter_id} deleted.')
+        else:
+            self.send_message(MASTER, f'Dead letter id-{letter_id} not found.')
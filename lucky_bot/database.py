@@ -6,14 +6,16 @@ from time import time
 from datetime import datetime, timezone
 
 from sqlalchemy import (
-    create_engine, Column, ForeignKey, String,
+    Column, ForeignKey, String,
     Integer, DateTime, BLOB, Boolean,
 )
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Query
 from sqlalchemy.exc import IntegrityError
 
-from lucky_bot.helpers.constants import DB_FILE, TESTING, LAST_NOTES_LIST, DatabaseException
-from lucky_bot.helpers.misc import encrypt, make_hash
+from lucky_bot.helpers.constants import (
+    DB_FILE, DB_DURABILITY, TESTING, LAST_NOTES_LIST, DatabaseException,
+)
+from lucky_bot.helpers.misc import make_engine, encrypt, make_hash
 
 import logging
 logger = logging.getLogger(__name__)
@@ -94,7 +96,7 @@ class LastNoteSent(MainBase):
     user = relationship(User, back_populates='last_notes')
 
 
-DB_ENGINE = create_engine(f'sqlite:///{DB_FILE}', future=True)
+DB_ENGINE = make_engine(DB_FILE, DB_DURABILITY)
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
 
@@ -44,6 +44,40 @@ TEXT_HELP = '''ⓘ Commands:
 
 # Databases
 LAST_NOTES_LIST = 10
+IMQ_BATCH_SIZE = 50  # messages per transaction in the controller
+IMQ_LEASE_TIME = 60  # seconds, a claimed message goes back to the queue after that
+IMQ_MAX_ATTEMPTS = 3  # failed processings before a message goes to the dead letters
+IMQ_UPDATE_RETENTION = 24 * 3600  # seconds the update_ids of the processed messages are kept, for the duplicates
+OMQ_BATCH_SIZE = 50  # messages per transaction in the sender
+# The lanes of the output message queue, a higher one is drained first
+INTERACTIVE = 0  # the replies to the commands
+SCHEDULED = 1  # the notes from the updater
+BULK = 2  # /admin mail
+OMQ_LANE_WEIGHTS = {INTERACTIVE: 6, SCHEDULED: 3, BULK: 1}  # the shares of a batch when all the lanes wait
+
+# Backpressure: above a watermark the webhook asks Telegram to retry later, the poller waits
+IMQ_SOFT_DEPTH = 5_000  # messages, 429
+IMQ_HARD_DEPTH = 20_000  # messages, 503
+IMQ_SOFT_AGE = 60  # seconds the oldest message waits, 429
+IMQ_HARD_AGE = 300  # seconds the oldest message waits, 503
+IMQ_AGE_PROBE_INTERVAL = 1  # seconds, the oldest message age is cached for that time
+
+# Storage profile for all the SQLite files, see helpers.misc.make_engine()
+SQLITE_POOL_SIZE = 32  # persistent connections per file, shared by the threads
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'mmap_size': 64 * 1024 * 1024,  # bytes
+    'cache_size': -8 * 1024,  # KiB
+    'busy_timeout': 5000,  # ms
+}
+SQLITE_DURABILITY = {
+    # strict: every commit is on the disk; relaxed: a commit may be lost on a power loss
+    'strict': {'synchronous': 'FULL'},
+    'relaxed': {'synchronous': 'NORMAL'},
+}
+DB_DURABILITY = 'strict'
+IMQ_DURABILITY = 'relaxed'
+OMQ_DURABILITY = 'relaxed'
 
 if TESTING:
     ''' Note:
@@ -65,6 +99,19 @@ PORT = 5000
 ADDRESS = '0.0.0.0'
 WEBHOOK_ENDPOINT = '/webhook'
 WEBHOOK_WAS_SET = re.compile('was set|already set')
+WEBHOOK_FAST_REPLY = True  # answer /ping, /help and plain text in the webhook response, bypassing the queues
+WEBHOOK_THREADS = 16  # 1 - one request at a time; keep it below SQLITE_POOL_SIZE
+WEBHOOK_QUEUE_SIZE = 64  # accepted requests waiting for a thread of the pool; the next ones get 503 at once
+RECEIVER_MODE = 'webhook'  # webhook - a tunnel and a local server; polling - getUpdates, no tunnel
+POLLING_LIMIT = 100  # updates per getUpdates call, Telegram allows 1-100
+POLLING_TIMEOUT = 5  # seconds of a long poll; keep it short, the receiver checks the exit signal between the polls
+POLLING_RETRY_DELAY = 5  # seconds after a network error
+WEBHOOK_GROUP_COMMIT = False  # gather the concurrent webhook requests in one IMQ transaction; needs WEBHOOK_THREADS > 1
+GROUP_COMMIT_WINDOW = 0.005  # seconds, how long a leader waits for the others
+GROUP_COMMIT_SIZE = 64  # a leader doesn't wait for more messages than that
+HTTP_POOL_SIZE = 32  # keep-alive connections to the Bot API, shared by all the threads; see helpers.http_session
+HTTP_CONNECT_TIMEOUT = 5  # seconds
+HTTP_READ_TIMEOUT = 15  # seconds; getUpdates waits longer, for its long poll
 
 if not REPLIT:
     api = PROJECT_DIR / 'resources' / '.tgapi'
@@ -106,12 +153,40 @@ LOG_EXCEPTIONS_FILE = PROJECT_DIR / 'logs' / 'exceptions.log'
 LOG_WERKZEUG_FILE = PROJECT_DIR / 'logs' / 'werkzeug.log'
 LOG_TELEBOT_FILE = PROJECT_DIR / 'logs' / 'pyTelegramBotAPI.log'
 ERRORS_TOTAL = PROJECT_DIR / 'logs' / 'errors_total'
+TRACE_TO_FILE = False  # write the delivered message traces to TRACE_FILE, see helpers.tracing
+TRACE_FILE = PROJECT_DIR / 'logs' / 'traces.log'
+TRACE_FILE_SIZE = 10 * 1024 * 1024  # bytes, then the file rolls over
+TRACE_FILE_BACKUPS = 3
 if not ERRORS_TOTAL.exists():
     with ERRORS_TOTAL.open('w') as f: f.write('0')
 
 
 # Main
 TREAD_RUNNING_TIMEOUT = 30
+CONTROLLER_WORKERS = 1  # note: the workers don't keep the order of messages between them
+
+# Sender
+SENDER_WORKERS = 4  # the chats of a batch are delivered in parallel, the messages of a chat in order
+SENDER_MODE = 'threads'  # threads - the SENDER_WORKERS pool; async - one event loop, see sender.async_sender
+ASYNC_SENDER_CONCURRENCY = 200  # sendMessage requests in flight, and the connections of the session
+ASYNC_SENDER_BATCH = 500  # messages read from the OMQ at once
+
+# the Telegram limits; see sender.rate_limiter
+SEND_RATE_GLOBAL = 30  # messages per second to all the chats
+SEND_BURST_GLOBAL = 30
+SEND_RATE_PER_CHAT = 1  # messages per second to one chat
+SEND_BURST_PER_CHAT = 1
+SEND_RETRY_AFTER = 10  # seconds a chat waits after "Too many requests", if telegram doesn't say
+SEND_MAX_ATTEMPTS = 3  # to send a message that fails with an undefined error; then the user gets a notice
+SEND_BACKOFF_BASE = 2  # seconds a chat waits after the first failed attempt, doubled after each next one
+SEND_BACKOFF_MAX = 300
+BREAKER_WINDOW = 20  # the last calls to Telegram counted by the circuit breaker; see sender.circuit_breaker
+BREAKER_MIN_CALLS = 10  # the breaker doesn't open on fewer calls in the window
+BREAKER_FAILURE_RATE = 0.5  # failed calls in the window to open the breaker
+BREAKER_COOLDOWN = 30  # seconds the breaker stays open before a probe
+
+# Updater
+UPDATER_SPREAD_WINDOW = 30 * 60  # seconds, the notes of a round are delivered over that time; 0 - all at once
 
 
 # Telegram request errors
@@ -133,7 +208,7 @@ TREAD_RUNNING_TIMEOUT = 30
 TG_WRONG_TOKEN = re.compile('Unauthorized')
 TG_UID_NOT_FOUND = re.compile('not found')
 TG_BOT_BLOCKED = re.compile('kicked|blocked|deactivated')
-TG_BOT_TIMEOUT = re.compile('Too many requests')
+TG_BOT_TIMEOUT = re.compile('Too many requests', re.IGNORECASE)  # "Too Many Requests: retry after N"
 
 
 # Exceptions
@@ -199,7 +274,17 @@ class DispatcherNoAccess(OutputDispatcherException):
     """ "Uid not found" or "bot blocked" from ApiTelegramException. """
 
 class DispatcherTimeout(OutputDispatcherException):
-    """ Timeout ApiTelegramException. """
+    """ Timeout ApiTelegramException; retry_after - seconds to wait before the next message to the chat. """
+    def __init__(self, *args, retry_after: int = None):
+        super().__init__(*args)
+        self.retry_after = retry_after
 
 class DispatcherUndefinedExc(OutputDispatcherException):
     """ Undefined ApiTelegramException. """
+
+class DispatcherUnavailable(OutputDispatcherException):
+    """ Telegram doesn't answer, or the circuit breaker is open; the messages stay in the queue.
+    retry_after - seconds to wait before the next attempt. """
+    def __init__(self, *args, retry_after: float = None):
+        super().__init__(*args)
+        self.retry_after = retry_after
@@ -0,0 +1,60 @@
+""" Pooled keep-alive HTTP session for the Bot API.
+The sync calls to Telegram go through telebot's apihelper: the sender, the webhook setup
+and the polling receiver. The fast replies need no call, they go back in the webhook response.
+bot_init sets HTTP_SESSION.request as the apihelper.CUSTOM_REQUEST_SENDER,
+so all the threads share one requests.Session with a pool of HTTP_POOL_SIZE connections,
+and a TLS connection is reused instead of opened per call.
+The async sender has its own pooled aiohttp session.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from lucky_bot.helpers.constants import HTTP_POOL_SIZE
+from lucky_bot.helpers.metrics import HTTP_REQUESTS, HTTP_CONNECTIONS
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        HTTP_CONNECTIONS.increment()
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        HTTP_CONNECTIONS.increment()
+        return super()._new_conn()
+
+
+class CountingAdapter(HTTPAdapter):
+    """ Counts the new connections of its pools. """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+class HTTPSession:
+    """
+    requests.Session is safe to share between the threads for the plain requests:
+    each one takes a connection from the pool. Above the pool size the extra connections
+    are opened and closed, instead of blocking the caller.
+    """
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = CountingAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """ The signature of apihelper.CUSTOM_REQUEST_SENDER; the timeouts come from apihelper. """
+        HTTP_REQUESTS.increment()
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+HTTP_SESSION = HTTPSession()
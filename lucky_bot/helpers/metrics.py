@@ -0,0 +1,238 @@
+""" Metrics in the Prometheus text format, see the /metrics endpoint of the Flask app.
+The values are kept in memory and updated on the hot paths; a scrape only reads them.
+A gauge may be a function instead, it's called on a scrape and must be cheap.
+
+The metrics of a module are declared here, except the queue gauges,
+which are declared next to their queues.
+"""
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from lucky_bot.helpers.misc import Counter as _Value
+from lucky_bot.helpers.signals import (
+    RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED,
+    CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED,
+    SENDER_IS_RUNNING, SENDER_IS_STOPPED,
+    UPDATER_IS_RUNNING, UPDATER_IS_STOPPED,
+)
+
+REGISTRY = []
+
+# seconds; from a fast reply to a Telegram timeout
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), registry: list = REGISTRY):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, **labels):
+        """ Will return the child for these label values; created on the first call. """
+        key = tuple(str(labels[name]) for name in self.label_names)
+        if (child := self._children.get(key)) is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        """ [(name, labels, value), ...] """
+        raise NotImplementedError
+
+    def _label_values(self) -> list[tuple[dict, object]]:
+        with self._lock:
+            children = list(self._children.items())
+        return [(dict(zip(self.label_names, key)), child) for key, child in sorted(children)]
+
+
+class Counter(Metric):
+    """ Grows only; Prometheus computes the rates. """
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def increment(self, amount=1):
+        self.labels().increment(amount)
+
+    @property
+    def value(self) -> int:
+        return self.labels().value
+
+    def samples(self):
+        return [(self.name, labels, child.value) for labels, child in self._label_values()]
+
+
+class Gauge(Metric):
+    """ Either set by the code, or read from the function on a scrape.
+    A function of a gauge with labels returns {(label value, ...): value}. """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), function=None, registry: list = REGISTRY):
+        super().__init__(name, help_text, labels, registry)
+        self.function = function
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().reset(value)
+
+    @property
+    def value(self):
+        return self.labels().value
+
+    def samples(self):
+        if self.function is None:
+            return [(self.name, labels, child.value) for labels, child in self._label_values()]
+        values = self.function()
+        if not self.label_names:
+            return [(self.name, {}, values)]
+        return [
+            (self.name, dict(zip(self.label_names, key)), value)
+            for key, value in sorted(values.items())
+        ]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def timer(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets=LATENCY_BUCKETS,
+                 registry: list = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labels, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def timer(self):
+        return self.labels().timer()
+
+    def samples(self):
+        result = []
+        for labels, child in self._label_values():
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                result.append((f'{self.name}_bucket', labels | {'le': _number(bound)}, cumulative))
+            result.append((f'{self.name}_bucket', labels | {'le': '+Inf'}, count))
+            result.append((f'{self.name}_sum', labels, total))
+            result.append((f'{self.name}_count', labels, count))
+        return result
+
+
+def _number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def render(registry: list = REGISTRY) -> str:
+    """ All the registered metrics in the Prometheus text exposition format. """
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            if labels:
+                pairs = ','.join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+                name = f'{name}{{{pairs}}}'
+            lines.append(f'{name} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _thread_states() -> dict:
+    """ 1 - running, 0 - stopped or not started. """
+    signals = {
+        'receiver': (RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED),
+        'controller': (CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED),
+        'sender': (SENDER_IS_RUNNING, SENDER_IS_STOPPED),
+        'updater': (UPDATER_IS_RUNNING, UPDATER_IS_STOPPED),
+    }
+    return {
+        (thread,): int(running.is_set() and not stopped.is_set())
+        for thread, (running, stopped) in signals.items()
+    }
+
+
+# Threads
+THREAD_RUNNING = Gauge(
+    'lucky_bot_thread_running', 'The thread has started and has not stopped.',
+    labels=('thread',), function=_thread_states,
+)
+
+# Stages: receiver, controller, sender
+MESSAGES = Counter(
+    'lucky_bot_messages_total', 'Messages passed through a stage.', labels=('stage',),
+)
+STAGE_LATENCY = Histogram(
+    'lucky_bot_stage_seconds',
+    'Processing time: a webhook request or a polling batch, a message in the controller, a delivery.',
+    labels=('stage',),
+)
+
+# Receiver; Telegram redelivers an update if it doesn't get a 200 in time
+DUPLICATE_UPDATES = Counter('lucky_bot_duplicate_updates_total', 'Redelivered updates, not saved again.')
+FAST_REPLIES = Counter('lucky_bot_fast_replies_total', 'Updates answered in the webhook response.')
+
+# Sender
+TELEGRAM_ERRORS = Counter(
+    'lucky_bot_telegram_errors_total', 'Telegram API errors in the output dispatcher.', labels=('error',),
+)
+
+# Bot API calls through the pooled session, see helpers.http_session;
+# the reused connections are the requests minus the new connections
+HTTP_REQUESTS = Counter('lucky_bot_http_requests_total', 'Sync calls to the Bot API.')
+HTTP_CONNECTIONS = Counter('lucky_bot_http_connections_total', 'New connections to the Bot API.')
+
+# Tracing: the time between the stages of a message, see helpers.tracing
+TRACE_LATENCY = Histogram(
+    'lucky_bot_trace_seconds', 'Time of a message in a stage, and from the receipt to the delivered reply.',
+    labels=('stage',), buckets=LATENCY_BUCKETS + (60, 300, 3600),
+)
+
+# Updater
+UPDATER_ROUND = Gauge('lucky_bot_updater_round_seconds', 'Duration of the last updater round.')
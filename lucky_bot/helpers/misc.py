@@ -1,24 +1,48 @@
 """ If it's not a constant, a setting variable, an exception, or a signal, then it goes here. """
+import time
 import threading
 from hashlib import sha3_256
 from datetime import datetime, timezone, timedelta
 
 from cryptography.fernet import Fernet
-
-from lucky_bot.helpers.constants import ThreadException, SALT, ENCRYPTION_KEY
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+
+from lucky_bot.helpers.constants import (
+    ThreadException, SALT, ENCRYPTION_KEY,
+    SQLITE_POOL_SIZE, SQLITE_PRAGMAS, SQLITE_DURABILITY,
+)
 from lucky_bot.helpers.signals import EXIT_SIGNAL
 
 
 # Security
+CIPHER = Fernet(ENCRYPTION_KEY)
+""" One cipher per process: Fernet() decodes and splits the key on every instantiation. """
+
 def encrypt(data) -> bytes:
     if not isinstance(data, bytes):
         data = str(data).encode()
-    return Fernet(ENCRYPTION_KEY).encrypt(data)
+    return CIPHER.encrypt(data)
 
-def decrypt(token) -> str:
+def decrypt(token, raw=False) -> str | bytes:
     if not isinstance(token, bytes):
-        text = token.encode()
-    return Fernet(ENCRYPTION_KEY).decrypt(token).decode('utf-8')
+        token = token.encode()
+    data = CIPHER.decrypt(token)
+    return data if raw else data.decode('utf-8')
+
+def encrypt_many(items) -> list[bytes]:
+    """ Encrypt a batch of data with a single timestamp for all the tokens. """
+    now = int(time.time())
+    return [
+        CIPHER.encrypt_at_time(data if isinstance(data, bytes) else str(data).encode(), now)
+        for data in items
+    ]
+
+def decrypt_many(tokens, raw=False) -> list[str] | list[bytes]:
+    data = [CIPHER.decrypt(token if isinstance(token, bytes) else token.encode()) for token in tokens]
+    return data if raw else [item.decode('utf-8') for item in data]
 
 def make_hash(key) -> str:
     if not isinstance(key, bytes):
@@ -26,6 +50,59 @@ def make_hash(key) -> str:
     return sha3_256(key + SALT).hexdigest()
 
 
+# Databases
+def make_engine(db_file, durability='strict') -> Engine:
+    """
+    The SQLite engine for the main database and the message queues.
+    Keeps a pool of open connections shared by the threads, instead of a new connection per session,
+    and sets the pragmas from the storage profile in helpers.constants.
+    """
+    engine = create_engine(
+        f'sqlite:///{db_file}',
+        future=True,
+        poolclass=QueuePool,
+        pool_size=SQLITE_POOL_SIZE,
+        max_overflow=SQLITE_POOL_SIZE,  # closed when returned, above the pool size
+        # a connection is used by one thread at a time, but not always by the same one
+        connect_args={'check_same_thread': False},
+    )
+    pragmas = SQLITE_PRAGMAS | SQLITE_DURABILITY[durability]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    return engine
+
+def migrate_schema(engine, metadata):
+    """
+    create_all() skips the tables that already exist, with all their new columns and indexes.
+    Will add the columns and indexes that are declared in the models but missing in the file.
+    Note: a new column must be nullable or have a server default.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    quote = engine.dialect.identifier_preparer.quote
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {quote(table.name)} ADD COLUMN {ddl}'))
+
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 # Time
 def first_update_time() -> datetime:
     """ 12 p.m. UTC """
@@ -48,6 +125,25 @@ class CurrentTime:
 
 
 # Threading
+class Counter:
+    """ A thread-safe counter. """
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def reset(self, value=0):
+        with self._lock:
+            self._value = value
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+
 class ThreadTemplate(threading.Thread):
     """
     Base class for all the threads.
@@ -116,10 +212,9 @@ class ThreadTemplate(threading.Thread):
         elif self.is_alive():
             raise ThreadException(f'Stop timeout: {self}.')
 
-    @classmethod
-    def _set_the_signal(cls):
+    def _set_the_signal(self):
         """ Signal is wrapped for testing purposes. """
-        cls.is_running_signal.set()
+        self.is_running_signal.set()
 
     @staticmethod
     def _test_exception_before_signal():
@@ -0,0 +1,55 @@
+""" Compact records for the input message queue.
+A private text message is reduced to the fields the bot handlers need and packed into
+a binary record, instead of the full Update json. Other updates are stored as json.
+
+Layout: RECORD_MAGIC, a fixed header, then utf-8 username and text.
+"""
+import struct
+from typing import NamedTuple
+
+RECORD_MAGIC = b'\x01'  # neither json '{' nor an internal command '/'
+HEADER = struct.Struct('>qqqqqHI')  # update_id, message_id, date, chat_id, user_id, username and text lengths
+
+
+class MessageRecord(NamedTuple):
+    update_id: int
+    message_id: int
+    date: int
+    chat_id: int
+    user_id: int
+    username: str
+    text: str
+
+
+def pack_update(update: dict) -> bytes | None:
+    """ Will return None, if the update is not a private text message, or a field is missing. """
+    message = update.get('message')
+    if not isinstance(message, dict) or not isinstance(message.get('text'), str) \
+            or not isinstance(chat := message.get('chat'), dict) or chat.get('type') != 'private' \
+            or not isinstance(user := message.get('from', {}), dict):
+        return None
+
+    ids = (update.get('update_id'), message.get('message_id', 0), message.get('date'),
+           chat.get('id'), user.get('id', chat.get('id')))
+    if not all(isinstance(field, int) for field in ids) \
+            or not isinstance(username := chat.get('username') or '', str):
+        return None
+
+    username = username.encode()
+    text = message['text'].encode()
+    header = HEADER.pack(*ids, len(username), len(text))
+    return RECORD_MAGIC + header + username + text
+
+
+def is_record(data) -> bool:
+    return isinstance(data, bytes) and data[:1] == RECORD_MAGIC
+
+
+def unpack_record(data: bytes) -> MessageRecord:
+    offset = len(RECORD_MAGIC)
+    *fields, username_len, text_len = HEADER.unpack_from(data, offset)
+    offset += HEADER.size
+    username = data[offset:offset + username_len].decode()
+    offset += username_len
+    text = data[offset:offset + text_len].decode()
+    return MessageRecord(*fields, username, text)
@@ -0,0 +1,80 @@
+""" Per-message latency tracing.
+A trace is stamped when a telegram message is received, and carried through the input queue,
+the controller and the output queue as a short string, until the sender delivers the reply.
+Each stage adds a mark with its start time:
+
+    receiver -> imq -> controller -> omq -> sender -> delivered
+
+The time between two marks goes to the lucky_bot_trace_seconds histogram;
+a delivered trace also goes to the total, and optionally to the rolling trace file.
+The controller keeps the trace of the current message in a thread-local,
+so a reply gets it without the bot handlers knowing about it.
+"""
+import json
+import logging
+import threading
+from time import time as current_time
+from typing import NamedTuple
+from uuid import uuid4
+
+from lucky_bot.helpers.constants import TRACE_TO_FILE
+from lucky_bot.helpers.metrics import TRACE_LATENCY
+
+STAGES = ('receiver', 'imq', 'controller', 'omq', 'sender')
+
+_CURRENT = threading.local()
+trace_logger = logging.getLogger('trace')
+
+
+class Trace(NamedTuple):
+    trace_id: str
+    marks: tuple  # the receipt time, then the start time of each next stage
+
+    @classmethod
+    def start(cls) -> 'Trace':
+        return cls(uuid4().hex[:16], (current_time(),))
+
+    def mark(self) -> 'Trace':
+        """ Will return the trace with the next stage started, and record the previous one. """
+        trace = self._replace(marks=self.marks + (current_time(),))
+        if len(trace.marks) - 2 < len(STAGES):
+            TRACE_LATENCY.labels(stage=STAGES[len(trace.marks) - 2]).observe(trace.marks[-1] - trace.marks[-2])
+        return trace
+
+    def durations(self) -> dict:
+        return {stage: round(self.marks[i + 1] - self.marks[i], 6)
+                for i, stage in enumerate(STAGES[:len(self.marks) - 1])}
+
+    def dumps(self) -> str:
+        return ':'.join([self.trace_id] + [f'{mark:.6f}' for mark in self.marks])
+
+    @classmethod
+    def loads(cls, text: str | None) -> 'Trace | None':
+        if not text:
+            return None
+        trace_id, *marks = text.split(':')
+        return cls(trace_id, tuple(float(mark) for mark in marks))
+
+
+def forward(trace: Trace | None) -> str | None:
+    """ The trace string for a queue: the next stage starts when the message is saved. """
+    return trace.mark().dumps() if trace else None
+
+def finish(trace: Trace | None):
+    """ The reply is delivered. """
+    if not trace:
+        return
+    trace = trace.mark()
+    total = trace.marks[-1] - trace.marks[0]
+    TRACE_LATENCY.labels(stage='total').observe(total)
+    if TRACE_TO_FILE:
+        trace_logger.info(json.dumps(
+            {'trace': trace.trace_id, 'received': trace.marks[0]} | trace.durations() | {'total': round(total, 6)}
+        ))
+
+
+def set_current(trace: Trace | None):
+    _CURRENT.trace = trace
+
+def current() -> Trace | None:
+    return getattr(_CURRENT, 'trace', None)
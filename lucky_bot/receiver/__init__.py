@@ -1,7 +1,9 @@
 """ Receiver.
 A module that handles input messages from Telegram, receives the internal and admin commands.
-Consists of the receiver thread, the input message queue and the webhook with ngrok server.
+Consists of the receiver thread, the input message queue and the webhook with ngrok server,
+or the polling receiver thread instead of the webhook.
 """
 from .input_mq import InputQueue
 from .flask_config import FLASK_APP
 from .receiver import ReceiverThread
+from .polling import PollingReceiverThread
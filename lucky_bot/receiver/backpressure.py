@@ -0,0 +1,68 @@
+""" Backpressure for the receiver.
+Compares the input message queue depth and the age of its oldest message with the watermarks.
+The depth is kept in memory by the queue; the age is an index probe, cached for a second.
+A crossing of a watermark is logged as an event.
+
+Exceptions go through:
+    IMQException
+"""
+import threading
+from time import monotonic
+
+from lucky_bot.helpers.constants import (
+    IMQ_SOFT_DEPTH, IMQ_HARD_DEPTH, IMQ_SOFT_AGE, IMQ_HARD_AGE, IMQ_AGE_PROBE_INTERVAL,
+)
+from lucky_bot.receiver.input_mq import InputQueue
+
+import logging
+logger = logging.getLogger(__name__)
+from logs import Log
+
+NORMAL = 200
+SOFT = 429
+HARD = 503
+
+
+class Backpressure:
+    def __init__(self):
+        self.level = NORMAL
+        self._age = 0
+        self._probed_at = None
+        self._lock = threading.Lock()
+
+    def check(self) -> int:
+        """ Will return NORMAL, or an HTTP status code for Telegram: SOFT or HARD. """
+        depth = InputQueue.depth()
+        age = self._oldest_message_age()
+
+        if depth >= IMQ_HARD_DEPTH or age >= IMQ_HARD_AGE:
+            level = HARD
+        elif depth >= IMQ_SOFT_DEPTH or age >= IMQ_SOFT_AGE:
+            level = SOFT
+        else:
+            level = NORMAL
+
+        if level != self.level:
+            with self._lock:
+                if level != self.level:
+                    self._log_crossing(self.level, level, depth, age)
+                    self.level = level
+        return level
+
+    def _oldest_message_age(self) -> int:
+        now = monotonic()
+        if self._probed_at is None or now - self._probed_at >= IMQ_AGE_PROBE_INTERVAL:
+            self._age = InputQueue.oldest_message_age()
+            self._probed_at = now
+        return self._age
+
+    @staticmethod
+    def _log_crossing(old: int, new: int, depth: int, age: int):
+        msg = f'backpressure: {old} -> {new}, imq depth {depth}, oldest message {age} s'
+        if new > old:
+            Log.warning(msg)
+        else:
+            Log.info(msg)
+
+
+BACKPRESSURE = Backpressure()
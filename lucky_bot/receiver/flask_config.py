@@ -1,21 +1,29 @@
 """ Flask based webhook.
 Calls the input message queue to save a telegram message data.
+The stateless commands are answered right in the response, see fast_reply().
+Above the queue watermarks, the updates are rejected for Telegram to retry, see backpressure.
 """
 import json
 import secrets
 from random import randint
 
-import telebot
 import flask
 from flask import Flask, request
 
 from lucky_bot.helpers.constants import (
-    WEBHOOK_ENDPOINT, WEBHOOK_SECRET,
+    WEBHOOK_ENDPOINT, WEBHOOK_SECRET, WEBHOOK_GROUP_COMMIT, WEBHOOK_FAST_REPLY, TEXT_HELP,
     WebhookWrongRequest, FlaskException, IMQException,
 )
 from lucky_bot.helpers.signals import INCOMING_MESSAGE, EXIT_SIGNAL
+from lucky_bot.helpers.records import pack_update
+from lucky_bot.helpers.tracing import Trace, forward
+from lucky_bot.helpers.metrics import (
+    DUPLICATE_UPDATES, FAST_REPLIES, MESSAGES, STAGE_LATENCY, render,
+)
 
 from lucky_bot.receiver import InputQueue
+from lucky_bot.receiver.group_commit import GroupCommit
+from lucky_bot.receiver.backpressure import BACKPRESSURE, NORMAL
 
 import logging
 logger = logging.getLogger(__name__)
@@ -35,36 +43,102 @@ FLASK_APP.config.update(
     MAX_CONTENT_LENGTH=15*1024*1024,
 )
 
+RECEIVED = MESSAGES.labels(stage='receiver')
+RECEIVER_LATENCY = STAGE_LATENCY.labels(stage='receiver')
+
+WRITE_BUFFER = GroupCommit()
 
-def get_message_data() -> str:
+
+def get_message_data() -> tuple[bytes, dict]:
     """
     Ensures that a request and its data both are correct.
+    Returns: the raw request data and the parsed update
     Raises: WebhookWrongRequest
     """
     h1 = request.headers.get('content-type')
     h2 = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
     if not h1 == 'application/json' and h2 == WEBHOOK_SECRET:
         raise WebhookWrongRequest
+    data = request.get_data()
+    return data, parse_update(data)
+
+
+def parse_update(data: bytes) -> dict:
+    """
+    A single json parsing and a check of the fields the bot relies on.
+    The full telebot objects are built by the controller.
+    Raises: WebhookWrongRequest
+    """
     try:
-        data = request.get_data().decode('utf-8')
-        telebot.types.Update.de_json(data)
-        return data
-    except Exception:
+        update = json.loads(data)
+    except ValueError:
+        raise WebhookWrongRequest
+
+    if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
         raise WebhookWrongRequest
+    if 'message' in update:
+        message = update['message']
+        if not isinstance(message, dict) \
+                or not isinstance(message.get('date'), int) \
+                or not isinstance(message.get('chat'), dict) \
+                or not isinstance(message['chat'].get('id'), int) \
+                or not isinstance(message.get('text', ''), str) \
+                or not isinstance(message.get('from', {}), dict):
+            raise WebhookWrongRequest
+    return update
+
+
+def fast_reply(update: dict) -> dict | None:
+    """
+    A sendMessage call for the stateless commands, to return in the webhook response,
+    the same as the bot handlers would answer. Will return None for anything else.
+    The fields it reads are checked by parse_update.
+    """
+    message = update.get('message')
+    if not message or message['chat'].get('type') != 'private' or not isinstance(message.get('text'), str):
+        return None
+
+    text = message['text']
+    if not text.startswith('/'):
+        reply = TEXT_HELP
+    else:
+        command = text.split(maxsplit=1)[0].split('@')[0]
+        if command == '/help':
+            reply = TEXT_HELP
+        elif command == '/ping':
+            reply = 'pong'
+        else:
+            return None
 
+    return {'method': 'sendMessage', 'chat_id': message['chat']['id'], 'text': reply}
 
-def save_message_to_queue(data):
+
+def save_message_to_queue(data: bytes, update: dict, trace: Trace = None) -> bool:
     """
-    Tries to save a message data to the Input Message Queue.
+    Tries to save a message data to the Input Message Queue, with its trace.
+    Will return False, if the update is a duplicate of a queued one.
     Raises:
         FlaskException
         IMQException: propagation
     """
     try:
         test_exception()
-        d = json.loads(data)
-        time = d['message']['date']
-        InputQueue.add_message(data, time)
+        update_id = update['update_id']
+        # other kinds of updates are saved with the current time
+        time = update['message']['date'] if 'message' in update else None
+        data = pack_update(update) or data
+
+        if WEBHOOK_GROUP_COMMIT:
+            add_message = WRITE_BUFFER.add_message
+        else:
+            add_message = InputQueue.add_message
+
+        if InputQueue.has_update(update_id) is True \
+                or add_message(data, time, update_id=update_id, trace=forward(trace)) is False:
+            DUPLICATE_UPDATES.increment()
+            Log.info(f'flask: duplicate update {update_id} dropped')
+            return False
+        return True
 
     except IMQException as exc:
         EXIT_SIGNAL.set()
@@ -76,6 +150,25 @@ def save_message_to_queue(data):
         raise FlaskException(exc)
 
 
+def remember_fast_reply(update: dict) -> bool:
+    """
+    Records the update_id of a fast reply as processed, so a redelivered update is answered once.
+    Will return False, if the update is a duplicate.
+    Raises:
+        IMQException: propagation
+    """
+    try:
+        if InputQueue.remember_update(update['update_id']) is False:
+            DUPLICATE_UPDATES.increment()
+            Log.info(f'flask: duplicate update {update["update_id"]} dropped')
+            return False
+        return True
+
+    except IMQException as exc:
+        EXIT_SIGNAL.set()
+        raise exc
+
+
 @FLASK_APP.route(WEBHOOK_ENDPOINT, methods=['POST'])
 def inbox():
     """
@@ -85,11 +178,12 @@ def inbox():
     Raises:
         FlaskException
     """
+    trace = Trace.start()
     try:
-        data = get_message_data()
+        data, update = get_message_data()
 
     except WebhookWrongRequest:
-        msg = 'flask: wrong request: %s' % request.get_data().decode('utf-8')
+        msg = 'flask: wrong request: %s' % request.get_data().decode('utf-8', errors='replace')
         Log.warning(msg)
         flask.abort(400)
     except Exception as exc:
@@ -99,12 +193,31 @@ def inbox():
         raise FlaskException(exc)
 
     else:
-        save_message_to_queue(data)
-        INCOMING_MESSAGE.set()
-        Log.console('new tg message')
+        if WEBHOOK_FAST_REPLY and (reply := fast_reply(update)):
+            if remember_fast_reply(update) is False:
+                return '', 200
+            FAST_REPLIES.increment()
+            Log.info('flask: fast reply')
+            return flask.jsonify(reply)
+
+        if (level := BACKPRESSURE.check()) != NORMAL:
+            # telegram will redeliver the update later
+            return '', level
+
+        with RECEIVER_LATENCY.timer():
+            saved = save_message_to_queue(data, update, trace)
+        if saved is True:
+            RECEIVED.increment()
+            INCOMING_MESSAGE.set()
+            Log.console('new tg message')
         return '', 200
 
 
 @FLASK_APP.route('/ping', methods=['GET'])
 def ping():
     return 'pong', 200
+
+
+@FLASK_APP.route('/metrics', methods=['GET'])
+def metrics():
+    return render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -0,0 +1,81 @@
+""" Group commit for the webhook.
+Concurrent requests put their messages in a shared buffer. The first of them becomes a leader:
+it waits a few milliseconds for the others, saves the whole buffer to the Input Message Queue
+in one transaction, and wakes up the followers with their results.
+A request returns only after the transaction with its message is committed.
+
+Exceptions go through:
+    IMQException
+"""
+import threading
+
+from lucky_bot.helpers.constants import GROUP_COMMIT_WINDOW, GROUP_COMMIT_SIZE
+from lucky_bot.receiver.input_mq import InputQueue
+
+
+class _Entry:
+    __slots__ = ('message', 'ready', 'done', 'result', 'error')
+
+    def __init__(self, message: tuple):
+        self.message = message
+        self.ready = threading.Event()
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class GroupCommit:
+    def __init__(self, window=GROUP_COMMIT_WINDOW, size=GROUP_COMMIT_SIZE):
+        self.window = window
+        self.size = size
+        self._lock = threading.Lock()
+        self._full = threading.Condition(self._lock)
+        self._pending = []
+        self._leader = False
+
+    def add_message(self, data: str | bytes, time=None, update_id: int = None, trace: str = None) -> bool:
+        """ Same as InputQueue.add_message(), but shares the transaction with the concurrent calls. """
+        entry = _Entry((data, time, update_id, trace))
+        with self._lock:
+            self._pending.append(entry)
+            if self._leader:
+                if len(self._pending) >= self.size:
+                    self._full.notify()
+                lead = False
+            else:
+                self._leader = lead = True
+
+        if lead is False:
+            entry.ready.wait()
+
+        if entry.done is False:
+            # a leader, or a follower that has got the leadership after the previous commit
+            self._commit()
+
+        if entry.error:
+            raise entry.error
+        return entry.result
+
+    def _commit(self):
+        with self._lock:
+            self._full.wait_for(lambda: len(self._pending) >= self.size, timeout=self.window)
+            batch, self._pending = self._pending[:self.size], self._pending[self.size:]
+
+        try:
+            results = InputQueue.add_messages([entry.message for entry in batch])
+        except Exception as exc:
+            for entry in batch:
+                entry.error = exc
+        else:
+            for entry, result in zip(batch, results):
+                entry.result = result
+        finally:
+            for entry in batch:
+                entry.done = True
+                entry.ready.set()
+
+            with self._lock:
+                if self._pending:
+                    self._pending[0].ready.set()
+                else:
+                    self._leader = False
@@ -1,15 +1,34 @@
 """
 Input Message Queue.
 Saves a message data from Telegram, or internal and admin commands, for future processing.
+A message is returned as a text, or as bytes if it is a compact record, see helpers.records.
+
+Consumers claim messages for a lease time. A claimed message is hidden from the other
+consumers until it is deleted, released, or its lease expires.
+A message that has failed IMQ_MAX_ATTEMPTS times is moved to the dead letters table,
+where it waits for the admin to replay or drop it.
+The update_id of a deleted telegram message is kept for IMQ_UPDATE_RETENTION,
+so a redelivery of the update is still a duplicate after the message is processed.
+
 Raises: IMQException
 """
+import threading
 from time import time as current_time
 
-from sqlalchemy import create_engine, Column, Integer, BLOB
+from sqlalchemy import Column, Index, Integer, Float, String, BLOB, select, update, or_, text, func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.exc import IntegrityError
 
-from lucky_bot.helpers.constants import TESTING, INPUT_MQ_FILE, IMQException
-from lucky_bot.helpers.misc import encrypt, decrypt
+from lucky_bot.helpers.constants import (
+    TESTING, INPUT_MQ_FILE, IMQ_DURABILITY, IMQ_LEASE_TIME, IMQ_MAX_ATTEMPTS, IMQ_UPDATE_RETENTION,
+    IMQException,
+)
+from lucky_bot.helpers.misc import (
+    make_engine, migrate_schema, encrypt, decrypt, encrypt_many, decrypt_many, Counter,
+)
+from lucky_bot.helpers.records import is_record
+from lucky_bot.helpers.metrics import Gauge
 
 import logging
 logger = logging.getLogger(__name__)
@@ -33,54 +52,229 @@ def catch_exception(func):
 
     return wrapper
 
+def payload(data: bytes) -> str | bytes:
+    """ A compact record stays binary, anything else is a text. """
+    return data if is_record(data) else data.decode('utf-8')
+
 IMQBase = declarative_base()
 
 
 class IncomingMessage(IMQBase):
     __tablename__ = 'incoming_messages'
+    __table_args__ = (
+        Index('ix_incoming_messages_fifo', 'message_date', 'id'),
+        Index('ix_incoming_messages_update_id', 'update_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     data = Column('message_body', BLOB, nullable=False)
     time = Column('message_date', Integer, nullable=False)
+    claimed_by = Column('claimed_by', String(100), nullable=True, default=None)
+    lease_until = Column('lease_until', Float, nullable=True, default=None)
+    update_id = Column('update_id', Integer, nullable=True, default=None)  # telegram messages only
+    attempts = Column('attempts', Integer, nullable=False, default=0, server_default='0')
+    # the message_date is telegram's time, it may be old after a redelivery
+    queued_at = Column('queued_at', Integer, nullable=True, default=lambda: int(current_time()))
+    trace = Column('trace', String, nullable=True, default=None)  # see helpers.tracing
 
     def __str__(self):
         return f'<input message id-{self.id!r}>'
 
 
-IMQ_ENGINE = create_engine(f'sqlite:///{INPUT_MQ_FILE}', future=True)
+class DeadLetter(IMQBase):
+    __tablename__ = 'dead_letters'
+
+    id = Column(Integer, primary_key=True)
+    data = Column('message_body', BLOB, nullable=False)
+    time = Column('message_date', Integer, nullable=False)
+    attempts = Column('attempts', Integer, nullable=False)
+    error = Column('error', String(100), nullable=False)
+    dead_since = Column('dead_since', Integer, nullable=False)
+
+    def __str__(self):
+        return f'<dead letter id-{self.id!r}>'
+
+
+class ProcessedUpdate(IMQBase):
+    """ The update_id of a telegram message that has left the queue. """
+    __tablename__ = 'processed_updates'
+    __table_args__ = (
+        Index('ix_processed_updates_time', 'processed_at'),
+    )
+
+    update_id = Column(Integer, primary_key=True)
+    processed_at = Column('processed_at', Integer, nullable=False)
+
+
+def remember_updates(session, query):
+    """ Keep the update_ids of the messages that the query is about to delete, in the same transaction. """
+    now = int(current_time())
+    update_ids = [row.update_id for row in query.with_entities(IncomingMessage.update_id)
+                  if row.update_id is not None]
+    if update_ids:
+        session.execute(
+            insert(ProcessedUpdate)
+            .values([{'update_id': update_id, 'processed_at': now} for update_id in update_ids])
+            .on_conflict_do_nothing()
+        )
+
+def is_processed(session, update_ids: list) -> set:
+    return {row.update_id for row in session.query(ProcessedUpdate.update_id)
+            .filter(ProcessedUpdate.update_id.in_(update_ids))}
+
+
+class PollingOffset(IMQBase):
+    """ The next update_id to ask from Telegram, in the polling mode. A single row. """
+    __tablename__ = 'polling_offset'
+
+    id = Column(Integer, primary_key=True)
+    offset = Column('offset', Integer, nullable=False)
+
+
+IMQ_ENGINE = make_engine(INPUT_MQ_FILE, IMQ_DURABILITY)
 IMQ_SESSION = sessionmaker(bind=IMQ_ENGINE)
+# the webhook threads wait for each other here, instead of the SQLite busy handler's sleeps
+IMQ_WRITE_LOCK = threading.Lock()
+# messages in the queue, kept by this process instead of a COUNT(*) per request
+IMQ_DEPTH = Counter()
 
 
 class InputQueue:
-    """ Wrapper for the queries to the input message queue. FIFO. """
+    """ Wrapper for the queries to the input message queue. FIFO by (time, id). """
 
     @staticmethod
     @catch_exception
     def set_up():
         IMQBase.metadata.create_all(IMQ_ENGINE)
+        migrate_schema(IMQ_ENGINE, IMQBase.metadata)
+        with IMQ_SESSION() as session:
+            IMQ_DEPTH.reset(session.query(func.count(IncomingMessage.id)).scalar())
 
     @staticmethod
     @catch_exception
     def tear_down():
         if TESTING and INPUT_MQ_FILE.exists():
             IMQBase.metadata.drop_all(IMQ_ENGINE)
+            IMQ_DEPTH.reset()
+
+    @staticmethod
+    def depth() -> int:
+        return IMQ_DEPTH.value
+
+    @staticmethod
+    @catch_exception
+    def oldest_message_age() -> int:
+        """ Seconds since the oldest message was queued, 0 if the queue is empty. A primary key probe. """
+        with IMQ_SESSION() as session:
+            queued_at = session.query(IncomingMessage.queued_at)\
+                .order_by(IncomingMessage.id)\
+                .limit(1)\
+                .scalar()
+        return max(int(current_time()) - queued_at, 0) if queued_at else 0
 
     @staticmethod
     @catch_exception
-    def add_message(data: str, time=None, encrypted=False) -> True:
-        """ Cypher any data. """
+    def add_message(data: str | bytes, time=None, encrypted=False, update_id: int = None,
+                    trace: str = None) -> bool:
+        """
+        Cypher any data.
+        Will return False if a message with this telegram update_id is already in the queue,
+        or has been processed.
+        """
         test_func()
         if not time:
             time = int(current_time())
 
         if not encrypted:
-            data = encrypt(data.encode())
+            data = encrypt(data)
 
-        with IMQ_SESSION.begin() as session:
-            session.add(
-                IncomingMessage(data=data, time=time)
+        try:
+            with IMQ_WRITE_LOCK, IMQ_SESSION.begin() as session:
+                if update_id is not None and is_processed(session, [update_id]):
+                    return False
+                session.add(
+                    IncomingMessage(data=data, time=time, update_id=update_id, trace=trace)
+                )
+        except IntegrityError:
+            return False
+        else:
+            IMQ_DEPTH.increment()
+            return True
+
+    @staticmethod
+    @catch_exception
+    def add_messages(messages: list, offset: int = None) -> list[bool]:
+        """
+        Cypher and save the messages in one transaction.
+
+        Args:
+            messages: [(data, time, update_id[, trace]), ...]; time, update_id and trace may be None
+            offset: the polling offset to save in the same transaction
+
+        Returns:
+            list: True for each saved message, False for a duplicate update_id, queued or processed
+        """
+        test_func()
+        if not messages and offset is None:
+            return []
+
+        now = int(current_time())
+        tokens = encrypt_many([message[0] for message in messages])
+        update_ids = [message[2] for message in messages if message[2] is not None]
+
+        with IMQ_WRITE_LOCK, IMQ_SESSION.begin() as session:
+            seen = {row.update_id for row in session.query(IncomingMessage.update_id)
+                    .filter(IncomingMessage.update_id.in_(update_ids))} \
+                | is_processed(session, update_ids) if update_ids else set()
+            result = []
+            for (_, time, update_id, *trace), token in zip(messages, tokens):
+                if update_id is not None and update_id in seen:
+                    result.append(False)
+                    continue
+                if update_id is not None:
+                    seen.add(update_id)
+                session.add(IncomingMessage(data=token, time=time or now, update_id=update_id,
+                                            trace=trace[0] if trace else None))
+                result.append(True)
+            if offset is not None:
+                session.merge(PollingOffset(id=1, offset=offset))
+        IMQ_DEPTH.increment(result.count(True))
+        return result
+
+    @staticmethod
+    @catch_exception
+    def get_offset() -> int | None:
+        with IMQ_SESSION() as session:
+            if not (offset_obj := session.get(PollingOffset, 1)):
+                return None
+            return offset_obj.offset
+
+    @staticmethod
+    @catch_exception
+    def has_update(update_id: int) -> bool:
+        """ Two index probes, for the duplicate telegram updates: in the queue, or processed. """
+        with IMQ_SESSION() as session:
+            return session.query(IncomingMessage.id)\
+                .filter(IncomingMessage.update_id == update_id)\
+                .first() is not None \
+                or bool(is_processed(session, [update_id]))
+
+    @staticmethod
+    @catch_exception
+    def remember_update(update_id: int) -> bool:
+        """
+        Marks an update that is answered without the queue as processed.
+        Will return False if the update is already in the queue, or has been processed.
+        """
+        with IMQ_WRITE_LOCK, IMQ_SESSION.begin() as session:
+            if session.query(IncomingMessage.id).filter(IncomingMessage.update_id == update_id).first():
+                return False
+            result = session.execute(
+                insert(ProcessedUpdate)
+                .values(update_id=update_id, processed_at=int(current_time()))
+                .on_conflict_do_nothing()
             )
-        return True
+            return result.rowcount == 1
 
     @staticmethod
     @catch_exception
@@ -96,11 +290,163 @@ class InputQueue:
         test_func2()
         with IMQ_SESSION() as session:
             if not (msg_obj := session.query(IncomingMessage)
-                    .order_by(IncomingMessage.time)
+                    .order_by(IncomingMessage.time, IncomingMessage.id)
                     .first()):
                 return None
             else:
-                return msg_obj.id, decrypt(msg_obj.data)
+                return msg_obj.id, payload(decrypt(msg_obj.data, raw=True))
+
+    @staticmethod
+    @catch_exception
+    def get_messages(limit: int) -> list:
+        """
+        Decipher and return up to `limit` first messages, in one query.
+
+        Returns:
+            list: [(message_id, message_data), ...], empty if the queue is empty
+        """
+        test_func2()
+        with IMQ_SESSION() as session:
+            rows = session.query(IncomingMessage.id, IncomingMessage.data)\
+                .order_by(IncomingMessage.time, IncomingMessage.id)\
+                .limit(limit)\
+                .all()
+        return list(zip(
+            [row.id for row in rows],
+            map(payload, decrypt_many([row.data for row in rows], raw=True)),
+        ))
+
+    @staticmethod
+    @catch_exception
+    def claim_messages(worker_id: str, limit: int, lease=IMQ_LEASE_TIME) -> list:
+        """
+        Atomically claim up to `limit` first messages that are free or whose lease has expired,
+        decipher and return them.
+
+        Returns:
+            list: [(message_id, message_data, trace), ...], empty if there is nothing to claim
+        """
+        test_func2()
+        now = current_time()
+        lease_until = now + lease
+        with IMQ_SESSION.begin() as session:
+            # take the write lock before the read, so two consumers can't claim the same rows
+            session.execute(text('BEGIN IMMEDIATE'))
+
+            free_messages = select(IncomingMessage.id)\
+                .where(or_(IncomingMessage.lease_until.is_(None),
+                           IncomingMessage.lease_until <= now))\
+                .order_by(IncomingMessage.time, IncomingMessage.id)\
+                .limit(limit)
+            session.execute(
+                update(IncomingMessage)
+                .where(IncomingMessage.id.in_(free_messages))
+                .values(claimed_by=worker_id, lease_until=lease_until)
+                .execution_options(synchronize_session=False)
+            )
+            rows = session.query(IncomingMessage.id, IncomingMessage.data, IncomingMessage.trace)\
+                .filter(IncomingMessage.claimed_by == worker_id,
+                        IncomingMessage.lease_until == lease_until)\
+                .order_by(IncomingMessage.time, IncomingMessage.id)\
+                .all()
+
+        return list(zip(
+            [row.id for row in rows],
+            map(payload, decrypt_many([row.data for row in rows], raw=True)),
+            [row.trace for row in rows],
+        ))
+
+    @staticmethod
+    @catch_exception
+    def renew_lease(worker_id: str, msg_ids: list, lease=IMQ_LEASE_TIME) -> int:
+        """ Extend the lease of the messages that are still claimed by the worker. """
+        if not msg_ids:
+            return 0
+        with IMQ_SESSION.begin() as session:
+            return session.query(IncomingMessage)\
+                .filter(IncomingMessage.id.in_(msg_ids),
+                        IncomingMessage.claimed_by == worker_id)\
+                .update({IncomingMessage.lease_until: current_time() + lease},
+                        synchronize_session=False)
+
+    @staticmethod
+    @catch_exception
+    def release_messages(worker_id: str, msg_ids: list) -> int:
+        """ Return the claimed messages to the queue without waiting for the lease. """
+        if not msg_ids:
+            return 0
+        with IMQ_SESSION.begin() as session:
+            return session.query(IncomingMessage)\
+                .filter(IncomingMessage.id.in_(msg_ids),
+                        IncomingMessage.claimed_by == worker_id)\
+                .update({IncomingMessage.claimed_by: None,
+                         IncomingMessage.lease_until: None},
+                        synchronize_session=False)
+
+    @staticmethod
+    @catch_exception
+    def fail_message(msg_id: int, worker_id: str, error: str) -> bool:
+        """
+        Count a failed processing of the claimed message and return it to the queue,
+        or move it to the dead letters after IMQ_MAX_ATTEMPTS.
+        Will return True if the message has been moved.
+        """
+        with IMQ_SESSION.begin() as session:
+            if not (msg_obj := session.query(IncomingMessage)
+                    .filter(IncomingMessage.id == msg_id,
+                            IncomingMessage.claimed_by == worker_id)
+                    .first()):
+                return False
+
+            msg_obj.attempts += 1
+            if msg_obj.attempts < IMQ_MAX_ATTEMPTS:
+                msg_obj.claimed_by = None
+                msg_obj.lease_until = None
+                return False
+
+            session.add(DeadLetter(
+                data=msg_obj.data, time=msg_obj.time, attempts=msg_obj.attempts,
+                error=error[:100], dead_since=int(current_time()),
+            ))
+            remember_updates(session, session.query(IncomingMessage).filter(IncomingMessage.id == msg_id))
+            session.delete(msg_obj)
+        IMQ_DEPTH.increment(-1)
+        return True
+
+    @staticmethod
+    @catch_exception
+    def get_dead_letters() -> list:
+        """
+        Returns:
+            list: [(dead_letter_id, message_date, attempts, error), ...], oldest first
+        """
+        with IMQ_SESSION() as session:
+            rows = session.query(DeadLetter.id, DeadLetter.time, DeadLetter.attempts, DeadLetter.error)\
+                .order_by(DeadLetter.id)\
+                .all()
+        return [tuple(row) for row in rows]
+
+    @staticmethod
+    @catch_exception
+    def replay_dead_letter(letter_id: int) -> bool:
+        """ Put the dead letter back at its place in the queue, with a clean attempts count. """
+        with IMQ_SESSION.begin() as session:
+            if not (letter := session.query(DeadLetter)
+                    .filter(DeadLetter.id == letter_id)
+                    .first()):
+                return False
+            session.add(IncomingMessage(data=letter.data, time=letter.time))
+            session.delete(letter)
+        IMQ_DEPTH.increment()
+        return True
+
+    @staticmethod
+    @catch_exception
+    def drop_dead_letter(letter_id: int) -> bool:
+        with IMQ_SESSION.begin() as session:
+            return session.query(DeadLetter)\
+                .filter(DeadLetter.id == letter_id)\
+                .delete(synchronize_session=False) > 0
 
     @staticmethod
     @catch_exception
@@ -110,9 +456,43 @@ class InputQueue:
                     .filter(IncomingMessage.id == msg_id)
                     .first()):
                 return False
+            remember_updates(session, session.query(IncomingMessage).filter(IncomingMessage.id == msg_id))
             session.delete(msg_obj)
+        IMQ_DEPTH.increment(-1)
         return True
 
+    @staticmethod
+    @catch_exception
+    def delete_messages(msg_ids: list, worker_id: str = None) -> int:
+        """
+        Delete the messages in one transaction. Will return the number of deleted rows.
+        With the worker_id, will skip the messages that have been claimed by another consumer.
+        The update_ids older than IMQ_UPDATE_RETENTION are forgotten in the same transaction.
+        """
+        if not msg_ids:
+            return 0
+        with IMQ_SESSION.begin() as session:
+            query = session.query(IncomingMessage).filter(IncomingMessage.id.in_(msg_ids))
+            if worker_id:
+                query = query.filter(IncomingMessage.claimed_by == worker_id)
+            remember_updates(session, query)
+            deleted = query.delete(synchronize_session=False)
+            session.query(ProcessedUpdate)\
+                .filter(ProcessedUpdate.processed_at < int(current_time()) - IMQ_UPDATE_RETENTION)\
+                .delete(synchronize_session=False)
+        IMQ_DEPTH.increment(-deleted)
+        return deleted
+
+
+IMQ_DEPTH_GAUGE = Gauge(
+    'lucky_bot_imq_depth', 'Messages in the input message queue.', function=InputQueue.depth,
+)
+IMQ_AGE_GAUGE = Gauge(
+    'lucky_bot_imq_oldest_message_seconds', 'Age of the oldest message in the input message queue.',
+    function=InputQueue.oldest_message_age,
+)
+
 
-if not TESTING and not INPUT_MQ_FILE.exists():
+if not TESTING:
+    # new file, or new columns and indexes in the old one
     InputQueue.set_up()
@@ -0,0 +1,125 @@
+""" Polling receiver thread.
+An alternative to the webhook: asks Telegram for the updates with getUpdates,
+without a tunnel and a local server.
+Each batch of updates and the next offset are saved to the Input Message Queue in one transaction,
+so an update is neither lost nor saved twice after a restart.
+"""
+import json
+
+from requests.exceptions import RequestException
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+from lucky_bot.helpers.constants import (
+    API, POLLING_LIMIT, POLLING_TIMEOUT, POLLING_RETRY_DELAY, TG_WRONG_TOKEN,
+    ReceiverException, IMQException,
+)
+from lucky_bot.helpers.signals import (
+    RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED,
+    INCOMING_MESSAGE, EXIT_SIGNAL,
+)
+from lucky_bot.helpers.misc import ThreadTemplate
+from lucky_bot.helpers.records import pack_update
+from lucky_bot.helpers.tracing import Trace, forward
+from lucky_bot.helpers.metrics import MESSAGES, STAGE_LATENCY
+from lucky_bot import BOT
+
+from lucky_bot.receiver import InputQueue
+from lucky_bot.receiver.backpressure import BACKPRESSURE, NORMAL
+
+import logging
+logger = logging.getLogger(__name__)
+from logs import Log
+
+RECEIVED = MESSAGES.labels(stage='receiver')
+RECEIVER_LATENCY = STAGE_LATENCY.labels(stage='receiver')
+
+
+class Poller:
+    offset: int = None
+
+    def connect(self):
+        # getUpdates doesn't work while a webhook is set
+        BOT.remove_webhook()
+        self.offset = InputQueue.get_offset()
+
+    def poll(self) -> int:
+        """
+        Saves one batch of updates. Will return the number of new messages.
+
+        Raises:
+            ApiTelegramException
+            RequestException
+            IMQException: propagation
+        """
+        updates = apihelper.get_updates(
+            API, offset=self.offset, limit=POLLING_LIMIT, long_polling_timeout=POLLING_TIMEOUT,
+        )
+        if not updates:
+            return 0
+
+        messages = [
+            (pack_update(update) or json.dumps(update),
+             update.get('message', {}).get('date'), update['update_id'], forward(Trace.start()))
+            for update in updates
+        ]
+        offset = max(update['update_id'] for update in updates) + 1
+        with RECEIVER_LATENCY.timer():
+            saved = InputQueue.add_messages(messages, offset=offset).count(True)
+        self.offset = offset
+        RECEIVED.increment(saved)
+        return saved
+
+
+class PollingReceiverThread(ThreadTemplate):
+    is_running_signal = RECEIVER_IS_RUNNING
+    is_stopped_signal = RECEIVER_IS_STOPPED
+
+    poller = Poller()
+
+    def __str__(self):
+        return 'polling receiver thread'
+
+    def body(self):
+        """ A simplified workflow:
+        0. Remove the webhook, if any, and load the saved offset;
+        1. Set the RECEIVER_IS_RUNNING signal;
+        2. Call getUpdates and save the batches until the EXIT_SIGNAL;
+           wait while the queue is above a watermark.
+
+        A network error or a Telegram error is logged and retried after a delay,
+        except a wrong token.
+
+        Raises:
+            ReceiverException
+            IMQException: propagation
+        """
+        try:
+            self.poller.connect()
+
+            self._set_the_signal()
+            self._test_exception_after_signal()
+
+            while not EXIT_SIGNAL.is_set():
+                if BACKPRESSURE.check() != NORMAL:
+                    # the updates wait on Telegram's side
+                    EXIT_SIGNAL.wait(POLLING_RETRY_DELAY)
+                    continue
+                try:
+                    if self.poller.poll() > 0:
+                        INCOMING_MESSAGE.set()
+                        Log.console('new tg messages')
+
+                except ApiTelegramException as exc:
+                    if TG_WRONG_TOKEN.search(exc.description):
+                        raise exc
+                    Log.warning(f'polling: telegram error: {exc.description}')
+                    EXIT_SIGNAL.wait(POLLING_RETRY_DELAY)
+                except RequestException as exc:
+                    Log.warning(f'polling: network error: {exc.__class__.__name__}')
+                    EXIT_SIGNAL.wait(POLLING_RETRY_DELAY)
+
+        except IMQException as exc:
+            raise exc
+        except Exception as exc:
+            raise ReceiverException(exc)
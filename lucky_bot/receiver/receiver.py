@@ -1,14 +1,17 @@
 """ Receiver thread.
 Integrated with the Flask app and the Input Message Queue.
 """
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from pyngrok import ngrok
 from pyngrok.ngrok import NgrokTunnel
 from pyngrok.exception import PyngrokNgrokURLError
-from werkzeug.serving import make_server, BaseWSGIServer
+from werkzeug.serving import make_server, BaseWSGIServer, WSGIRequestHandler
 
 from lucky_bot.helpers.constants import (
     REPLIT, REPLIT_URL, ADDRESS, PORT,
-    WEBHOOK_ENDPOINT, WEBHOOK_SECRET,
+    WEBHOOK_ENDPOINT, WEBHOOK_SECRET, WEBHOOK_THREADS, WEBHOOK_QUEUE_SIZE, WEBHOOK_GROUP_COMMIT,
     ReceiverException,
 )
 from lucky_bot.helpers.signals import RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED
@@ -22,6 +25,56 @@ logger = logging.getLogger(__name__)
 from logs import Log
 
 
+class OneRequestHandler(WSGIRequestHandler):
+    """ A keep-alive connection would hold a worker of the pool while it is idle. """
+    protocol_version = 'HTTP/1.0'
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Handles the requests in a fixed pool of threads.
+    Up to queue_size accepted requests wait for a thread; above that a request gets 503
+    without a thread, so an overload is shed at the socket, and Telegram redelivers the update later.
+    """
+    multithread = True
+    rejection = b'HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n'
+
+    def __init__(self, host: str, port: int, app, threads: int, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        super().__init__(host, port, app, handler=OneRequestHandler)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='webhook')
+        self.slots = threading.BoundedSemaphore(threads + queue_size)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self._reject_request(request)
+            return
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def _reject_request(self, request):
+        try:
+            # read the request that has arrived, so the close doesn't reset the connection
+            request.settimeout(0.05)
+            request.recv(65536)
+            request.sendall(self.rejection)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
 class Receiver:
     tunnel: NgrokTunnel = None
     webhook_url: str = None
@@ -66,20 +119,27 @@ class Receiver:
 
         self.webhook = BOT.set_webhook(
             url=self.webhook_url,
-            max_connections=10,
+            # Telegram accepts 1-100
+            max_connections=min(max(WEBHOOK_THREADS, 1), 100),
             secret_token=WEBHOOK_SECRET,
         )
         if self.webhook is not True:
             raise ReceiverException(f"Can't set the webhook: {self.webhook}")
 
     def _make_server(self):
-        self.server = make_server(
-            host=ADDRESS,
-            port=PORT,
-            app=FLASK_APP,
-            threaded=False,
-            processes=1,
-        )
+        if WEBHOOK_GROUP_COMMIT and WEBHOOK_THREADS < 2:
+            # one request at a time has nothing to gather, a group commit only waits its window
+            raise ReceiverException('WEBHOOK_GROUP_COMMIT needs WEBHOOK_THREADS > 1')
+        if WEBHOOK_THREADS > 1:
+            self.server = PooledWSGIServer(ADDRESS, PORT, FLASK_APP, WEBHOOK_THREADS)
+        else:
+            self.server = make_server(
+                host=ADDRESS,
+                port=PORT,
+                app=FLASK_APP,
+                threaded=False,
+                processes=1,
+            )
 
     def _remove_webhook(self):
         """ Wrapped for testing. """
@@ -88,11 +148,11 @@ class Receiver:
     def _shutdown_server(self):
         if self.server and self.serving:
             self.server.shutdown()
-            self.server.socket.close()
+            self.server.server_close()
             self.serving = False
         elif self.server and not self.serving:
             # it may happen in some cases
-            self.server.socket.close()
+            self.server.server_close()
         self.server = None
 
     def _close_tunnel(self):
@@ -1,7 +1,9 @@
 """ Sender.
 A module that handles output messages to Telegram.
-Consists of the sender thread, the output message queue and the output dispatcher.
+Consists of the sender thread, the output message queue and the output dispatcher;
+or the async sender thread instead of the sender thread.
 The module can send messages to the input message queue.
 """
 from .output_mq import OutputQueue
 from .sender import SenderThread
+from .async_sender import AsyncSenderThread
@@ -0,0 +1,257 @@
+""" Asyncio sender.
+An alternative to the SenderThread pool, selected with SENDER_MODE = 'async'.
+One event loop in the sender thread runs the telebot async client over a pooled aiohttp session,
+and keeps up to ASYNC_SENDER_CONCURRENCY sendMessage requests in flight.
+The messages of one chat are still delivered in order, and the errors are sorted
+by the output dispatcher; see Sender.
+"""
+import asyncio
+from functools import partial
+from time import time as current_time
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from lucky_bot.helpers.constants import (
+    API, ASYNC_SENDER_CONCURRENCY, ASYNC_SENDER_BATCH, SEND_MAX_ATTEMPTS, StopTheSenderGently,
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+    DispatcherWrongToken, DispatcherNoAccess, DispatcherTimeout,
+    DispatcherUndefinedExc, DispatcherUnavailable, OutputDispatcherException,
+)
+from lucky_bot.helpers.signals import INCOMING_MESSAGE
+from lucky_bot.helpers.misc import make_hash
+from lucky_bot.helpers.metrics import TELEGRAM_ERRORS
+from lucky_bot.helpers.tracing import Trace, finish
+
+from lucky_bot.receiver import InputQueue
+from lucky_bot.sender import OutputQueue
+from lucky_bot.sender.output_dispatcher import (
+    raise_api_exception, record_unavailable, telegram_is_unavailable, circuit_is_open,
+)
+from lucky_bot.sender.circuit_breaker import CIRCUIT_BREAKER
+from lucky_bot.sender.rate_limiter import RATE_LIMITER
+from lucky_bot.sender.sender import Sender, SenderThread, DELIVERED, SENDER_LATENCY, backoff
+
+import logging
+logger = logging.getLogger(__name__)
+from logs import Log
+
+
+async def send_message(bot: AsyncTeleBot, uid: str | int, text: str, markup=False):
+    """
+    The async twin of output_dispatcher.send_message, with the same exceptions.
+
+    Raises:
+        OutputDispatcherException
+        DispatcherWrongToken
+        DispatcherNoAccess
+        DispatcherTimeout
+        DispatcherUndefinedExc
+        DispatcherUnavailable
+    """
+    if not CIRCUIT_BREAKER.allow():
+        raise circuit_is_open()
+    if (delay := RATE_LIMITER.reserve(uid)) > 0:
+        await asyncio.sleep(delay)
+    try:
+        if markup:
+            await bot.send_message(uid, text, parse_mode='HTML')
+        else:
+            await bot.send_message(uid, text)
+        CIRCUIT_BREAKER.record_success()
+
+    except asyncio_helper.ApiTelegramException as aexc:
+        raise_api_exception(aexc)
+        if aexc.error_code >= 500:
+            raise telegram_is_unavailable()
+        msg = 'async dispatcher: undefined ApiTelegramException'
+        Log.warning(msg)
+        raise DispatcherUndefinedExc(msg)
+
+    except (asyncio_helper.RequestTimeout, asyncio_helper.ApiHTTPException) as exception:
+        # telebot logs the aiohttp errors and raises RequestTimeout instead
+        record_unavailable(exception)
+        raise telegram_is_unavailable()
+
+    except Exception as exception:
+        TELEGRAM_ERRORS.labels(error='exception').increment()
+        msg = 'async dispatcher: normal exception'
+        logger.exception(msg)
+        Log.error(msg)
+        raise OutputDispatcherException(exception)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking call, like a write to a queue, in the default executor of the loop,
+    so a busy SQLite lock doesn't stall the other sends.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+class AsyncSender(Sender):
+    """ The event loop and the session of the bot live until the shutdown of the sender thread. """
+    retry_at: float = None
+    loop: asyncio.AbstractEventLoop = None
+    bot: AsyncTeleBot = None
+
+    @classmethod
+    def process_outgoing_messages(cls):
+        """
+        Exceptions go through:
+            OutputDispatcherException
+            StopTheSenderGently
+            OMQException
+            IMQException
+        """
+        if cls.loop is None:
+            asyncio_helper.REQUEST_LIMIT = ASYNC_SENDER_CONCURRENCY
+            # the aiohttp client of telebot takes one total timeout per request
+            asyncio_helper.REQUEST_TIMEOUT = HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT
+            cls.loop = asyncio.new_event_loop()
+            cls.bot = AsyncTeleBot(API)
+        cls.loop.run_until_complete(cls._process_outgoing_messages())
+
+    @classmethod
+    async def _process_outgoing_messages(cls):
+        if cls.retry_at and cls.retry_at <= current_time():
+            cls.retry_at = None
+        if (retry_in := CIRCUIT_BREAKER.retry_in()) > 0:
+            cls._wake_up_in(retry_in)
+            return
+
+        semaphore = asyncio.Semaphore(ASYNC_SENDER_CONCURRENCY)
+        while True:
+            messages = OutputQueue.get_messages(ASYNC_SENDER_BATCH)
+            if not messages:
+                cls._wake_up_for_the_next_message()
+                break
+
+            chats = {}
+            for message in messages:
+                chats.setdefault(make_hash(message[1]), []).append(message)
+
+            delivered = []
+            failed = asyncio.Event()
+            try:
+                results = await asyncio.gather(
+                    *[cls._deliver_to_the_chat(chat, delivered, failed, semaphore) for chat in chats.values()],
+                    return_exceptions=True,
+                )
+            finally:
+                OutputQueue.delete_messages(delivered)
+
+            for chat, result in zip(chats, results):
+                if isinstance(result, (int, float)):
+                    cls._postpone_the_chat(chat, result)
+            for result in results:
+                if isinstance(result, DispatcherUnavailable):
+                    cls._wake_up_in(result.retry_after)
+                    return
+                elif isinstance(result, BaseException):
+                    raise result
+
+    @classmethod
+    async def _deliver_to_the_chat(cls, messages: list, delivered: list,
+                                   failed: asyncio.Event, semaphore: asyncio.Semaphore) -> float | None:
+        try:
+            for message_id, destination, message, markup, trace in messages:
+                if failed.is_set():
+                    return None
+                trace = trace and Trace.loads(trace).mark()
+                try:
+                    async with semaphore:
+                        with SENDER_LATENCY.timer():
+                            sent = await cls._handle_an_async_delivery(destination, message, markup)
+                except DispatcherTimeout as exc:
+                    return exc.retry_after
+                except DispatcherUndefinedExc:
+                    attempts = await run_blocking(OutputQueue.retry_message, message_id, drop_markup=True)
+                    if attempts < SEND_MAX_ATTEMPTS:
+                        return backoff(attempts)
+                    sent = await cls._give_up(destination)
+                except DispatcherUnavailable as exc:
+                    if exc.retry_after:
+                        raise exc
+                    return backoff(await run_blocking(OutputQueue.retry_message, message_id))
+                if sent is True:
+                    finish(trace)
+                delivered.append(message_id)
+                DELIVERED.increment()
+        except Exception as exc:
+            failed.set()
+            raise exc
+
+    @classmethod
+    async def _give_up(cls, destination) -> bool:
+        Log.warning('sender: deleting the broken message; delete the uid manually if the exception persists')
+        text = 'Undefined error while trying to send you a message :C'
+        try:
+            await send_message(cls.bot, destination, text)
+        except (DispatcherNoAccess, DispatcherTimeout, DispatcherUndefinedExc, DispatcherUnavailable) as exc:
+            Log.warning(f'sender: the notice is not sent ({type(exc).__name__})')
+        return False
+
+    @classmethod
+    async def _handle_an_async_delivery(cls, destination, message, markup=False) -> bool:
+        """
+        The async twin of Sender._handle_a_delivery.
+
+        Exceptions go through:
+            IMQException
+            DispatcherTimeout: the caller postpones the chat
+            DispatcherUndefinedExc: the caller retries the message
+            DispatcherUnavailable: the caller retries the message, or keeps all of them
+
+        Raises:
+            StopTheSenderGently
+            OutputDispatcherException: propagation
+        """
+        try:
+            await send_message(cls.bot, destination, message, markup)
+            return True
+
+        except DispatcherWrongToken:
+            Log.error('sender: stopping because of api error')
+            raise StopTheSenderGently
+
+        except DispatcherTimeout as exc:
+            Log.warning(f'sender: a chat is rate limited for {exc.retry_after} s')
+            raise exc
+
+        except DispatcherUnavailable as exc:
+            Log.warning('sender: telegram is unavailable')
+            raise exc
+
+        except DispatcherUndefinedExc as exc:
+            Log.warning('sender: an undefined error, the message will be retried')
+            raise exc
+
+        except DispatcherNoAccess:
+            Log.info('sender: deleting the inaccessible uid')
+            await run_blocking(InputQueue.add_message, f'/sender delete {destination}')
+            INCOMING_MESSAGE.set()
+
+        except (OutputDispatcherException, Exception) as exc:
+            Log.error('sender: stopping because of dispatcher exception')
+            if isinstance(exc, OutputDispatcherException):
+                raise exc
+            else:
+                raise OutputDispatcherException(exc)
+
+    @classmethod
+    def shutdown(cls):
+        if cls.loop is not None:
+            if asyncio_helper.session_manager.session is not None:
+                cls.loop.run_until_complete(cls.bot.close_session())
+            cls.loop.run_until_complete(cls.loop.shutdown_default_executor())
+            cls.loop.close()
+            cls.loop = None
+            cls.bot = None
+
+
+class AsyncSenderThread(SenderThread):
+    sender = AsyncSender()
+
+    def __str__(self):
+        return 'async sender thread'
@@ -0,0 +1,95 @@
+""" Circuit breaker in front of the output dispatcher.
+When Telegram is degraded, each message would go through its attempts and timeouts,
+while the backlog grows. The breaker counts the outcomes of the last BREAKER_WINDOW calls;
+a failure is a network error or a 5xx answer. Any other answer means Telegram is up.
+
+    closed -> open: BREAKER_FAILURE_RATE of the window failed, and at least BREAKER_MIN_CALLS
+    open -> half-open: after BREAKER_COOLDOWN, one probe call is allowed
+    half-open -> closed: the probe succeeded; -> open: the probe failed
+
+While the breaker is open the dispatcher doesn't call Telegram, and the sender keeps the messages queued.
+A lost probe doesn't block the breaker: the next one is allowed after another cooldown.
+"""
+import threading
+from collections import deque
+from time import monotonic
+
+from lucky_bot.helpers.constants import (
+    BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE, BREAKER_COOLDOWN,
+)
+from lucky_bot.helpers.metrics import Gauge
+
+import logging
+logger = logging.getLogger(__name__)
+from logs import Log
+
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+
+class CircuitBreaker:
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, cooldown=BREAKER_COOLDOWN):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)  # True - a failure
+        self._next_probe = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """ May the next call go to Telegram. In the open state, takes the probe. """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = monotonic()
+            if now < self._next_probe:
+                return False
+            if self.state == OPEN:
+                self.state = HALF_OPEN
+                Log.info('circuit breaker: half-open, a probe')
+            self._next_probe = now + self.cooldown
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._outcomes.clear()
+                Log.info('circuit breaker: closed')
+            else:
+                self._outcomes.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == CLOSED:
+                self._outcomes.append(True)
+                if len(self._outcomes) < self.min_calls \
+                        or sum(self._outcomes) / len(self._outcomes) < self.failure_rate:
+                    return
+            self.state = OPEN
+            self._next_probe = monotonic() + self.cooldown
+            Log.warning(f'circuit breaker: open for {self.cooldown} s')
+
+    def retry_in(self) -> float:
+        """ Seconds until the next call may go to Telegram, 0 if the breaker is closed. """
+        with self._lock:
+            if self.state == CLOSED:
+                return 0
+            return max(self._next_probe - monotonic(), 0)
+
+    def reset(self):
+        with self._lock:
+            self.state = CLOSED
+            self._outcomes.clear()
+            self._next_probe = 0.0
+
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
+BREAKER_STATE = Gauge(
+    'lucky_bot_circuit_breaker_state', 'The breaker of the Telegram calls: 0 - closed, 1 - open, 2 - half-open.',
+    function=lambda: CIRCUIT_BREAKER.state,
+)
@@ -1,29 +1,32 @@
 """ Telegram messaging Dispatcher.
 It sends messages to Telegram through the telebot and sorts possible exceptions.
+The calls go through the circuit breaker, see sender.circuit_breaker.
 """
-import time
-
-from telebot.apihelper import ApiTelegramException
+from requests.exceptions import RequestException
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
 
 from lucky_bot.helpers.constants import (
     TG_WRONG_TOKEN, TG_UID_NOT_FOUND,
-    TG_BOT_BLOCKED, TG_BOT_TIMEOUT,
+    TG_BOT_BLOCKED, TG_BOT_TIMEOUT, SEND_RETRY_AFTER,
 
     DispatcherWrongToken, DispatcherNoAccess, DispatcherTimeout,
-    DispatcherUndefinedExc, OutputDispatcherException,
+    DispatcherUndefinedExc, DispatcherUnavailable, OutputDispatcherException,
 )
+from lucky_bot.helpers.metrics import TELEGRAM_ERRORS
 from lucky_bot import BOT
+from lucky_bot.sender.rate_limiter import RATE_LIMITER
+from lucky_bot.sender.circuit_breaker import CIRCUIT_BREAKER
 
 import logging
 logger = logging.getLogger(__name__)
 from logs import Log
 
-MAX_ATTEMPT = 3
-
 
 def send_message(uid: str | int, text: str, markup=False, file=None):
     """
     Send a message to Telegram and handle possible exception.
+    One attempt: the sender schedules the next one in the output message queue.
+    The call to Telegram waits for the rate limiter.
 
     Raises:
         OutputDispatcherException
@@ -31,56 +34,101 @@ def send_message(uid: str | int, text: str, markup=False, file=None):
         DispatcherNoAccess
         DispatcherTimeout
         DispatcherUndefinedExc
+        DispatcherUnavailable
+    """
+    if not CIRCUIT_BREAKER.allow():
+        raise circuit_is_open()
+    RATE_LIMITER.wait(uid)
+    try:
+        if markup:
+            BOT.send_message(uid, text, parse_mode='HTML')
+        else:
+            BOT.send_message(uid, text)
+        CIRCUIT_BREAKER.record_success()
+
+    except ApiTelegramException as aexc:
+        raise_api_exception(aexc)
+        if aexc.error_code >= 500:
+            raise telegram_is_unavailable()
+        msg = 'output dispatcher: undefined ApiTelegramException'
+        Log.warning(msg)
+        raise DispatcherUndefinedExc(msg)
+
+    except (RequestException, ApiHTTPException) as exception:
+        record_unavailable(exception)
+        raise telegram_is_unavailable()
+
+    except Exception as exception:
+        TELEGRAM_ERRORS.labels(error='exception').increment()
+        msg = 'output dispatcher: normal exception'
+        logger.exception(msg)
+        Log.error(msg)
+        raise OutputDispatcherException(exception)
+
+
+def raise_api_exception(aexc: ApiTelegramException):
+    """
+    Sorts an exception from Telegram, the sync or the async one; see sender.async_sender.
+    Returns if the exception is undefined, the caller may try again.
+    An answer with a 5xx code is a failure for the circuit breaker, any other answer is a success.
+
+    Raises:
+        DispatcherWrongToken
+        DispatcherNoAccess
+        DispatcherTimeout
     """
-    attempt = 0
-    while attempt < MAX_ATTEMPT:
-        attempt += 1
-        if attempt > 1 and markup:
-            markup = False
-        try:
-            if markup:
-                BOT.send_message(uid, text, parse_mode='HTML')
-            else:
-                BOT.send_message(uid, text)
-            break
-
-        except ApiTelegramException as aexc:
-            if TG_WRONG_TOKEN.search(aexc.description):
-                msg = 'output dispatcher: wrong telegram token'
-                logger.exception(msg)
-                Log.error(msg)
-                raise DispatcherWrongToken(msg)
-
-            elif TG_UID_NOT_FOUND.search(aexc.description):
-                msg = 'output dispatcher: uid not found'
-                Log.warning(msg)
-                raise DispatcherNoAccess(msg)
-
-            elif TG_BOT_BLOCKED.search(aexc.description):
-                msg = 'output dispatcher: bot blocked'
-                Log.warning(msg)
-                raise DispatcherNoAccess(msg)
-
-            elif TG_BOT_TIMEOUT.search(aexc.description):
-                if attempt < 3:
-                    time.sleep(10)
-                    continue
-                else:
-                    msg = 'output dispatcher: telegram timeout'
-                    Log.warning(msg)
-                    raise DispatcherTimeout(msg)
-
-            else:
-                if attempt < 3:
-                    time.sleep(1)
-                    continue
-                else:
-                    msg = 'output dispatcher: undefined ApiTelegramException'
-                    Log.warning(msg)
-                    raise DispatcherUndefinedExc(msg)
-
-        except Exception as exception:
-            msg = 'output dispatcher: normal exception'
-            logger.exception(msg)
-            Log.error(msg)
-            raise OutputDispatcherException(exception)
+    TELEGRAM_ERRORS.labels(error=_error_class(aexc)).increment()
+    if aexc.error_code >= 500:
+        CIRCUIT_BREAKER.record_failure()
+    else:
+        CIRCUIT_BREAKER.record_success()
+
+    if TG_WRONG_TOKEN.search(aexc.description):
+        msg = 'output dispatcher: wrong telegram token'
+        logger.exception(msg)
+        Log.error(msg)
+        raise DispatcherWrongToken(msg)
+
+    elif TG_UID_NOT_FOUND.search(aexc.description):
+        msg = 'output dispatcher: uid not found'
+        Log.warning(msg)
+        raise DispatcherNoAccess(msg)
+
+    elif TG_BOT_BLOCKED.search(aexc.description):
+        msg = 'output dispatcher: bot blocked'
+        Log.warning(msg)
+        raise DispatcherNoAccess(msg)
+
+    elif TG_BOT_TIMEOUT.search(aexc.description):
+        # the chat waits, not the sender; see Sender
+        retry_after = (aexc.result_json.get('parameters') or {}).get('retry_after', SEND_RETRY_AFTER)
+        msg = f'output dispatcher: telegram timeout, retry after {retry_after} s'
+        Log.warning(msg)
+        raise DispatcherTimeout(msg, retry_after=retry_after)
+
+
+def record_unavailable(exception: Exception):
+    """ A network error, or an answer that is not from the Bot API. """
+    TELEGRAM_ERRORS.labels(error='unavailable').increment()
+    CIRCUIT_BREAKER.record_failure()
+    Log.warning(f'output dispatcher: telegram is unavailable, {type(exception).__name__}')
+
+
+def telegram_is_unavailable() -> DispatcherUnavailable:
+    """ retry_after is 0 while the circuit breaker is closed: the sender retries the message later. """
+    return DispatcherUnavailable('output dispatcher: telegram is unavailable',
+                                 retry_after=CIRCUIT_BREAKER.retry_in())
+
+
+def circuit_is_open() -> DispatcherUnavailable:
+    return DispatcherUnavailable('output dispatcher: the circuit breaker is open',
+                                 retry_after=CIRCUIT_BREAKER.retry_in())
+
+
+def _error_class(aexc: ApiTelegramException) -> str:
+    """ A label for the metrics, in the order of the checks above. """
+    for error, pattern in [('wrong_token', TG_WRONG_TOKEN), ('uid_not_found', TG_UID_NOT_FOUND),
+                           ('bot_blocked', TG_BOT_BLOCKED), ('timeout', TG_BOT_TIMEOUT)]:
+        if pattern.search(aexc.description):
+            return error
+    return 'undefined'
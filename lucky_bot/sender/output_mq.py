@@ -1,15 +1,23 @@
 """
 Output Message Queue.
 It saves messages from the program, for future sending to Telegram.
+A message goes to one of the lanes: interactive, scheduled or bulk.
+A batch is shared between the waiting lanes by OMQ_LANE_WEIGHTS, so the replies
+don't wait behind a broadcast, and the broadcast still moves on.
 Raises: OMQException
 """
 from time import time as current_time
 
-from sqlalchemy import create_engine, Column, Integer, BLOB, Boolean
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import Column, Index, Integer, String, BLOB, Boolean, func, or_, and_, exists
+from sqlalchemy.orm import declarative_base, sessionmaker, aliased
 
-from lucky_bot.helpers.constants import TESTING, OUTPUT_MQ_FILE, OMQException
-from lucky_bot.helpers.misc import encrypt, decrypt
+from lucky_bot.helpers.constants import (
+    TESTING, OUTPUT_MQ_FILE, OMQ_DURABILITY, INTERACTIVE, OMQ_LANE_WEIGHTS, OMQException,
+)
+from lucky_bot.helpers.misc import (
+    make_engine, migrate_schema, encrypt_many, decrypt, decrypt_many, make_hash, Counter,
+)
+from lucky_bot.helpers.metrics import Gauge
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,6 +46,13 @@ OMQBase = declarative_base()
 
 class OutgoingMessage(OMQBase):
     __tablename__ = 'messages_to_telegram'
+    __table_args__ = (
+        Index('ix_messages_to_telegram_fifo', 'date', 'id'),
+        Index('ix_messages_to_telegram_chat', 'chat'),
+        Index('ix_messages_to_telegram_lane', 'priority', 'date', 'id'),
+        Index('ix_messages_to_telegram_deliver_after', 'deliver_after'),
+        Index('ix_messages_to_telegram_lane_due', 'priority', 'deliver_after', 'date', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     destination = Column('address', BLOB, nullable=False)
@@ -45,49 +60,122 @@ class OutgoingMessage(OMQBase):
     stream = Column('file', BLOB, nullable=True, default=None)
     markup = Column('markup_text?', Boolean, nullable=False, default=False)
     time = Column('date', Integer, nullable=False)
+    trace = Column('trace', String, nullable=True, default=None)  # see helpers.tracing
+    chat = Column('chat', String, nullable=True, default=None)  # make_hash(uid), same as User.tg_id
+    next_attempt_at = Column('next_attempt_at', Integer, nullable=True, default=None)  # a postponed chat
+    attempts = Column('attempts', Integer, nullable=False, default=0, server_default='0')
+    priority = Column('priority', Integer, nullable=False, default=INTERACTIVE, server_default='0')  # the lane
+    deliver_after = Column('deliver_after', Integer, nullable=True, default=None)  # a scheduled message
 
 
-OMQ_ENGINE = create_engine(f'sqlite:///{OUTPUT_MQ_FILE}', future=True)
+def is_due(now: int):
+    """
+    The message is not scheduled later, waits for no attempt, and no earlier message to its chat waits.
+    A scheduled message doesn't hold the others to its chat, a retried one does.
+    """
+    earlier = aliased(OutgoingMessage)
+    return and_(
+        or_(OutgoingMessage.deliver_after.is_(None), OutgoingMessage.deliver_after <= now),
+        or_(OutgoingMessage.next_attempt_at.is_(None), OutgoingMessage.next_attempt_at <= now),
+        ~exists().where(
+            earlier.chat == OutgoingMessage.chat,
+            earlier.next_attempt_at > now,
+            or_(earlier.time < OutgoingMessage.time,
+                and_(earlier.time == OutgoingMessage.time, earlier.id < OutgoingMessage.id)),
+        ),
+    )
+
+
+OMQ_ENGINE = make_engine(OUTPUT_MQ_FILE, OMQ_DURABILITY)
 OMQ_SESSION = sessionmaker(bind=OMQ_ENGINE)
+# messages in the queue, kept by this process instead of a COUNT(*) per scrape
+OMQ_DEPTH = Counter()
+
+
+def share_the_batch(lanes: list, limit: int) -> list:
+    """
+    The weighted shares of the waiting lanes, the rest of the division to the heavier lanes,
+    then the spare room in the order of the lanes. The batch is never longer than the limit.
+    """
+    weights = [weight if rows else 0 for weight, rows in zip(
+        [OMQ_LANE_WEIGHTS[lane] for lane in sorted(OMQ_LANE_WEIGHTS)], lanes)]
+    if not (total := sum(weights)):
+        return lanes
+    shares = [limit * weight // total for weight in weights]
+    rest = limit - sum(shares)
+    for i in sorted(range(len(lanes)), key=lambda i: -weights[i])[:rest]:
+        if weights[i]:
+            shares[i] += 1
+    batch = [rows[:share] for rows, share in zip(lanes, shares)]
+    spare = limit - sum(len(rows) for rows in batch)
+    for i, rows in enumerate(lanes):
+        extra = rows[len(batch[i]):len(batch[i]) + max(spare, 0)]
+        batch[i] = batch[i] + extra
+        spare -= len(extra)
+    return batch
 
 
 class OutputQueue:
-    """ Wrapper for the queries to the output message queue. FIFO. """
+    """ Wrapper for the queries to the output message queue. FIFO by (time, id) in a lane. """
     @staticmethod
     @catch_exception
     def set_up():
         OMQBase.metadata.create_all(OMQ_ENGINE)
+        migrate_schema(OMQ_ENGINE, OMQBase.metadata)
+        with OMQ_SESSION() as session:
+            OMQ_DEPTH.reset(session.query(func.count(OutgoingMessage.id)).scalar())
 
     @staticmethod
     @catch_exception
     def tear_down():
         if TESTING and OUTPUT_MQ_FILE.exists():
             OMQBase.metadata.drop_all(OMQ_ENGINE)
+            OMQ_DEPTH.reset()
+
+    @staticmethod
+    def depth() -> int:
+        return OMQ_DEPTH.value
+
+    @staticmethod
+    @catch_exception
+    def oldest_message_age() -> int:
+        """ Seconds since the date of the first message, 0 if the queue is empty. A probe of the fifo index. """
+        with OMQ_SESSION() as session:
+            time = session.query(OutgoingMessage.time)\
+                .order_by(OutgoingMessage.time, OutgoingMessage.id)\
+                .limit(1)\
+                .scalar()
+        return max(int(current_time()) - time, 0) if time else 0
 
     @staticmethod
     @catch_exception
     def add_message(uid: str | int, message: str, time=None,
-                    file=None, markup=False, encrypted=False) -> True:
-        """ Cypher any data. """
+                    file=None, markup=False, encrypted=False, trace: str = None, chat: str = None,
+                    priority=INTERACTIVE, deliver_after: int = None) -> True:
+        """ Cypher any data. The chat hash is made from the uid, if not given. """
         test_func2()
         if not time:
             time = int(current_time())
 
+        if not chat:
+            chat = make_hash(decrypt(uid) if encrypted else uid)
         if not encrypted:
-            uid = encrypt(str(uid).encode())
-            message = encrypt(message.encode())
+            uid, message = encrypt_many([str(uid), message])
 
         with OMQ_SESSION.begin() as session:
             session.add(
-                OutgoingMessage(destination=uid, text=message, time=time, markup=markup)
+                OutgoingMessage(destination=uid, text=message, time=time, markup=markup,
+                                trace=trace, chat=chat, priority=priority, deliver_after=deliver_after)
             )
+        OMQ_DEPTH.increment()
         return True
 
     @staticmethod
     @catch_exception
     def get_first_message() -> tuple | None:
         """
-        Decipher and return original data, if any.
+        Decipher and return original data, if any, from the highest lane.
+        The messages to the postponed chats are skipped until their next attempt.
 
         Returns:
             tuple: (message_id, uid, text, markup)
@@ -97,14 +185,98 @@ class OutputQueue:
         test_func()
         with OMQ_SESSION() as session:
             if not (msg_obj := session.query(OutgoingMessage)
-                    .order_by(OutgoingMessage.time)
+                    .filter(is_due(int(current_time())))
+                    .order_by(OutgoingMessage.priority, OutgoingMessage.time, OutgoingMessage.id)
                     .first()):
                 return None
             else:
-                uid = decrypt(msg_obj.destination)
-                text = decrypt(msg_obj.text)
+                uid, text = decrypt_many([msg_obj.destination, msg_obj.text])
                 return msg_obj.id, uid, text, msg_obj.markup
 
+    @staticmethod
+    @catch_exception
+    def get_messages(limit: int) -> list:
+        """
+        Decipher and return up to `limit` first messages, two queries per lane.
+        Each waiting lane gets at least its share of the batch by OMQ_LANE_WEIGHTS,
+        the shares of the empty lanes go to the others, the higher lanes first.
+        The messages to the postponed chats are skipped until their next attempt,
+        so a retry neither blocks the other chats nor is overtaken in its chat.
+
+        Returns:
+            list: [(message_id, uid, text, markup, trace), ...], the higher lanes first;
+                empty if the queue is empty
+        """
+        test_func()
+        now = int(current_time())
+        with OMQ_SESSION() as session:
+            due = session.query(OutgoingMessage.id, OutgoingMessage.destination, OutgoingMessage.text,
+                                OutgoingMessage.markup, OutgoingMessage.trace, OutgoingMessage.time) \
+                .filter(is_due(now))
+            lanes = []
+            for lane in sorted(OMQ_LANE_WEIGHTS):
+                # the scheduled messages are searched by deliver_after in the index,
+                # so the ones that are not due yet are not scanned
+                rows = [
+                    row
+                    for scheduled in (OutgoingMessage.deliver_after.is_(None), OutgoingMessage.deliver_after <= now)
+                    for row in due.filter(OutgoingMessage.priority == lane, scheduled)
+                    .order_by(OutgoingMessage.time, OutgoingMessage.id)
+                    .limit(limit)
+                    .all()
+                ]
+                lanes.append(sorted(rows, key=lambda row: (row.time, row.id))[:limit])
+        rows = [row for lane in share_the_batch(lanes, limit) for row in lane]
+
+        tokens = []
+        for row in rows:
+            tokens += [row.destination, row.text]
+        plain = decrypt_many(tokens)
+
+        return [
+            (row.id, plain[2 * i], plain[2 * i + 1], row.markup, row.trace)
+            for i, row in enumerate(rows)
+        ]
+
+    @staticmethod
+    @catch_exception
+    def next_delivery_at() -> int | None:
+        """
+        The time a message that is not due yet becomes due: a scheduled one, or one to a postponed chat.
+        None if there is none.
+        """
+        now = int(current_time())
+        with OMQ_SESSION() as session:
+            times = [
+                session.query(func.min(column)).filter(column > now).scalar()
+                for column in (OutgoingMessage.deliver_after, OutgoingMessage.next_attempt_at)
+            ]
+        return min([time for time in times if time is not None], default=None)
+
+    @staticmethod
+    @catch_exception
+    def postpone_chat(chat: str, seconds: float) -> int:
+        """ All the messages to the chat wait for the next attempt. Will return the number of them. """
+        with OMQ_SESSION.begin() as session:
+            return session.query(OutgoingMessage)\
+                .filter(OutgoingMessage.chat == chat)\
+                .update({OutgoingMessage.next_attempt_at: int(current_time() + seconds)},
+                        synchronize_session=False)
+
+    @staticmethod
+    @catch_exception
+    def retry_message(msg_id: int, drop_markup=False) -> int:
+        """ Count a failed attempt to send the message. Will return the number of attempts, 0 if not found. """
+        with OMQ_SESSION.begin() as session:
+            if not (msg_obj := session.query(OutgoingMessage)
+                    .filter(OutgoingMessage.id == msg_id)
+                    .first()):
+                return 0
+            msg_obj.attempts += 1
+            if drop_markup:
+                msg_obj.markup = False
+            return msg_obj.attempts
+
     @staticmethod
     @catch_exception
     def delete_message(msg_id: int) -> bool:
@@ -114,8 +286,32 @@ class OutputQueue:
                     .first()):
                 return False
             session.delete(msg_obj)
+        OMQ_DEPTH.increment(-1)
         return True
 
+    @staticmethod
+    @catch_exception
+    def delete_messages(msg_ids: list) -> int:
+        """ Delete the messages in one transaction. Will return the number of deleted rows. """
+        if not msg_ids:
+            return 0
+        with OMQ_SESSION.begin() as session:
+            deleted = session.query(OutgoingMessage)\
+                .filter(OutgoingMessage.id.in_(msg_ids))\
+                .delete(synchronize_session=False)
+        OMQ_DEPTH.increment(-deleted)
+        return deleted
+
+
+OMQ_DEPTH_GAUGE = Gauge(
+    'lucky_bot_omq_depth', 'Messages in the output message queue.', function=OutputQueue.depth,
+)
+OMQ_AGE_GAUGE = Gauge(
+    'lucky_bot_omq_oldest_message_seconds', 'Age of the first message in the output message queue.',
+    function=OutputQueue.oldest_message_age,
+)
+
 
-if not TESTING and not OUTPUT_MQ_FILE.exists():
+if not TESTING:
+    # new file, or new columns and indexes in the old one
     OutputQueue.set_up()
@@ -0,0 +1,70 @@
+""" Rate limiter for the messages to Telegram.
+Telegram allows about 30 messages per second to all the chats, and about 1 per second to one chat;
+above that it answers "Too many requests".
+A token bucket for all the chats and one per chat. A call reserves a token in both buckets
+and waits until they are refilled, so the bursts are paced instead of being rejected.
+"""
+import threading
+from time import monotonic
+
+from lucky_bot.helpers.constants import (
+    SEND_RATE_GLOBAL, SEND_BURST_GLOBAL, SEND_RATE_PER_CHAT, SEND_BURST_PER_CHAT,
+)
+from lucky_bot.helpers.signals import EXIT_SIGNAL
+
+CHAT_BUCKETS_LIMIT = 1024  # the refilled buckets of idle chats are dropped above that
+
+
+class TokenBucket:
+    """ Not thread-safe by itself, see RateLimiter. """
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """ Takes a token, in debt if needed. Will return the seconds to wait for it. """
+        self.refill(now)
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0)
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    def __init__(self, rate=SEND_RATE_GLOBAL, burst=SEND_BURST_GLOBAL,
+                 chat_rate=SEND_RATE_PER_CHAT, chat_burst=SEND_BURST_PER_CHAT):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._bucket = TokenBucket(rate, burst, monotonic())
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, chat: str | int) -> float:
+        """ Will return the seconds to wait before a message to this chat may be sent. """
+        chat = str(chat)
+        with self._lock:
+            now = monotonic()
+            if (bucket := self._chats.get(chat)) is None:
+                if len(self._chats) >= CHAT_BUCKETS_LIMIT:
+                    self._drop_idle_chats(now)
+                bucket = self._chats[chat] = TokenBucket(self.chat_rate, self.chat_burst, now)
+            return max(bucket.reserve(now), self._bucket.reserve(now))
+
+    def wait(self, chat: str | int):
+        """ Blocks until a message to this chat may be sent, or until the EXIT_SIGNAL. """
+        if (delay := self.reserve(chat)) > 0:
+            EXIT_SIGNAL.wait(delay)
+
+    def _drop_idle_chats(self, now: float):
+        for chat in [chat for chat, bucket in self._chats.items() if bucket.is_full(now)]:
+            del self._chats[chat]
+
+
+RATE_LIMITER = RateLimiter()
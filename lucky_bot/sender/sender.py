@@ -1,52 +1,194 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import time as current_time
+
 from lucky_bot.helpers.constants import (
+    OMQ_BATCH_SIZE, SENDER_WORKERS, SEND_MAX_ATTEMPTS, SEND_BACKOFF_BASE, SEND_BACKOFF_MAX,
     SenderException, StopTheSenderGently, OMQException, IMQException,
     DispatcherWrongToken, DispatcherNoAccess, DispatcherTimeout,
-    DispatcherUndefinedExc, OutputDispatcherException,
+    DispatcherUndefinedExc, DispatcherUnavailable, OutputDispatcherException,
 )
 from lucky_bot.helpers.signals import (
     SENDER_IS_RUNNING, SENDER_IS_STOPPED,
     NEW_MESSAGE_TO_SEND, INCOMING_MESSAGE, EXIT_SIGNAL,
 )
-from lucky_bot.helpers.misc import ThreadTemplate
+from lucky_bot.helpers.misc import ThreadTemplate, make_hash
+from lucky_bot.helpers.metrics import MESSAGES, STAGE_LATENCY
+from lucky_bot.helpers.tracing import Trace, finish
 
 from lucky_bot.receiver import InputQueue
 from lucky_bot.sender import OutputQueue
 from lucky_bot.sender import output_dispatcher
+from lucky_bot.sender.circuit_breaker import CIRCUIT_BREAKER
 
 import logging
 logger = logging.getLogger(__name__)
 from logs import Log
 
+DELIVERED = MESSAGES.labels(stage='sender')
+SENDER_LATENCY = STAGE_LATENCY.labels(stage='sender')
+
+
+def backoff(attempts: int) -> float:
+    """ Seconds before the next attempt: exponential, with a jitter, so the retries of a burst spread out. """
+    delay = min(SEND_BACKOFF_BASE * 2 ** max(attempts - 1, 0), SEND_BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
 
 class Sender:
     """ Gets messages from the output message queue and passes them to the output dispatcher. """
+    retry_at: float = None  # the earliest next attempt, after the circuit breaker, or the next scheduled message
+    executor: ThreadPoolExecutor = None
 
     @classmethod
     def process_outgoing_messages(cls):
         """
+        The messages of a batch are grouped by chat; the chats are delivered in parallel
+        by SENDER_WORKERS, the messages of one chat in order.
+        The next batch waits for the whole previous one, so the order holds between the batches too.
+        A chat that gets "Too many requests" is postponed in the queue for its retry_after,
+        the other chats go on. A failed message is retried the same way, after its backoff;
+        the attempts are counted in the queue, so they survive a restart.
+        While the circuit breaker is open, all the messages stay in the queue.
+
         Exceptions go through:
             OutputDispatcherException
             StopTheSenderGently
             OMQException
             IMQException
         """
+        if cls.retry_at and cls.retry_at <= current_time():
+            cls.retry_at = None
+        if (retry_in := CIRCUIT_BREAKER.retry_in()) > 0:
+            cls._wake_up_in(retry_in)
+            return
+
         while True:
-            result = OutputQueue.get_first_message()
-            if result:
-                message_id, destination, message, markup = result
-                cls._handle_a_delivery(destination, message, markup)
-                OutputQueue.delete_message(message_id)
-            else:
+            messages = OutputQueue.get_messages(OMQ_BATCH_SIZE)
+            if not messages:
+                cls._wake_up_for_the_next_message()
                 break
 
+            chats = {}
+            for message in messages:
+                chats.setdefault(make_hash(message[1]), []).append(message)
+
+            # the delivered messages are deleted in one transaction per batch,
+            # even if a delivery in the batch raises
+            delivered = []
+            failed = threading.Event()
+            try:
+                if len(chats) == 1 or SENDER_WORKERS == 1:
+                    results = []
+                    for chat in chats.values():
+                        try:
+                            results.append(cls._deliver_to_the_chat(chat, delivered, failed))
+                        except Exception as exc:
+                            results.append(exc)
+                else:
+                    futures = [cls._get_executor().submit(cls._deliver_to_the_chat, chat, delivered, failed)
+                               for chat in chats.values()]
+                    wait(futures)
+                    results = [future.exception() or future.result() for future in futures]
+            finally:
+                OutputQueue.delete_messages(delivered)
+
+            # the chats that got a delay are postponed even if another chat raised,
+            # their attempts are already counted
+            for chat, result in zip(chats, results):
+                if isinstance(result, (int, float)):
+                    cls._postpone_the_chat(chat, result)
+            for result in results:
+                if isinstance(result, DispatcherUnavailable):
+                    cls._wake_up_in(result.retry_after)
+                    return
+                elif isinstance(result, BaseException):
+                    raise result
+
+    @classmethod
+    def _deliver_to_the_chat(cls, messages: list, delivered: list, failed: threading.Event) -> float | None:
+        """
+        Delivers the messages of one chat in order, appends the delivered ids.
+        Stops at "Too many requests" or at a failed attempt, and will return the seconds
+        the chat must wait. If a delivery to any chat raises, the others stop before their next message.
+        """
+        try:
+            for message_id, destination, message, markup, trace in messages:
+                if failed.is_set():
+                    return None
+                trace = trace and Trace.loads(trace).mark()
+                try:
+                    with SENDER_LATENCY.timer():
+                        sent = cls._handle_a_delivery(destination, message, markup)
+                except DispatcherTimeout as exc:
+                    return exc.retry_after
+                except DispatcherUndefinedExc:
+                    if (attempts := OutputQueue.retry_message(message_id, drop_markup=True)) < SEND_MAX_ATTEMPTS:
+                        return backoff(attempts)
+                    sent = cls._give_up(destination)
+                except DispatcherUnavailable as exc:
+                    if exc.retry_after:
+                        raise exc
+                    return backoff(OutputQueue.retry_message(message_id))
+                if sent is True:
+                    finish(trace)
+                delivered.append(message_id)
+                DELIVERED.increment()
+        except Exception as exc:
+            failed.set()
+            raise exc
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        if cls.executor is None:
+            cls.executor = ThreadPoolExecutor(SENDER_WORKERS, thread_name_prefix='sender')
+        return cls.executor
+
+    @classmethod
+    def shutdown(cls):
+        if cls.executor is not None:
+            cls.executor.shutdown(wait=True)
+            cls.executor = None
+
+    @classmethod
+    def _postpone_the_chat(cls, chat: str, seconds: float):
+        OutputQueue.postpone_chat(chat, seconds)
+        cls._wake_up_in(seconds)
+
+    @classmethod
+    def _wake_up_for_the_next_message(cls):
+        if next_delivery_at := OutputQueue.next_delivery_at():
+            cls._wake_up_in(next_delivery_at - current_time())
+
+    @classmethod
+    def _wake_up_in(cls, seconds: float):
+        retry_at = current_time() + seconds
+        cls.retry_at = min(cls.retry_at, retry_at) if cls.retry_at else retry_at
+
     @staticmethod
-    def _handle_a_delivery(destination, message, markup=False):
+    def _give_up(destination) -> bool:
+        """ The last attempt failed: the message is deleted, the user gets a notice. """
+        Log.warning('sender: deleting the broken message; delete the uid manually if the exception persists')
+        text = 'Undefined error while trying to send you a message :C'
+        try:
+            output_dispatcher.send_message(destination, text)
+        except (DispatcherNoAccess, DispatcherTimeout, DispatcherUndefinedExc, DispatcherUnavailable) as exc:
+            Log.warning(f'sender: the notice is not sent ({type(exc).__name__})')
+        return False
+
+    @staticmethod
+    def _handle_a_delivery(destination, message, markup=False) -> bool:
         """
         Calls the dispatcher and handles its exceptions.
         Sends /delete commands to the input message queue.
+        Will return True if the message is delivered.
 
         Exceptions go through:
             IMQException
+            DispatcherTimeout: the caller postpones the chat
+            DispatcherUndefinedExc: the caller retries the message
+            DispatcherUnavailable: the caller retries the message, or keeps all of them
 
         Raises:
             StopTheSenderGently
@@ -54,25 +196,29 @@ class Sender:
         """
         try:
             output_dispatcher.send_message(destination, message, markup)
+            return True
 
         except DispatcherWrongToken:
             Log.error('sender: stopping because of api error')
             raise StopTheSenderGently
 
-        except DispatcherTimeout:
-            Log.warning('sender: stopping because of tg timeout')
-            raise StopTheSenderGently
+        except DispatcherTimeout as exc:
+            Log.warning(f'sender: a chat is rate limited for {exc.retry_after} s')
+            raise exc
+
+        except DispatcherUnavailable as exc:
+            Log.warning('sender: telegram is unavailable')
+            raise exc
+
+        except DispatcherUndefinedExc as exc:
+            Log.warning('sender: an undefined error, the message will be retried')
+            raise exc
 
         except DispatcherNoAccess:
             Log.info('sender: deleting the inaccessible uid')
             InputQueue.add_message(f'/sender delete {destination}')
             INCOMING_MESSAGE.set()
 
-        except DispatcherUndefinedExc:
-            Log.warning('sender: deleting the broken message; delete the uid manually if the exception persists')
-            text = 'Undefined error while trying to send you a message :C'
-            output_dispatcher.send_message(destination, text)
-
         except (OutputDispatcherException, Exception) as exc:
             Log.error('sender: stopping because of dispatcher exception')
             if isinstance(exc, OutputDispatcherException):
@@ -93,10 +239,11 @@ class SenderThread(ThreadTemplate):
     def body(self):
         """
         Description:
-            0. Dispatch any messages;
-            1. Clear NEW_MESSAGE_TO_SEND signal, if set;
+            0. Clear NEW_MESSAGE_TO_SEND signal, if set;
+            1. Dispatch any messages;
             2. Set the SENDER_IS_RUNNING signal;
-            3. Loop and wait for the NEW_MESSAGE_TO_SEND signal.
+            3. Loop and wait for the NEW_MESSAGE_TO_SEND signal,
+               or for the next attempt of a postponed chat, a scheduled message, or the circuit breaker.
 
             To break the sender from the loop and stop its work,
             the NEW_MESSAGE_TO_SEND signal must be set after the EXIT_SIGNAL.
@@ -111,14 +258,15 @@ class SenderThread(ThreadTemplate):
             self.work_before_the_loop()
 
             while True:
-                if NEW_MESSAGE_TO_SEND.wait(3600):
+                if NEW_MESSAGE_TO_SEND.wait(self._time_to_wait()):
                     pass
 
                 if EXIT_SIGNAL.is_set():
                     break
                 else:
-                    self.sender.process_outgoing_messages()
+                    # cleared before the processing, so a message that arrives during it keeps its signal
                     NEW_MESSAGE_TO_SEND.clear()
+                    self.sender.process_outgoing_messages()
                     self._test_sender_cycle()
 
         except StopTheSenderGently:
@@ -128,13 +276,21 @@ class SenderThread(ThreadTemplate):
         except Exception as exc:
             Log.error('sender: a normal exception')
             raise SenderException(exc)
+        finally:
+            self.sender.shutdown()
 
     def work_before_the_loop(self):
-        self.sender.process_outgoing_messages()
         NEW_MESSAGE_TO_SEND.clear()
+        self.sender.process_outgoing_messages()
         self._set_the_signal()
         self._test_exception_after_signal()
 
+    def _time_to_wait(self) -> float:
+        """ Until the next message or the next attempt. """
+        if self.sender.retry_at:
+            return max(self.sender.retry_at - current_time(), 0)
+        return 3600
+
     @staticmethod
     def _test_sender_cycle():
         pass
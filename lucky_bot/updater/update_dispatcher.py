@@ -7,7 +7,11 @@ Exceptions go through:
     OMQException
 """
 import random
+import zlib
+from time import time
 
+from lucky_bot.helpers.constants import SCHEDULED, UPDATER_SPREAD_WINDOW
+from lucky_bot.helpers.signals import NEW_MESSAGE_TO_SEND
 from lucky_bot.sender import OutputQueue
 from lucky_bot import MainDB
 
@@ -31,12 +35,15 @@ def notifications_dispatcher(current_time):
     0. Take all the users that have at least 1 note;
     1. Check that the user hasn't yet received a message for the current time;
     3. Get user's notifications for the updater and select one random message;
-    4. Pass this message to the output message queue;
+    4. Pass this message to the output message queue, scheduled within the spread window;
     5. Set the user flag for the current time period.
     """
     if not (users := MainDB.get_users_with_notes()):
         return
 
+    round_start = int(time())
+    sent = False
+
     for user in users:
         if not is_waiting_for_update(user, current_time):
             continue
@@ -48,9 +55,21 @@ def notifications_dispatcher(current_time):
         else:
             note = random.choice(notes)
 
-        OutputQueue.add_message(user.c_id, note.text, markup=True, encrypted=True)
+        OutputQueue.add_message(user.c_id, note.text, markup=True, encrypted=True, chat=user.tg_id,
+                                priority=SCHEDULED, deliver_after=round_start + spread_offset(user.tg_id))
         MainDB.update_user_last_notes_list(user.tg_id, note.number)
         set_update_flag(user.tg_id, current_time)
+        sent = True
+
+    if sent:
+        NEW_MESSAGE_TO_SEND.set()
+
+
+def spread_offset(tg_id: str) -> int:
+    """ Seconds after the round start, the same for a user in every round. """
+    if not UPDATER_SPREAD_WINDOW:
+        return 0
+    return zlib.crc32(str(tg_id).encode()) % UPDATER_SPREAD_WINDOW
 
 
 def is_waiting_for_update(user, current_time):
@@ -1,4 +1,5 @@
 from datetime import datetime, timezone
+from time import perf_counter
 
 from lucky_bot.helpers.constants import (
     UpdaterException, DatabaseException,
@@ -13,6 +14,7 @@ from lucky_bot.helpers.signals import (
     UPDATER_CYCLE, EXIT_SIGNAL,
 )
 from lucky_bot.helpers.misc import ThreadTemplate
+from lucky_bot.helpers.metrics import UPDATER_ROUND
 from lucky_bot.updater import update_dispatcher
 
 import logging
@@ -33,9 +35,11 @@ class Updater:
         """
         Log.info('updater works')
         current_time = cls._get_current_time()
+        start = perf_counter()
         try:
             update_dispatcher.clear_all_users_flags(current_time)
             update_dispatcher.send_messages(current_time)
+            UPDATER_ROUND.set(perf_counter() - start)
 
         except (DatabaseException, OMQException) as exc:
             raise exc
@@ -4,18 +4,17 @@ import threading
 
 from lucky_bot.helpers.constants import (
     MainException, TREAD_RUNNING_TIMEOUT,
-    ERRORS_TOTAL, TESTING,
+    CONTROLLER_WORKERS, RECEIVER_MODE, SENDER_MODE, ERRORS_TOTAL, TESTING,
 )
 from lucky_bot.helpers.signals import (
-    RECEIVER_IS_RUNNING, CONTROLLER_IS_RUNNING,
-    UPDATER_IS_RUNNING, SENDER_IS_RUNNING,
+    RECEIVER_IS_RUNNING, UPDATER_IS_RUNNING, SENDER_IS_RUNNING,
     ALL_THREADS_ARE_GO, ALL_DONE_SIGNAL, EXIT_SIGNAL,
     exit_signal,
 )
-from lucky_bot.sender import SenderThread
+from lucky_bot.sender import SenderThread, AsyncSenderThread
 from lucky_bot.updater import UpdaterThread
 from lucky_bot.controller import ControllerThread
-from lucky_bot.receiver import ReceiverThread
+from lucky_bot.receiver import ReceiverThread, PollingReceiverThread
 
 import logging
 logger = logging.getLogger(__name__)
@@ -51,15 +50,15 @@ def main():
     Log.info('[>>> START >>>', console=False)
 
     # instantiate threads;
-    sender = SenderThread()
+    sender = AsyncSenderThread() if SENDER_MODE == 'async' else SenderThread()
     updater = UpdaterThread()
-    controller = ControllerThread()
-    receiver = ReceiverThread()
+    controllers = [ControllerThread(worker) for worker in range(CONTROLLER_WORKERS)]
+    receiver = PollingReceiverThread() if RECEIVER_MODE == 'polling' else ReceiverThread()
 
     threads = [
         {'thread': sender, 'running': SENDER_IS_RUNNING},
         {'thread': updater, 'running': UPDATER_IS_RUNNING},
-        {'thread': controller, 'running': CONTROLLER_IS_RUNNING},
+        *[{'thread': controller, 'running': controller.is_running_signal} for controller in controllers],
         {'thread': receiver, 'running': RECEIVER_IS_RUNNING},
     ]
 
@@ -0,0 +1,58 @@
+"""
+Per-message crypto cost, before and after the shared cipher.
+This benchmark must be run by hands.
+python tests/benchmarks/bench_crypto.py
+"""
+import sys
+
+if __name__ != '__main__':
+    print('Run bench_crypto.py as main.')
+    sys.exit(1)
+
+import pathlib
+import timeit
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(BASE_DIR))
+
+from cryptography.fernet import Fernet
+
+from lucky_bot.helpers.constants import ENCRYPTION_KEY
+from lucky_bot.helpers.misc import encrypt, decrypt, encrypt_many, decrypt_many
+
+NUMBER = 20_000
+UID = '1234567890'
+TEXT = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.'
+
+
+def old_encrypt(data) -> bytes:
+    if not isinstance(data, bytes):
+        data = str(data).encode()
+    return Fernet(ENCRYPTION_KEY).encrypt(data)
+
+def old_decrypt(token) -> str:
+    return Fernet(ENCRYPTION_KEY).decrypt(token).decode('utf-8')
+
+
+def report(name, seconds, messages=NUMBER):
+    print(f'{name:<40} {seconds / messages * 1e6:8.2f} us/message')
+
+
+token = encrypt(TEXT)
+tokens = [token] * NUMBER
+texts = [TEXT] * NUMBER
+
+print(f'{NUMBER} messages\n')
+report('encrypt, new Fernet() per call', timeit.timeit(lambda: old_encrypt(TEXT), number=NUMBER))
+report('encrypt, shared cipher', timeit.timeit(lambda: encrypt(TEXT), number=NUMBER))
+report('encrypt_many', timeit.timeit(lambda: encrypt_many(texts), number=1))
+print()
+report('decrypt, new Fernet() per call', timeit.timeit(lambda: old_decrypt(token), number=NUMBER))
+report('decrypt, shared cipher', timeit.timeit(lambda: decrypt(token), number=NUMBER))
+report('decrypt_many', timeit.timeit(lambda: decrypt_many(tokens), number=1))
+print()
+# an OMQ row: uid and text
+report('omq row, new Fernet() per field',
+       timeit.timeit(lambda: (old_encrypt(UID), old_encrypt(TEXT)), number=NUMBER))
+report('omq row, encrypt_many',
+       timeit.timeit(lambda: encrypt_many([UID, TEXT]), number=NUMBER))
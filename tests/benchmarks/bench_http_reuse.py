@@ -0,0 +1,128 @@
+"""
+Sends per second to a local fake Bot API over TLS, through BOT.send_message,
+with a new connection per call and with the pooled keep-alive session, 1 and 8 threads.
+The certificate is self-signed for 127.0.0.1; the handshake is what the reuse saves.
+This benchmark must be run by hands.
+python tests/benchmarks/bench_http_reuse.py
+"""
+import sys
+
+if __name__ != '__main__':
+    print('Run bench_http_reuse.py as main.')
+    sys.exit(1)
+
+import os
+import ssl
+import json
+import pathlib
+import datetime
+import tempfile
+import ipaddress
+import threading
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(BASE_DIR))
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from telebot import apihelper
+
+from lucky_bot.helpers.metrics import HTTP_REQUESTS, HTTP_CONNECTIONS
+from lucky_bot.helpers.http_session import HTTP_SESSION
+from lucky_bot import BOT
+
+THREADS = [1, 8]
+SENDS_PER_THREAD = 200
+os.environ['no_proxy'] = '127.0.0.1,localhost'
+
+MESSAGE = json.dumps({'ok': True, 'result': {
+    'message_id': 1, 'date': 0, 'chat': {'id': 42, 'type': 'private'}, 'text': 'hello',
+}}).encode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # the headers and the body go in two writes
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(MESSAGE)))
+        self.end_headers()
+        self.wfile.write(MESSAGE)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def self_signed_certificate(directory) -> tuple[str, str]:
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder()\
+        .subject_name(name).issuer_name(name).public_key(key.public_key())\
+        .serial_number(x509.random_serial_number())\
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))\
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), False)\
+        .sign(key, hashes.SHA256())
+    cert_file, key_file = pathlib.Path(directory, 'cert.pem'), pathlib.Path(directory, 'key.pem')
+    cert_file.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_file.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return str(cert_file), str(key_file)
+
+
+def sends(_) -> None:
+    for _ in range(SENDS_PER_THREAD):
+        BOT.send_message(42, 'hello')
+
+
+def load(threads) -> float:
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(sends, range(threads)))
+    return threads * SENDS_PER_THREAD / (perf_counter() - start)
+
+
+with tempfile.TemporaryDirectory() as directory:
+    cert_file, key_file = self_signed_certificate(directory)
+    os.environ['REQUESTS_CA_BUNDLE'] = cert_file
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1})
+    thread.start()
+    apihelper.API_URL = f'https://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}'
+
+    modes = {
+        # telebot without a session: a one-time requests.Session per call
+        'new connection': lambda: (setattr(apihelper, 'CUSTOM_REQUEST_SENDER', None),
+                                   setattr(apihelper, 'SESSION_TIME_TO_LIVE', 0)),
+        'pooled session': lambda: setattr(apihelper, 'CUSTOM_REQUEST_SENDER', HTTP_SESSION.request),
+    }
+    try:
+        for name, set_mode in modes.items():
+            set_mode()
+            for threads in THREADS:
+                requests, connections = HTTP_REQUESTS.value, HTTP_CONNECTIONS.value
+                rate = load(threads)
+                reused = ''
+                if apihelper.CUSTOM_REQUEST_SENDER:
+                    requests, connections = HTTP_REQUESTS.value - requests, HTTP_CONNECTIONS.value - connections
+                    reused = f'  {requests - connections} of {requests} requests reused a connection'
+                print(f'{name:<16} {threads:>2} threads  {rate:8.1f} sends/s{reused}')
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
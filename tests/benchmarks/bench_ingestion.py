@@ -0,0 +1,56 @@
+"""
+CPU time of the webhook ingestion per request, before and after the single-parse path:
+before - decode, Update.de_json() for validation, json.loads() for the date, encode, encrypt;
+after - one json.loads() with a schema check, the raw bytes are encrypted.
+The database is not involved.
+This benchmark must be run by hands.
+python tests/benchmarks/bench_ingestion.py
+"""
+import sys
+
+if __name__ != '__main__':
+    print('Run bench_ingestion.py as main.')
+    sys.exit(1)
+
+import json
+import pathlib
+from time import process_time
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(BASE_DIR))
+
+import telebot
+
+from lucky_bot.helpers.constants import PROJECT_DIR
+from lucky_bot.helpers.misc import encrypt
+from lucky_bot.receiver.flask_config import parse_update
+
+REQUESTS = 20_000
+
+with open(PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json', 'rb') as f:
+    RAW = f.read().strip()
+
+
+def before(raw: bytes):
+    data = raw.decode('utf-8')
+    telebot.types.Update.de_json(data)
+    d = json.loads(data)
+    time, update_id = d['message']['date'], d.get('update_id')
+    return encrypt(data.encode()), time, update_id
+
+
+def after(raw: bytes):
+    update = parse_update(raw)
+    return encrypt(raw), update['message']['date'], update['update_id']
+
+
+def measure(func) -> float:
+    start = process_time()
+    for _ in range(REQUESTS):
+        func(RAW)
+    return (process_time() - start) / REQUESTS
+
+
+old, new = measure(before), measure(after)
+print(f'before {old * 1e6:8.1f} us/request')
+print(f'after  {new * 1e6:8.1f} us/request  ({old / new:.1f}x)')
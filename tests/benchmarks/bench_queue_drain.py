@@ -0,0 +1,78 @@
+"""
+Drain a backlog of 100k messages from the input message queue,
+with and without the (time, id) index, one by one and in batches.
+This benchmark must be run by hands.
+python tests/benchmarks/bench_queue_drain.py
+"""
+import sys
+
+if __name__ != '__main__':
+    print('Run bench_queue_drain.py as main.')
+    sys.exit(1)
+
+import pathlib
+from time import perf_counter
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(BASE_DIR))
+
+from sqlalchemy import text
+
+from lucky_bot.helpers.constants import IMQ_BATCH_SIZE
+from lucky_bot.helpers.misc import encrypt
+from lucky_bot.receiver import InputQueue
+from lucky_bot.receiver.input_mq import IMQ_ENGINE, IncomingMessage
+
+BACKLOG = 100_000
+SAMPLE = 500  # without the index every dequeue is a full scan, so only a sample is drained
+
+
+def fill_the_queue():
+    token = encrypt('{"update_id": 1, "message": {"date": 1, "text": "hello"}}')
+    rows = [{'message_body': token, 'message_date': 1_600_000_000 + i // 10}
+            for i in range(BACKLOG)]
+    with IMQ_ENGINE.begin() as conn:
+        conn.execute(IncomingMessage.__table__.insert(), rows)
+
+
+def drain(limit=None) -> tuple[int, float]:
+    count = 0
+    start = perf_counter()
+    while limit is None or count < limit:
+        if not (result := InputQueue.get_first_message()):
+            break
+        InputQueue.delete_message(result[0])
+        count += 1
+    return count, perf_counter() - start
+
+
+def drain_in_batches() -> tuple[int, float]:
+    count = 0
+    start = perf_counter()
+    while messages := InputQueue.get_messages(IMQ_BATCH_SIZE):
+        count += InputQueue.delete_messages([id_ for id_, data in messages])
+    return count, perf_counter() - start
+
+
+def report(name, count, seconds):
+    print(f'{name:<28} {count:>7} messages {seconds:8.2f} s '
+          f'{seconds / count * 1e3:8.3f} ms/message')
+
+
+try:
+    InputQueue.set_up()
+    fill_the_queue()
+
+    with IMQ_ENGINE.begin() as conn:
+        conn.execute(text('DROP INDEX ix_incoming_messages_fifo'))
+    count, seconds = drain(SAMPLE)
+    report('no index, sample', count, seconds)
+    print(f'{"no index, full drain":<28} ~{seconds / count * BACKLOG / 2:.0f} s (extrapolated, O(n^2))')
+
+    InputQueue.set_up()  # the migration brings the index back
+    count, seconds = drain(SAMPLE)
+    report('index, sample', count, seconds)
+    count, seconds = drain_in_batches()
+    report(f'index, batches of {IMQ_BATCH_SIZE}', count, seconds)
+finally:
+    InputQueue.tear_down()
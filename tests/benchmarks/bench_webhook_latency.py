@@ -0,0 +1,91 @@
+"""
+Webhook latency under load: 10, 50 and 100 concurrent senders,
+one request at a time against the pool of WEBHOOK_THREADS, with and without the group commit.
+Every request is saved to the input message queue.
+This benchmark must be run by hands.
+python tests/benchmarks/bench_webhook_latency.py
+"""
+import sys
+
+if __name__ != '__main__':
+    print('Run bench_webhook_latency.py as main.')
+    sys.exit(1)
+
+import os
+import json
+import pathlib
+import threading
+from time import perf_counter
+from statistics import quantiles
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent
+sys.path.append(str(BASE_DIR))
+
+import requests
+from werkzeug.serving import make_server
+
+from lucky_bot.helpers.constants import PROJECT_DIR, WEBHOOK_SECRET, WEBHOOK_ENDPOINT, WEBHOOK_THREADS
+from lucky_bot.receiver import InputQueue, FLASK_APP
+from lucky_bot.receiver import flask_config
+from lucky_bot.receiver.receiver import PooledWSGIServer
+
+SENDERS = [10, 50, 100]
+REQUESTS_PER_SENDER = 20
+os.environ['no_proxy'] = '127.0.0.1,localhost'
+
+with open(PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json') as f:
+    UPDATE = json.loads(f.read())
+
+HEADERS = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+update_ids = iter(range(1, 10**9))
+update_ids_lock = threading.Lock()
+
+
+def sender(url) -> list[float]:
+    latencies = []
+    with requests.Session() as session:
+        for _ in range(REQUESTS_PER_SENDER):
+            with update_ids_lock:
+                UPDATE['update_id'] = next(update_ids)
+                data = json.dumps(UPDATE).encode()
+            start = perf_counter()
+            response = session.post(url, headers=HEADERS, data=data)
+            latencies.append(perf_counter() - start)
+            assert response.status_code == 200, response.status_code
+    return latencies
+
+
+def load(server, senders) -> list[float]:
+    url = f'http://127.0.0.1:{server.port}{WEBHOOK_ENDPOINT}'
+    with ThreadPoolExecutor(senders) as executor:
+        results = executor.map(sender, [url] * senders)
+    return [latency for latencies in results for latency in latencies]
+
+
+def report(name, senders, latencies):
+    p = quantiles(latencies, n=100)
+    print(f'{name:<20} {senders:>4} senders  p50 {p[49] * 1e3:8.2f} ms  p99 {p[98] * 1e3:8.2f} ms')
+
+
+InputQueue.set_up()
+servers = {
+    'one at a time': (lambda: make_server('127.0.0.1', 0, FLASK_APP, threaded=False), False),
+    f'pool of {WEBHOOK_THREADS}': (lambda: PooledWSGIServer('127.0.0.1', 0, FLASK_APP, WEBHOOK_THREADS), False),
+    'pool, group commit': (lambda: PooledWSGIServer('127.0.0.1', 0, FLASK_APP, WEBHOOK_THREADS), True),
+}
+try:
+    for name, (make, group_commit) in servers.items():
+        flask_config.WEBHOOK_GROUP_COMMIT = group_commit
+        server = make()
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1})
+        thread.start()
+        try:
+            for senders in SENDERS:
+                report(name, senders, load(server, senders))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+finally:
+    InputQueue.tear_down()
@@ -1,4 +1,5 @@
 """ python -m unittest tests.integration.controller.test_controller_int """
+import json
 from time import sleep
 from unittest.mock import patch
 
@@ -7,6 +8,8 @@ from lucky_bot.helpers.signals import (
     CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED,
     INCOMING_MESSAGE, NEW_MESSAGE_TO_SEND, EXIT_SIGNAL,
 )
+from lucky_bot.helpers.records import pack_update
+from lucky_bot.helpers.tracing import Trace, forward
 from lucky_bot import MainDB
 from lucky_bot.receiver import InputQueue
 from lucky_bot.sender import OutputQueue
@@ -42,6 +45,25 @@ class TestControllerWorks(ThreadSmallTestTemplate):
         InputQueue.tear_down()
         MainDB.tear_down()
 
+    def test_controller_compact_record(self, controller_cycle):
+        trace = Trace.start()
+        InputQueue.add_message(pack_update(json.loads(self.telegram_start)), trace=forward(trace))
+        self.thread_obj.start()
+        if not NEW_MESSAGE_TO_SEND.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to put the message in the OMQ has passed.')
+
+        self.assertIsNotNone(MainDB.get_user(self.uid))
+        msg_id, uid, text, markup = OutputQueue.get_first_message()
+        self.assertEqual(uid, str(self.uid))
+        self.assertIn('@john_doe', text)
+
+        reply_trace = Trace.loads(OutputQueue.get_messages(1)[0][4])
+        self.assertEqual(reply_trace.trace_id, trace.trace_id, msg='the reply carries the trace')
+        self.assertEqual(len(reply_trace.marks), 4, msg='received, imq, controller, omq')
+        self.assertEqual(list(reply_trace.durations()), ['receiver', 'imq', 'controller'])
+        self.thread_obj.merge()
+
     def test_controller_cmd_start(self, controller_cycle):
         InputQueue.add_message(self.telegram_start)
         INCOMING_MESSAGE.set()
@@ -1,8 +1,9 @@
 """ python -m unittest tests.integration.controller.test_controller_with_imq """
+import threading
 from unittest.mock import patch
 from time import sleep
 
-from lucky_bot.helpers.constants import TestException, IMQException, PROJECT_DIR
+from lucky_bot.helpers.constants import TestException, IMQException, PROJECT_DIR, IMQ_MAX_ATTEMPTS
 from lucky_bot.helpers.signals import (
     CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED,
     INCOMING_MESSAGE, EXIT_SIGNAL,
@@ -47,6 +48,52 @@ class TestControllerWithMessageQueue(ThreadSmallTestTemplate):
         self.assertEqual(process_the_message.call_count, 3)
         self.assertIsNone(InputQueue.get_first_message())
 
+    @patch('lucky_bot.controller.controller.IMQ_BATCH_SIZE', 5)
+    @patch('lucky_bot.controller.controller.Controller._process_the_message')
+    def test_controllers_share_the_queue(self, process_the_message, *args):
+        messages = [f'message {i}' for i in range(200)]
+        for message in messages:
+            InputQueue.add_message(message, time=1)
+
+        processed = []
+        process_the_message.side_effect = lambda data: processed.append(data) or sleep(0.001)
+
+        workers = [
+            threading.Thread(target=Controller.check_new_messages, args=(f'worker-{i}',))
+            for i in range(4)
+        ]
+        [worker.start() for worker in workers]
+        [worker.join(30) for worker in workers]
+
+        self.assertEqual(sorted(processed), sorted(messages), msg='each message exactly once')
+        self.assertIsNone(InputQueue.get_first_message())
+
+    @patch('lucky_bot.controller.controller.Controller._process_the_message')
+    def test_controller_crash_leaves_the_batch_to_others(self, process_the_message, *args):
+        InputQueue.add_message('foo', time=1)
+        InputQueue.add_message('bar', time=2)
+        InputQueue.add_message('baz', time=3)
+        process_the_message.side_effect = [None, TestException('boom')]
+
+        self.assertRaises(TestException, Controller.check_new_messages, 'worker-1')
+        self.assertEqual(
+            [msg[1] for msg in InputQueue.claim_messages('worker-2', 10)],
+            ['bar', 'baz'],
+        )
+
+    def test_controller_quarantines_a_poison_message(self, respond, bot, *args):
+        InputQueue.add_message('/sender delete 42', time=1)
+        InputQueue.add_message(self.telegram_request, time=2)
+        InputQueue.add_message('/sender delete 404', time=3)
+        bot.process_new_updates.side_effect = TestException('boom')
+
+        Controller.check_new_messages('worker-1')
+
+        self.assertEqual(bot.process_new_updates.call_count, IMQ_MAX_ATTEMPTS)
+        self.assertEqual(respond.delete_user.call_count, 2)
+        self.assertIsNone(InputQueue.get_first_message())
+        self.assertEqual(len(InputQueue.get_dead_letters()), 1)
+
     def test_controller_normal_messages(self, respond, bot, controller_cycle):
         InputQueue.add_message('/sender delete 42', time=1)
         InputQueue.add_message(self.telegram_request, time=2)
@@ -1,16 +1,20 @@
 """ python -m unittest tests.integration.receiver.test_flask_with_imq """
+import json
 import unittest
+from unittest.mock import patch
 
 from lucky_bot.helpers.constants import PROJECT_DIR, WEBHOOK_SECRET, WEBHOOK_ENDPOINT
 from lucky_bot.helpers.signals import EXIT_SIGNAL, INCOMING_MESSAGE
+from lucky_bot.helpers.records import pack_update
 from lucky_bot.receiver import InputQueue
 from lucky_bot.receiver import FLASK_APP
+from lucky_bot.receiver.flask_config import DUPLICATE_UPDATES
 
 
 class TestFlaskWithMessageQueue(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json'
+        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_list.json'
         with open(fixture) as f:
             cls.telegram_request = f.read().strip()
 
@@ -36,7 +40,50 @@ class TestFlaskWithMessageQueue(unittest.TestCase):
 
         result = InputQueue.get_first_message()
         self.assertIsNotNone(result)
-        self.assertEqual(result[1], self.telegram_request)
+        self.assertEqual(result[1], pack_update(json.loads(self.telegram_request)))
 
         InputQueue.delete_message(result[0])
         self.assertIsNone(InputQueue.get_first_message())
+
+    def test_flask_with_imq_duplicate_update(self):
+        duplicates = DUPLICATE_UPDATES.value
+        for _ in range(2):
+            response = self.client.post(
+                WEBHOOK_ENDPOINT,
+                headers={'Content-Type': 'application/json',
+                         'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+                data=self.telegram_request.encode(),
+            )
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(len(InputQueue.get_messages(10)), 1)
+        self.assertEqual(DUPLICATE_UPDATES.value, duplicates + 1)
+
+    def test_flask_with_imq_duplicate_fast_reply(self):
+        update = json.loads(self.telegram_request)
+        update['message']['text'] = '/ping'
+        responses = [
+            self.client.post(
+                WEBHOOK_ENDPOINT,
+                headers={'Content-Type': 'application/json',
+                         'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+                data=json.dumps(update),
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual(responses[0].json['text'], 'pong')
+        self.assertEqual(responses[1].status_code, 200)
+        self.assertEqual(responses[1].data, b'', msg='the redelivered update is answered once')
+        self.assertIsNone(InputQueue.get_first_message())
+
+    @patch('lucky_bot.receiver.flask_config.WEBHOOK_GROUP_COMMIT', True)
+    def test_flask_with_imq_group_commit(self):
+        response = self.client.post(
+            WEBHOOK_ENDPOINT,
+            headers={'Content-Type': 'application/json',
+                     'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+            data=self.telegram_request.encode(),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(InputQueue.get_first_message(), msg='committed before 200')
+        self.assertTrue(INCOMING_MESSAGE.is_set())
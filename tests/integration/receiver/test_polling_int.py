@@ -0,0 +1,188 @@
+""" python -m unittest tests.integration.receiver.test_polling_int """
+import json
+import threading
+from time import sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from unittest.mock import patch
+
+from telebot import apihelper
+
+from lucky_bot.helpers.constants import TestException, ReceiverException, PROJECT_DIR
+from lucky_bot.helpers.signals import (
+    RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED, INCOMING_MESSAGE, EXIT_SIGNAL,
+)
+from lucky_bot.helpers.records import unpack_record
+from lucky_bot.receiver import InputQueue
+from lucky_bot.receiver import PollingReceiverThread
+from lucky_bot.receiver.polling import Poller
+
+from tests.presets import ThreadSmallTestTemplate
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """ A local Bot API: getUpdates serves self.updates by the offset, or self.errors first;
+    other methods return True. """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            method = url.path.rsplit('/', 1)[-1]
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            self.server.calls.append((method, params))
+
+            if method == 'getUpdates' and self.server.errors:
+                code, body = 500, {'ok': False, 'error_code': 500, 'description': self.server.errors.pop()}
+            elif method == 'getUpdates':
+                offset = int(params.get('offset', 0))
+                limit = int(params.get('limit', 100))
+                result = [u for u in self.server.updates if u['update_id'] >= offset][:limit]
+                if not result:
+                    sleep(0.05)  # a short long poll
+                code, body = 200, {'ok': True, 'result': result}
+            else:
+                code, body = 200, {'ok': True, 'result': True}
+
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_POST = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.updates = []
+        self.calls = []
+        self.errors = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.1})
+
+    def getUpdates_offsets(self) -> list:
+        return [params.get('offset') for method, params in self.calls if method == 'getUpdates']
+
+
+class TestPollingReceiver(ThreadSmallTestTemplate):
+    thread_class = PollingReceiverThread
+    is_running_signal = RECEIVER_IS_RUNNING
+    is_stopped_signal = RECEIVER_IS_STOPPED
+
+    @classmethod
+    def setUpClass(cls):
+        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json'
+        with open(fixture) as f:
+            cls.update = json.loads(f.read())
+
+        cls.api = FakeBotAPI()
+        cls.api.thread.start()
+        cls.api_url = apihelper.API_URL
+        apihelper.API_URL = f'http://127.0.0.1:{cls.api.server_port}/bot{{0}}/{{1}}'
+
+    @classmethod
+    def tearDownClass(cls):
+        apihelper.API_URL = cls.api_url
+        cls.api.shutdown()
+        cls.api.server_close()
+
+    def setUp(self):
+        InputQueue.set_up()
+        self.api.updates = [dict(self.update, update_id=i) for i in range(100, 250)]
+        self.api.calls.clear()
+        self.api.errors.clear()
+        PollingReceiverThread.poller = Poller()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        InputQueue.tear_down()
+
+    def _wait_for_the_queue(self, count):
+        for _ in range(100):
+            if len(InputQueue.get_messages(1000)) >= count:
+                return
+            sleep(0.05)
+        self.thread_obj.merge()
+        raise TestException('The time to fill the queue has passed.')
+
+    def test_polling_receiver_integration(self):
+        self.thread_obj.start()
+        if not RECEIVER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the receiver has passed.')
+
+        self._wait_for_the_queue(150)
+        for _ in range(100):
+            if len(self.api.getUpdates_offsets()) >= 3:
+                break
+            sleep(0.05)
+        self.assertTrue(INCOMING_MESSAGE.is_set())
+        self.assertEqual(self.api.calls[0], ('setWebhook', {}), msg='remove the webhook')
+        self.assertEqual(self.api.getUpdates_offsets()[:3], [None, '200', '250'], msg='batches of 100')
+        self.assertEqual(InputQueue.get_offset(), 250)
+
+        messages = InputQueue.get_messages(1000)
+        self.assertEqual(len(messages), 150)
+        self.assertEqual(unpack_record(messages[0][1]).update_id, 100)
+        self.assertEqual(unpack_record(messages[0][1]).text, 'hello')
+
+        self.thread_obj.merge()
+        self.assertTrue(RECEIVER_IS_STOPPED.is_set())
+
+    def test_polling_receiver_restarts_from_the_saved_offset(self):
+        InputQueue.add_messages([], offset=240)
+
+        self.thread_obj.start()
+        if not RECEIVER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the receiver has passed.')
+
+        self._wait_for_the_queue(10)
+        self.thread_obj.merge()
+        self.assertEqual(self.api.getUpdates_offsets()[0], '240')
+        self.assertEqual(len(InputQueue.get_messages(1000)), 10)
+
+    @patch('lucky_bot.receiver.polling.POLLING_RETRY_DELAY', 0.1)
+    def test_polling_receiver_survives_telegram_errors(self):
+        self.api.errors.append('Internal Server Error')
+
+        self.thread_obj.start()
+        if not RECEIVER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the receiver has passed.')
+
+        self._wait_for_the_queue(150)
+        self.thread_obj.merge()
+
+    @patch('lucky_bot.receiver.polling.POLLING_RETRY_DELAY', 0.1)
+    @patch('lucky_bot.receiver.backpressure.IMQ_SOFT_DEPTH', 100)
+    def test_polling_receiver_backpressure(self):
+        self.thread_obj.start()
+        if not RECEIVER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the receiver has passed.')
+
+        self._wait_for_the_queue(100)
+        sleep(0.3)
+        self.assertEqual(self.api.getUpdates_offsets(), [None], msg='waits above the watermark')
+        self.assertEqual(len(InputQueue.get_messages(1000)), 100)
+
+        InputQueue.delete_messages([id_ for id_, data in InputQueue.get_messages(1000)])
+        self._wait_for_the_queue(50)
+        self.thread_obj.merge()
+        self.assertEqual(self.api.getUpdates_offsets()[:2], [None, '200'])
+
+    def test_polling_receiver_wrong_token(self):
+        self.api.errors.append('Unauthorized')
+
+        self.thread_obj.start()
+        if not RECEIVER_IS_STOPPED.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to stop the receiver has passed.')
+
+        self.assertTrue(EXIT_SIGNAL.is_set())
+        self.assertRaises(ReceiverException, self.thread_obj.merge)
+        self.assertEqual(InputQueue.get_messages(10), [])
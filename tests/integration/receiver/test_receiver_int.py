@@ -1,6 +1,11 @@
 """ python -m unittest tests.integration.receiver.test_receiver_int """
 import os
+import json
+import threading
+import unittest
+from time import sleep
 from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -12,9 +17,11 @@ from lucky_bot.helpers.signals import (
     RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED,
     EXIT_SIGNAL, INCOMING_MESSAGE,
 )
+from lucky_bot.helpers.records import pack_update
 from lucky_bot.receiver import InputQueue
 from lucky_bot.receiver import FLASK_APP
 from lucky_bot.receiver import ReceiverThread
+from lucky_bot.receiver.receiver import PooledWSGIServer
 
 from tests.presets import ThreadSmallTestTemplate, mock_ngrok, mock_telebot
 
@@ -31,7 +38,7 @@ class TestReceiverServing(ThreadSmallTestTemplate):
         cls.url = f'http://{ADDRESS}:{PORT}{WEBHOOK_ENDPOINT}'
         os.environ['no_proxy'] = '0.0.0.0,127.0.0.1,localhost,example.com'
 
-        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json'
+        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_list.json'
         with open(fixture) as f:
             cls.telegram_request = f.read().strip()
 
@@ -89,7 +96,7 @@ class TestReceiverServing(ThreadSmallTestTemplate):
         # input message queue
         result = InputQueue.get_first_message()
         self.assertIsNotNone(result)
-        self.assertEqual(result[1], self.telegram_request)
+        self.assertEqual(result[1], pack_update(json.loads(self.telegram_request)))
         InputQueue.delete_message(result[0])
         self.assertIsNone(InputQueue.get_first_message())
 
@@ -115,6 +122,31 @@ class TestReceiverServing(ThreadSmallTestTemplate):
         self.thread_obj.merge()
         self.assertIsNone(self.thread_obj.receiver.server)
 
+    def test_receiver_concurrent_requests(self, ngrok, bot):
+        self.thread_obj.start()
+        if not RECEIVER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the receiver has passed.')
+        self.assertIsInstance(self.thread_obj.receiver.server, PooledWSGIServer)
+
+        def post(update_id):
+            update = json.loads(self.telegram_request)
+            update['update_id'] = update_id
+            return requests.post(
+                self.url,
+                headers={'Content-Type': 'application/json',
+                         'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+                data=json.dumps(update).encode(),
+            ).status_code
+
+        with ThreadPoolExecutor(20) as executor:
+            codes = list(executor.map(post, range(1, 41)))
+
+        self.assertEqual(codes, [200] * 40)
+        self.assertFalse(EXIT_SIGNAL.is_set())
+        self.assertEqual(len(InputQueue.get_messages(100)), 40)
+        self.thread_obj.merge()
+
     @patch('lucky_bot.receiver.flask_config.test_exception')
     def test_receiver_exception_in_flask_app(self, test_exception, ngrok, bot):
         test_exception.side_effect = TestException('boom')
@@ -146,3 +178,34 @@ class TestReceiverServing(ThreadSmallTestTemplate):
             raise TestException('The time to stop the receiver has passed.')
 
         self.thread_obj.merge()
+
+
+class TestPooledServer(unittest.TestCase):
+    def test_pooled_server_sheds_above_the_queue(self):
+        release = threading.Event()
+        def app(environ, start_response):
+            release.wait(5)
+            start_response('200 OK', [('Content-Length', '0')])
+            return [b'']
+
+        server = PooledWSGIServer('127.0.0.1', 0, app, threads=1, queue_size=1)
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1})
+        thread.start()
+
+        def get():
+            try:
+                return requests.get(f'http://127.0.0.1:{server.server_port}/', timeout=10).status_code
+            except requests.ConnectionError:
+                return 'reset'
+
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(get) for _ in range(4)]
+            sleep(0.5)
+            release.set()
+            codes = [future.result() for future in futures]
+        server.shutdown()
+        server.server_close()
+        thread.join(5)
+
+        self.assertEqual(codes.count(200), 2, msg='one in a thread, one in the queue')
+        self.assertEqual(codes.count(503), 2, msg=str(codes))
@@ -0,0 +1,143 @@
+""" python -m unittest tests.integration.sender.test_async_sender_int """
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from unittest.mock import patch, Mock
+
+from telebot import asyncio_helper
+
+from lucky_bot.helpers.constants import TestException
+from lucky_bot.helpers.signals import SENDER_IS_RUNNING, SENDER_IS_STOPPED, EXIT_SIGNAL
+from lucky_bot.sender import OutputQueue
+from lucky_bot.sender import AsyncSenderThread
+from lucky_bot.sender.async_sender import AsyncSender
+
+from tests.presets import ThreadSmallTestTemplate
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """ A local Bot API: sendMessage answers after self.delay, or "Too many requests" to self.limited chats. """
+    daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+            chat = params.get('chat_id')
+
+            with self.server.lock:
+                self.server.in_flight += 1
+                self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            time.sleep(self.server.delay)
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+            if chat in self.server.limited:
+                self.server.limited.discard(chat)
+                code, body = 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                   'parameters': {'retry_after': 1}}
+            else:
+                with self.server.lock:
+                    self.server.messages.append((chat, params.get('text')))
+                code, body = 200, {'ok': True, 'result': {
+                    'message_id': len(self.server.messages), 'date': 0,
+                    'chat': {'id': int(chat), 'type': 'private'}, 'text': params.get('text'),
+                }}
+
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST  # telebot sends the form in the body of a GET
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.request_queue_size = 256
+        self.lock = threading.Lock()
+        self.delay = 0.05
+        self.limited = set()
+        self.messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.1})
+
+
+@patch('lucky_bot.sender.async_sender.RATE_LIMITER', Mock(**{'reserve.return_value': 0}))
+class TestAsyncSenderWithFakeAPI(ThreadSmallTestTemplate):
+    thread_class = AsyncSenderThread
+    is_running_signal = SENDER_IS_RUNNING
+    is_stopped_signal = SENDER_IS_STOPPED
+
+    @classmethod
+    def setUpClass(cls):
+        cls.api = FakeBotAPI()
+        cls.api.thread.start()
+        cls.api_url = asyncio_helper.API_URL
+        asyncio_helper.API_URL = f'http://127.0.0.1:{cls.api.server_port}/bot{{0}}/{{1}}'
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio_helper.API_URL = cls.api_url
+        cls.api.shutdown()
+        cls.api.server_close()
+
+    def setUp(self):
+        OutputQueue.set_up()
+        self.api.messages.clear()
+        self.api.limited.clear()
+        self.api.max_in_flight = 0
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        OutputQueue.tear_down()
+        AsyncSender.retry_at = None
+
+    def _start(self):
+        self.thread_obj.start()
+        if not SENDER_IS_RUNNING.wait(30):
+            self.thread_obj.merge()
+            raise TestException('The time to start the sender has passed.')
+
+    def test_async_sender_integration(self):
+        expected = [(str(100 + i % 100), f'message {i}') for i in range(300)]
+        for chat, text in expected:
+            OutputQueue.add_message(chat, text)
+
+        start = time.time()
+        self._start()
+        elapsed = time.time() - start
+
+        self.assertEqual(sorted(self.api.messages), sorted(expected))
+        for chat in ('100', '150', '199'):
+            self.assertEqual([m for m in self.api.messages if m[0] == chat], [m for m in expected if m[0] == chat],
+                             msg='in order per chat')
+        self.assertGreater(self.api.max_in_flight, 50, msg='the requests are in flight together')
+        self.assertLess(elapsed, 300 * self.api.delay / 5)
+        self.assertEqual(OutputQueue.get_messages(10), [])
+        self.assertFalse(EXIT_SIGNAL.is_set())
+        self.thread_obj.merge()
+
+    def test_async_sender_rate_limited_chat(self):
+        OutputQueue.add_message('5', 'foo')
+        OutputQueue.add_message('6', 'bar')
+        self.api.limited.add('5')
+
+        self._start()
+        self.assertEqual(self.api.messages, [('6', 'bar')])
+        self.assertFalse(EXIT_SIGNAL.is_set(), msg='the sender goes on')
+
+        for _ in range(50):
+            if OutputQueue.depth() == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.api.messages, [('6', 'bar'), ('5', 'foo')], msg='retried by itself')
+        self.thread_obj.merge()
@@ -2,11 +2,12 @@
 import time
 from unittest.mock import patch
 
+from requests.exceptions import ConnectionError
 from telebot.apihelper import ApiTelegramException
 
 from lucky_bot.helpers.constants import (
     TestException, SenderException,
-    OutputDispatcherException, OMQException,
+    OutputDispatcherException, OMQException, SCHEDULED,
 )
 from lucky_bot.helpers.signals import (
     SENDER_IS_RUNNING, SENDER_IS_STOPPED,
@@ -14,6 +15,8 @@ from lucky_bot.helpers.signals import (
 )
 from lucky_bot.sender import OutputQueue
 from lucky_bot.sender import SenderThread
+from lucky_bot.sender.sender import Sender
+from lucky_bot.sender.circuit_breaker import CircuitBreaker, OPEN, CLOSED
 
 from tests.presets import ThreadSmallTestTemplate
 
@@ -32,6 +35,7 @@ class TestSenderWorks(ThreadSmallTestTemplate):
     def tearDown(self):
         super().tearDown()
         OutputQueue.tear_down()
+        Sender.retry_at = None
 
     def test_sender_integration_normal_case(self, disp_bot, sender_cycle):
         uid1 = '42'
@@ -68,6 +72,23 @@ class TestSenderWorks(ThreadSmallTestTemplate):
 
         self.thread_obj.merge()
 
+    def test_sender_scheduled_message(self, disp_bot, *args):
+        OutputQueue.add_message('5', 'note', priority=SCHEDULED, deliver_after=int(time.time()) + 2)
+
+        self.thread_obj.start()
+        if not SENDER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the sender has passed.')
+        disp_bot.send_message.assert_not_called()
+
+        for _ in range(40):
+            if OutputQueue.depth() == 0:
+                break
+            time.sleep(0.1)
+        disp_bot.send_message.assert_called_once()
+        self.assertEqual(disp_bot.send_message.call_args.args, ('5', 'note'), msg='delivered by itself')
+        self.thread_obj.merge()
+
     def test_sender_forced_merge(self, *args):
         self.thread_obj.start()
         if not SENDER_IS_RUNNING.wait(10):
@@ -103,6 +124,92 @@ class TestSenderWorks(ThreadSmallTestTemplate):
 
         self.assertRaises(OMQException, self.thread_obj.merge)
 
+    def test_sender_rate_limited_chat(self, disp_bot, *args):
+        OutputQueue.add_message('5', 'foo')
+        OutputQueue.add_message('6', 'bar')
+        exc = ApiTelegramException(
+            function_name='foo', result='bar',
+            result_json={'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                         'parameters': {'retry_after': 1}}
+        )
+        limited = [exc]
+        disp_bot.send_message.side_effect = lambda uid, *args, **kwargs: \
+            (_ for _ in ()).throw(limited.pop()) if uid == '5' and limited else None
+
+        self.thread_obj.start()
+        if not SENDER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the sender has passed.')
+
+        self.assertEqual(sorted(c.args for c in disp_bot.send_message.call_args_list), [('5', 'foo'), ('6', 'bar')])
+        self.assertFalse(EXIT_SIGNAL.is_set(), msg='the sender goes on')
+
+        for _ in range(50):
+            if OutputQueue.depth() == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(disp_bot.send_message.call_count, 3)
+        self.assertEqual(disp_bot.send_message.call_args.args, ('5', 'foo'), msg='retried by itself')
+        self.thread_obj.merge()
+
+    def test_sender_rate_limited_chats_wait_by_themselves(self, disp_bot, *args):
+        OutputQueue.add_message('5', 'foo')
+        OutputQueue.add_message('6', 'bar')
+        limited = {'5': 1, '6': 2}
+        def send_message(uid, *args, **kwargs):
+            if retry_after := limited.pop(uid, None):
+                raise ApiTelegramException(
+                    function_name='foo', result='bar',
+                    result_json={'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                                 'parameters': {'retry_after': retry_after}}
+                )
+        disp_bot.send_message.side_effect = send_message
+
+        self.thread_obj.start()
+        if not SENDER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the sender has passed.')
+
+        for _ in range(50):
+            if OutputQueue.depth() == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(OutputQueue.depth(), 0, msg='the later chat is not left behind')
+        self.assertEqual(disp_bot.send_message.call_count, 4)
+        self.thread_obj.merge()
+
+    def test_sender_circuit_breaker(self, disp_bot, *args):
+        breaker = CircuitBreaker(window=10, min_calls=2, failure_rate=0.5, cooldown=1)
+        patch('lucky_bot.sender.output_dispatcher.CIRCUIT_BREAKER', breaker).start()
+        patch('lucky_bot.sender.sender.CIRCUIT_BREAKER', breaker).start()
+        self.addCleanup(patch.stopall)
+        OutputQueue.add_message('5', 'foo')
+        OutputQueue.add_message('6', 'bar')
+        telegram_is_down = [True]
+        def send_message(*args, **kwargs):
+            if telegram_is_down[0]:
+                raise ConnectionError('boom')
+        disp_bot.send_message.side_effect = send_message
+
+        self.thread_obj.start()
+        if not SENDER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the sender has passed.')
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(OutputQueue.depth(), 2, msg='the messages stay in the queue')
+        self.assertFalse(EXIT_SIGNAL.is_set(), msg='the sender goes on')
+        calls = disp_bot.send_message.call_count
+        telegram_is_down[0] = False
+
+        for _ in range(50):
+            if OutputQueue.depth() == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(disp_bot.send_message.call_count, calls + 2, msg='a probe, then the rest')
+        self.assertEqual(breaker.state, CLOSED)
+        self.thread_obj.merge()
+
     def test_sender_stops_gently(self, disp_bot, *args):
         OutputQueue.add_message(3, 'foo')
         exc = ApiTelegramException(
@@ -82,6 +82,9 @@ class TestSenderReceiverControllerAndDB(unittest.TestCase):
         if not SENDER_IS_STOPPED.wait(10):
             self.sender.merge()
             raise TestException('The time to stop the sender has passed.')
+        if not CONTROLLER_IS_RUNNING.wait(10):
+            self.controller.merge()
+            raise TestException('The time to start the controller has passed.')
         INCOMING_MESSAGE.set()
         if not CONTROLLER_IS_STOPPED.wait(10):
             self.controller.merge()
@@ -12,6 +12,7 @@ from lucky_bot.updater import UpdaterThread
 from tests.presets import ThreadSmallTestTemplate
 
 
+@patch('lucky_bot.updater.update_dispatcher.UPDATER_SPREAD_WINDOW', 0)
 @patch('lucky_bot.updater.updater.UpdaterThread._test_updater_cycle')
 @patch('lucky_bot.updater.updater.datetime')
 @patch('lucky_bot.updater.updater.second_update_time')
@@ -13,12 +13,22 @@ sys.path.append(str(BASE_DIR))
 
 from tests import test_base
 from tests.units import test_database
+from tests.units import test_misc
+from tests.units import test_records
+from tests.units import test_metrics
+from tests.units import test_tracing
+from tests.units import test_http_session
 from tests.units.updater import test_update_dispatcher
 from tests.units.updater import test_updater
 from tests.units.sender import test_omq
 from tests.units.sender import test_output_dispatcher
+from tests.units.sender import test_rate_limiter
+from tests.units.sender import test_circuit_breaker
 from tests.units.sender import test_sender
+from tests.units.sender import test_async_sender
 from tests.units.receiver import test_imq
+from tests.units.receiver import test_group_commit
+from tests.units.receiver import test_backpressure
 from tests.units.receiver import test_flask_app
 from tests.units.receiver import test_receiver
 from tests.units.controller import test_bot_handlers
@@ -27,7 +37,9 @@ from tests.units.controller import test_controller
 
 from tests.integration.updater import test_updater_int
 from tests.integration.sender import test_sender_int
+from tests.integration.sender import test_async_sender_int
 from tests.integration.receiver import test_receiver_int, test_flask_with_imq
+from tests.integration.receiver import test_polling_int
 from tests.integration.controller import test_controller_int
 from tests.integration.controller import test_controller_with_imq
 from tests.integration.controller import test_parser_with_db
@@ -48,15 +60,25 @@ if base_result.wasSuccessful() is False:
 print('\n------------------------------unit tests------------------------------')
 unit_tests = {
     test_database,
+    test_misc,
+    test_records,
+    test_metrics,
+    test_tracing,
+    test_http_session,
 
     test_update_dispatcher,
     test_updater,
 
     test_omq,
     test_output_dispatcher,
+    test_rate_limiter,
+    test_circuit_breaker,
     test_sender,
+    test_async_sender,
 
     test_imq,
+    test_group_commit,
+    test_backpressure,
     test_flask_app,
     test_receiver,
 
@@ -80,9 +102,11 @@ integration_tests = {
     test_updater_int,
 
     test_sender_int,
+    test_async_sender_int,
 
     test_flask_with_imq,
     test_receiver_int,
+    test_polling_int,
 
     test_parser_with_db,
     test_responder_integration,
@@ -1,10 +1,11 @@
 """ python -m unittest tests.units.controller.test_bot_handlers """
+import json
 import unittest
 from unittest.mock import patch
 
 import telebot
 
-from lucky_bot.helpers.constants import TestException, PROJECT_DIR
+from lucky_bot.helpers.constants import TestException, PROJECT_DIR, MASTER
 from lucky_bot.helpers.signals import EXIT_SIGNAL
 from lucky_bot.controller.bot_handlers import TEXT_HELLO, TEXT_HELP
 from lucky_bot import BOT
@@ -113,6 +114,30 @@ class TestBotHandlers(unittest.TestCase):
 
         respond.send_note.assert_called_once_with(self.uid, note_num)
 
+    def _admin_update(self, text):
+        update = json.loads(self.telegram_help)
+        update['message']['chat']['id'] = int(MASTER)
+        update['message']['text'] = text
+        update['message']['entities'] = [{'offset': 0, 'length': 6, 'type': 'bot_command'}]
+        return telebot.types.Update.de_json(json.dumps(update))
+
+    def test_admin_dlq_cmd(self, respond, *args):
+        BOT.process_new_updates([self._admin_update('/admin dlq list')])
+        respond.admin_list_dead_letters.assert_called_once()
+
+        BOT.process_new_updates([self._admin_update('/admin dlq replay 7')])
+        respond.admin_replay_dead_letter.assert_called_once_with('7')
+
+        BOT.process_new_updates([self._admin_update('/admin  dlq drop 8')])
+        respond.admin_drop_dead_letter.assert_called_once_with('8')
+
+    def test_admin_dlq_cmd_without_id(self, respond, *args):
+        BOT.process_new_updates([self._admin_update('/admin dlq replay')])
+        BOT.process_new_updates([self._admin_update('/admin dlq drop')])
+
+        respond.admin_replay_dead_letter.assert_not_called()
+        respond.admin_drop_dead_letter.assert_not_called()
+
 
 @patch('lucky_bot.controller.bot_handlers.parser')
 @patch('lucky_bot.controller.bot_handlers.respond')
@@ -1,15 +1,17 @@
 """ python -m unittest tests.units.controller.test_controller """
+import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, ANY
 from time import sleep
 
 from lucky_bot.helpers.constants import (
-    TestException, TelebotHandlerException, PROJECT_DIR,
+    TestException, TelebotHandlerException, IMQException, PROJECT_DIR,
 )
 from lucky_bot.helpers.signals import (
     CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED,
     INCOMING_MESSAGE, EXIT_SIGNAL,
 )
+from lucky_bot.helpers.records import pack_update
 from lucky_bot.controller.controller import Controller
 from lucky_bot.controller import ControllerThread
 
@@ -34,6 +36,32 @@ class TestControllerThreadBase(ThreadTestTemplate):
         super().forced_merge()
 
 
+@patch('lucky_bot.controller.controller.Controller.check_new_messages')
+class TestControllerWorkers(unittest.TestCase):
+    def setUp(self):
+        self.workers = [ControllerThread(worker) for worker in range(2)]
+
+    def tearDown(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.merge()
+        [signal.clear() for signal in (CONTROLLER_IS_RUNNING, CONTROLLER_IS_STOPPED, INCOMING_MESSAGE, EXIT_SIGNAL)]
+
+    def test_controller_workers_have_their_own_signals(self, check):
+        first, second = self.workers
+        self.assertIs(first.is_running_signal, CONTROLLER_IS_RUNNING)
+        self.assertIsNot(second.is_running_signal, CONTROLLER_IS_RUNNING)
+        self.assertIsNot(second.is_stopped_signal, CONTROLLER_IS_STOPPED)
+
+        second.start()
+        self.assertTrue(second.is_running_signal.wait(10))
+        self.assertFalse(CONTROLLER_IS_RUNNING.is_set(), msg='the first worker has not started')
+
+        second.merge()
+        self.assertTrue(second.is_stopped_signal.is_set())
+        self.assertFalse(CONTROLLER_IS_STOPPED.is_set())
+
+
 @patch('lucky_bot.controller.controller.BOT')
 @patch('lucky_bot.controller.controller.Controller.responder')
 class TestControllerCallToResponder(unittest.TestCase):
@@ -56,6 +84,19 @@ class TestControllerCallToResponder(unittest.TestCase):
         self.controller._process_the_message(msg_data)
         bot.process_new_updates.assert_called_once()
 
+    def test_telegram_message_record(self, arg, bot):
+        msg_data = pack_update(json.loads(self.telegram_request))
+        self.controller._process_the_message(msg_data)
+
+        bot.process_new_updates.assert_not_called()
+        bot.process_new_messages.assert_called_once()
+        message = bot.process_new_messages.call_args.args[0][0]
+        self.assertEqual(message.text, 'hello')
+        self.assertEqual(message.content_type, 'text')
+        self.assertEqual(message.chat.id, 1266575762)
+        self.assertEqual(message.chat.username, 'john_doe')
+        self.assertEqual(message.date, 1672410421)
+
     def test_telegram_message_exception(self, arg, bot):
         msg_data = self.telegram_request
         bot.process_new_updates.side_effect = TestException('boom')
@@ -64,6 +105,14 @@ class TestControllerCallToResponder(unittest.TestCase):
                           self.controller._process_the_message,
                           msg_data)
 
+    def test_telegram_message_imq_exception(self, arg, bot):
+        msg_data = self.telegram_request
+        bot.process_new_updates.side_effect = IMQException('boom')
+
+        self.assertRaises(IMQException,
+                          self.controller._process_the_message,
+                          msg_data)
+
 
 @patch('lucky_bot.controller.controller.ControllerThread._test_controller_cycle')
 @patch('lucky_bot.controller.controller.BOT')
@@ -81,9 +130,9 @@ class TestSenderExecution(ThreadSmallTestTemplate):
             cls.telegram_request = f.read().strip()
 
     def test_sender_normal_message(self, imq, responder, bot, controller_cycle):
-        msg_obj1 = (1, '/sender delete 42')
-        msg_obj2 = (2, self.telegram_request)
-        imq.get_first_message.side_effect = [msg_obj1, msg_obj2, None]
+        msg_obj1 = (1, '/sender delete 42', None)
+        msg_obj2 = (2, self.telegram_request, None)
+        imq.claim_messages.side_effect = [[msg_obj1, msg_obj2], []]
         INCOMING_MESSAGE.set()
 
         self.thread_obj.start()
@@ -95,18 +144,19 @@ class TestSenderExecution(ThreadSmallTestTemplate):
         self.assertFalse(EXIT_SIGNAL.is_set(), msg='first')
         responder.delete_user.assert_called_once_with('42')
         bot.process_new_updates.assert_called_once()
-        self.assertEqual(imq.delete_message.call_count, 2, msg='first')
+        imq.delete_messages.assert_called_once_with([1, 2], ANY)
         controller_cycle.assert_not_called()
 
-        msg_obj3 = (3, '/sender delete 404')
-        imq.get_first_message.side_effect = [msg_obj3, None]
+        msg_obj3 = (3, '/sender delete 404', None)
+        imq.claim_messages.side_effect = [[msg_obj3], []]
         INCOMING_MESSAGE.set()
         sleep(0.2)
         self.assertFalse(INCOMING_MESSAGE.is_set(), msg='cycle')
         self.assertFalse(EXIT_SIGNAL.is_set(), msg='cycle')
         self.assertEqual(responder.delete_user.call_count, 2, msg='cycle')
         bot.process_new_updates.assert_called_once()
-        self.assertEqual(imq.delete_message.call_count, 3, msg='cycle')
+        self.assertEqual(imq.delete_messages.call_count, 2, msg='cycle')
+        imq.delete_messages.assert_called_with([3], ANY)
         controller_cycle.assert_called_once()
 
         EXIT_SIGNAL.set()
@@ -119,16 +169,26 @@ class TestSenderExecution(ThreadSmallTestTemplate):
         controller_cycle.assert_called_once()
 
     def test_controller_exception_in_message_process(self, imq, responder, bot, controller_cycle):
-        msg_obj = (1, self.telegram_request)
-        imq.get_first_message.side_effect = [msg_obj, None]
+        msg_obj1 = (1, '/sender delete 42', None)
+        msg_obj2 = (2, self.telegram_request, None)
+        msg_obj3 = (3, '/sender delete 404', None)
+        imq.claim_messages.side_effect = [[msg_obj1, msg_obj2, msg_obj3], []]
         bot.process_new_updates.side_effect = TestException('boom')
 
         self.thread_obj.start()
+        if not CONTROLLER_IS_RUNNING.wait(10):
+            self.thread_obj.merge()
+            raise TestException('The time to start the controller has passed.')
+
+        self.assertFalse(EXIT_SIGNAL.is_set(), msg='a poison message does not stop the controller')
+        imq.fail_message.assert_called_once_with(2, ANY, 'TestException')
+        imq.delete_messages.assert_called_once_with([1, 3], ANY)
+        imq.release_messages.assert_called_once_with(ANY, [])
+        self.assertEqual(responder.delete_user.call_count, 2)
+
+        EXIT_SIGNAL.set()
+        INCOMING_MESSAGE.set()
         if not CONTROLLER_IS_STOPPED.wait(10):
             self.thread_obj.merge()
             raise TestException('The time to stop the controller has passed.')
-
-        self.assertFalse(CONTROLLER_IS_RUNNING.is_set(), msg='exception before this signal')
-        controller_cycle.assert_not_called()
-        self.assertTrue(EXIT_SIGNAL.is_set())
-        self.assertRaises(TelebotHandlerException, self.thread_obj.merge)
+        self.thread_obj.merge()
@@ -2,9 +2,10 @@
 import unittest
 from unittest.mock import patch, Mock
 
-from lucky_bot.helpers.constants import DatabaseException
+from lucky_bot.helpers.constants import DatabaseException, MASTER, INTERACTIVE, BULK
 from lucky_bot.helpers.misc import encrypt
 from lucky_bot.helpers.signals import NEW_MESSAGE_TO_SEND
+from lucky_bot.helpers.tracing import Trace
 from lucky_bot.controller import Respond
 
 
@@ -23,9 +24,28 @@ class TestResponder(unittest.TestCase):
         text = 'hello'
         self.responder.send_message(uid, text)
 
-        output.add_message.assert_called_once_with(uid, text, markup=False, encrypted=False)
+        output.add_message.assert_called_once_with(uid, text, markup=False, encrypted=False, trace=None,
+                                                   priority=INTERACTIVE)
         self.assertTrue(NEW_MESSAGE_TO_SEND.is_set())
 
+    def test_responder_mail_users_in_bulk(self, output, db):
+        db.get_all_users.return_value = [Mock(c_id=b'1'), Mock(c_id=b'2')]
+        self.responder.admin_mail_users('hello')
+
+        self.assertEqual(output.add_message.call_count, 2)
+        self.assertEqual(output.add_message.call_args.kwargs['priority'], BULK)
+
+    @patch('lucky_bot.controller.responder.tracing.current')
+    def test_responder_forwards_the_trace_of_interactive_replies(self, current, output, db):
+        current.return_value = Trace.start()
+        self.responder.send_message(1, 'hello')
+        self.assertIsNotNone(output.add_message.call_args.kwargs['trace'])
+
+        db.get_all_users.return_value = [Mock(c_id=b'1'), Mock(c_id=b'2')]
+        self.responder.admin_mail_users('hello')
+        self.assertIsNone(output.add_message.call_args_list[1].kwargs['trace'])
+        self.assertIsNone(output.add_message.call_args_list[2].kwargs['trace'])
+
     def test_responder_delete_user(self, arg, db):
         uid = 2
         self.responder.delete_user(uid, start_cmd=True)
@@ -124,3 +144,21 @@ class TestResponder(unittest.TestCase):
         output.add_message.assert_called_once()
         result = output.add_message.call_args.args
         self.assertEqual(result[1], 'Number not found. Check the note number by calling /list.')
+
+    @patch('lucky_bot.controller.responder.InputQueue')
+    def test_responder_admin_dead_letters(self, imq, output, db):
+        imq.get_dead_letters.return_value = [(7, 1672410421, 3, 'KeyError')]
+        self.responder.admin_list_dead_letters()
+        uid, text = output.add_message.call_args.args
+        self.assertEqual(uid, MASTER)
+        self.assertIn('id-7 :: KeyError, 3 attempts', text)
+
+        imq.replay_dead_letter.return_value = True
+        self.responder.admin_replay_dead_letter('7')
+        imq.replay_dead_letter.assert_called_once_with(7)
+        self.assertEqual(output.add_message.call_args.args[1], 'Dead letter id-7 returned to the queue.')
+
+        imq.drop_dead_letter.return_value = False
+        self.responder.admin_drop_dead_letter('8')
+        imq.drop_dead_letter.assert_called_once_with(8)
+        self.assertEqual(output.add_message.call_args.args[1], 'Dead letter id-8 not found.')
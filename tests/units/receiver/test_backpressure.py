@@ -0,0 +1,39 @@
+""" python -m unittest tests.units.receiver.test_backpressure """
+import unittest
+from unittest.mock import patch
+
+from lucky_bot.receiver.backpressure import Backpressure, NORMAL, SOFT, HARD
+
+
+@patch('lucky_bot.receiver.backpressure.IMQ_HARD_AGE', 300)
+@patch('lucky_bot.receiver.backpressure.IMQ_SOFT_AGE', 60)
+@patch('lucky_bot.receiver.backpressure.IMQ_HARD_DEPTH', 20)
+@patch('lucky_bot.receiver.backpressure.IMQ_SOFT_DEPTH', 10)
+@patch('lucky_bot.receiver.backpressure.Log')
+@patch('lucky_bot.receiver.backpressure.InputQueue')
+class TestBackpressure(unittest.TestCase):
+    def test_backpressure_watermarks(self, imq, log):
+        imq.oldest_message_age.return_value = 0
+        backpressure = Backpressure()
+
+        for depth, level in [(0, NORMAL), (10, SOFT), (20, HARD), (9, NORMAL)]:
+            imq.depth.return_value = depth
+            self.assertEqual(backpressure.check(), level, msg=f'depth {depth}')
+
+        self.assertEqual(log.warning.call_count, 2)
+        log.info.assert_called_once()
+
+    @patch('lucky_bot.receiver.backpressure.monotonic')
+    def test_backpressure_age_is_cached(self, monotonic, imq, log):
+        imq.depth.return_value = 0
+        imq.oldest_message_age.return_value = 60
+        monotonic.return_value = 100.0
+        backpressure = Backpressure()
+
+        self.assertEqual(backpressure.check(), SOFT)
+        imq.oldest_message_age.return_value = 300
+        monotonic.return_value = 100.5
+        self.assertEqual(backpressure.check(), SOFT, msg='cached')
+        monotonic.return_value = 101.0
+        self.assertEqual(backpressure.check(), HARD)
+        self.assertEqual(imq.oldest_message_age.call_count, 2)
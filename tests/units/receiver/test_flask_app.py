@@ -1,20 +1,24 @@
 """ python -m unittest tests.units.receiver.test_flask_app """
+import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, ANY
 
 from lucky_bot.helpers.constants import (
-    TestException, FlaskException, PROJECT_DIR,
+    TestException, FlaskException, PROJECT_DIR, TEXT_HELP,
     WEBHOOK_SECRET, WEBHOOK_ENDPOINT,
 )
 from lucky_bot.helpers.signals import EXIT_SIGNAL, INCOMING_MESSAGE
-from lucky_bot.receiver import FLASK_APP
+from lucky_bot.helpers.records import pack_update
+from lucky_bot.helpers.tracing import Trace
+from lucky_bot.receiver import FLASK_APP, InputQueue
+from lucky_bot.sender import OutputQueue
 
 
 @patch('lucky_bot.receiver.flask_config.InputQueue')
 class TestFlaskApp(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json'
+        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_list.json'
         with open(fixture) as f:
             cls.telegram_request = f.read().strip()
 
@@ -23,6 +27,9 @@ class TestFlaskApp(unittest.TestCase):
         FLASK_APP.config['TESTING'] = True
         FLASK_APP.config['DEBUG'] = True
         self.client = FLASK_APP.test_client()
+        backpressure = patch('lucky_bot.receiver.flask_config.BACKPRESSURE.check', return_value=200)
+        self.backpressure = backpressure.start()
+        self.addCleanup(backpressure.stop)
 
     def tearDown(self):
         signals = [EXIT_SIGNAL, INCOMING_MESSAGE]
@@ -36,6 +43,20 @@ class TestFlaskApp(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.text, 'pong')
 
+    def test_flask_app_metrics(self, *args):
+        InputQueue.set_up()
+        OutputQueue.set_up()
+        self.addCleanup(InputQueue.tear_down)
+        self.addCleanup(OutputQueue.tear_down)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        for name in ['lucky_bot_imq_depth', 'lucky_bot_omq_oldest_message_seconds',
+                     'lucky_bot_stage_seconds_bucket', 'lucky_bot_thread_running{thread="receiver"}',
+                     'lucky_bot_telegram_errors_total', 'lucky_bot_updater_round_seconds']:
+            self.assertIn(name, response.text)
+
     def test_flask_app_normal_request(self, imq):
         response = self.client.post(
             WEBHOOK_ENDPOINT,
@@ -44,12 +65,124 @@ class TestFlaskApp(unittest.TestCase):
             data=self.telegram_request.encode(),
         )
         self.assertEqual(response.status_code, 200)
+        imq.add_message.assert_called_once_with(
+            pack_update(json.loads(self.telegram_request)), 1672410421, update_id=906994025, trace=ANY,
+        )
+        trace = Trace.loads(imq.add_message.call_args.kwargs['trace'])
+        self.assertEqual(len(trace.marks), 2, msg='received and saved')
+
+    @patch('lucky_bot.receiver.flask_config.DUPLICATE_UPDATES')
+    def test_flask_app_duplicate_request(self, counter, imq):
+        imq.has_update.return_value = True
+        response = self.client.post(
+            WEBHOOK_ENDPOINT,
+            headers={'Content-Type': 'application/json',
+                     'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+            data=self.telegram_request.encode(),
+        )
+        self.assertEqual(response.status_code, 200, msg='telegram must not redeliver it again')
+        imq.has_update.assert_called_once_with(906994025)
+        imq.add_message.assert_not_called()
+        counter.increment.assert_called_once()
+        self.assertFalse(INCOMING_MESSAGE.is_set())
+
+    def test_flask_app_backpressure(self, imq):
+        for level in [429, 503]:
+            self.backpressure.return_value = level
+            response = self.client.post(
+                WEBHOOK_ENDPOINT,
+                headers={'Content-Type': 'application/json',
+                         'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+                data=self.telegram_request.encode(),
+            )
+            self.assertEqual(response.status_code, level)
+        imq.add_message.assert_not_called()
+        self.assertFalse(INCOMING_MESSAGE.is_set())
+
+    def test_flask_app_fast_reply(self, imq):
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+        update = json.loads(self.telegram_request)
+        replies = {'/ping': 'pong', '/ping@lucky_bot': 'pong', '/help': TEXT_HELP, 'hello': TEXT_HELP}
+        for text, reply in replies.items():
+            update['message']['text'] = text
+            response = self.client.post(WEBHOOK_ENDPOINT, headers=headers, data=json.dumps(update))
+            self.assertEqual(response.status_code, 200, msg=text)
+            self.assertEqual(
+                response.json,
+                {'method': 'sendMessage', 'chat_id': 1266575762, 'text': reply},
+                msg=text,
+            )
+        imq.add_message.assert_not_called()
+        self.assertFalse(INCOMING_MESSAGE.is_set())
+
+        update['message']['text'] = '/add ping'
+        response = self.client.post(WEBHOOK_ENDPOINT, headers=headers, data=json.dumps(update))
+        self.assertEqual(response.data, b'')
+        imq.add_message.assert_called_once()
+
+    def test_flask_app_duplicate_fast_reply(self, imq):
+        imq.remember_update.return_value = False
+        update = json.loads(self.telegram_request)
+        update['message']['text'] = '/ping'
+        response = self.client.post(
+            WEBHOOK_ENDPOINT,
+            headers={'Content-Type': 'application/json',
+                     'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+            data=json.dumps(update),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'')
+        imq.remember_update.assert_called_once_with(906994025)
+        imq.add_message.assert_not_called()
+
+    def test_flask_app_fast_reply_without_chat_id(self, imq):
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+        update = json.loads(self.telegram_request)
+        update['message']['text'] = '/ping'
+        del update['message']['chat']['id']
+        response = self.client.post(WEBHOOK_ENDPOINT, headers=headers, data=json.dumps(update))
+        self.assertEqual(response.status_code, 400)
+        imq.add_message.assert_not_called()
+        self.assertFalse(EXIT_SIGNAL.is_set())
+
+    @patch('lucky_bot.receiver.flask_config.WEBHOOK_FAST_REPLY', False)
+    def test_flask_app_fast_reply_off(self, imq):
+        update = json.loads(self.telegram_request)
+        update['message']['text'] = '/ping'
+        response = self.client.post(
+            WEBHOOK_ENDPOINT,
+            headers={'Content-Type': 'application/json',
+                     'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+            data=json.dumps(update),
+        )
+        self.assertEqual(response.data, b'')
         imq.add_message.assert_called_once()
 
     def test_flask_app_wrong_request(self, *args):
         response = self.client.post(WEBHOOK_ENDPOINT, data=r'junk')
         self.assertEqual(response.status_code, 400)
 
+    def test_flask_app_update_schema(self, imq):
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+        wrong = [
+            b'[]', b'{"message": {}}', b'{"update_id": "1"}',
+            b'{"update_id": 1, "message": {"chat": {"id": 1}}}',
+            b'{"update_id": 1, "message": {"date": 1, "chat": 1}}',
+            b'{"update_id": 1, "message": {"date": 1, "chat": {"type": "private"}, "text": "/start"}}',
+            b'{"update_id": 1, "message": {"date": 1, "chat": {"id": 1, "type": "private"}, "text": 5}}',
+            b'{"update_id": 1, "message": {"date": 1, "chat": {"id": 1, "type": "private"}, "from": 1}}',
+            b'\xff\xfe',
+        ]
+        for data in wrong:
+            response = self.client.post(WEBHOOK_ENDPOINT, headers=headers, data=data)
+            self.assertEqual(response.status_code, 400, msg=data)
+        imq.add_message.assert_not_called()
+
+        data = b'{"update_id": 2, "edited_message": {"date": 1, "chat": {"id": 1}}}'
+        response = self.client.post(WEBHOOK_ENDPOINT, headers=headers, data=data)
+        self.assertEqual(response.status_code, 200)
+        imq.add_message.assert_called_once_with(data, None, update_id=2, trace=ANY)
+
     @patch('lucky_bot.receiver.flask_config.get_message_data')
     def test_flask_app_get_msg_exception(self, get_message, *args):
         get_message.side_effect = TestException('boom')
@@ -0,0 +1,68 @@
+""" python -m unittest tests.units.receiver.test_group_commit """
+import unittest
+import threading
+from unittest.mock import patch
+
+from lucky_bot.helpers.constants import TestException, IMQException
+from lucky_bot.receiver import InputQueue
+from lucky_bot.receiver.group_commit import GroupCommit
+
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        InputQueue.set_up()
+
+    def tearDown(self):
+        InputQueue.tear_down()
+
+    def _add_concurrently(self, buffer, messages) -> list:
+        results = [None] * len(messages)
+        errors = []
+
+        def add(i, message):
+            try:
+                results[i] = buffer.add_message(*message)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=add, args=(i, msg)) for i, msg in enumerate(messages)]
+        [thread.start() for thread in threads]
+        [thread.join(10) for thread in threads]
+        return results + errors
+
+    @patch('lucky_bot.receiver.group_commit.InputQueue.add_messages', wraps=InputQueue.add_messages)
+    def test_group_commit_shares_transactions(self, add_messages):
+        buffer = GroupCommit(window=0.05, size=10)
+        messages = [(f'message {i}', i + 1, i + 1) for i in range(20)]
+
+        results = self._add_concurrently(buffer, messages)
+
+        self.assertEqual(results, [True] * 20)
+        self.assertLess(add_messages.call_count, 20, msg='at least one group')
+        self.assertEqual(
+            sorted(data for id_, data in InputQueue.get_messages(30)),
+            sorted(data for data, _, _ in messages),
+        )
+
+    def test_group_commit_duplicates(self):
+        buffer = GroupCommit(window=0.05, size=10)
+        self.assertTrue(buffer.add_message('foo', 1, 42))
+
+        results = self._add_concurrently(buffer, [('foo', 1, 42), ('foo', 1, 43), ('foo', 1, 43)])
+
+        self.assertEqual(sorted(results), [False, False, True])
+        self.assertEqual(len(InputQueue.get_messages(10)), 2)
+
+    @patch('lucky_bot.receiver.input_mq.test_func')
+    def test_group_commit_exception(self, func):
+        func.side_effect = TestException('boom')
+        buffer = GroupCommit(window=0.05, size=10)
+
+        results = self._add_concurrently(buffer, [('foo', 1, 1), ('bar', 2, 2), ('baz', 3, 3)])
+
+        self.assertEqual(results[:3], [None] * 3)
+        self.assertEqual(len(results[3:]), 3, msg='each request gets the exception')
+        [self.assertIsInstance(exc, IMQException) for exc in results[3:]]
+
+        func.side_effect = None
+        self.assertTrue(buffer.add_message('foo', 1, 1), msg='the leadership is free')
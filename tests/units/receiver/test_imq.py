@@ -1,7 +1,12 @@
 """ python -m unittest tests.units.receiver.test_imq """
 import unittest
+from time import sleep
+
+from sqlalchemy import inspect, text
 
 from lucky_bot.receiver import InputQueue
+from lucky_bot.helpers.constants import IMQ_MAX_ATTEMPTS
+from lucky_bot.receiver.input_mq import IMQ_ENGINE
 
 
 class TestReceiverMessageQueue(unittest.TestCase):
@@ -32,3 +37,224 @@ class TestReceiverMessageQueue(unittest.TestCase):
             self.assertTrue(InputQueue.delete_message(id_))
 
         self.assertIsNone(InputQueue.get_first_message())
+
+    def test_input_queue_fifo_tie_break(self):
+        for message in ['first', 'second', 'third']:
+            InputQueue.add_message(message, time=42)
+
+        for message in ['first', 'second', 'third']:
+            id_, text = InputQueue.get_first_message()
+            self.assertEqual(text, message)
+            InputQueue.delete_message(id_)
+
+    def test_input_queue_dequeue_uses_the_index(self):
+        with IMQ_ENGINE.connect() as conn:
+            plan = conn.execute(text(
+                'EXPLAIN QUERY PLAN SELECT id FROM incoming_messages '
+                'ORDER BY message_date, id LIMIT 1'
+            )).fetchall()
+        self.assertIn('ix_incoming_messages_fifo', str(plan))
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+    def test_input_queue_migration(self):
+        with IMQ_ENGINE.begin() as conn:
+            conn.execute(text('DROP INDEX ix_incoming_messages_fifo'))
+        indexes = [i['name'] for i in inspect(IMQ_ENGINE).get_indexes('incoming_messages')]
+        self.assertNotIn('ix_incoming_messages_fifo', indexes)
+
+        InputQueue.add_message('old message', time=1)
+        InputQueue.set_up()
+
+        indexes = [i['name'] for i in inspect(IMQ_ENGINE).get_indexes('incoming_messages')]
+        self.assertIn('ix_incoming_messages_fifo', indexes)
+        self.assertEqual(InputQueue.get_first_message()[1], 'old message')
+
+    def test_input_queue_batches(self):
+        self.assertEqual(InputQueue.get_messages(10), [])
+        self.assertEqual(InputQueue.delete_messages([]), 0)
+
+        for i in range(5):
+            InputQueue.add_message(f'message {i}', time=5 - i // 2)
+
+        batch = InputQueue.get_messages(3)
+        self.assertEqual([text for id_, text in batch], ['message 4', 'message 2', 'message 3'])
+        self.assertEqual(InputQueue.delete_messages([id_ for id_, text in batch]), 3)
+
+        batch = InputQueue.get_messages(3)
+        self.assertEqual([text for id_, text in batch], ['message 0', 'message 1'])
+        self.assertEqual(InputQueue.delete_messages([id_ for id_, text in batch] + [404]), 2)
+        self.assertEqual(InputQueue.get_messages(3), [])
+
+    def test_input_queue_claims(self):
+        for i in range(5):
+            InputQueue.add_message(f'message {i}', time=i + 1)
+
+        batch1 = InputQueue.claim_messages('worker-1', 2)
+        batch2 = InputQueue.claim_messages('worker-2', 2)
+        self.assertEqual([msg[1] for msg in batch1], ['message 0', 'message 1'])
+        self.assertEqual([msg[1] for msg in batch2], ['message 2', 'message 3'])
+
+        # someone else's claim can't be deleted, renewed or released
+        ids1 = [msg[0] for msg in batch1]
+        self.assertEqual(InputQueue.delete_messages(ids1, 'worker-2'), 0)
+        self.assertEqual(InputQueue.renew_lease('worker-2', ids1), 0)
+        self.assertEqual(InputQueue.release_messages('worker-2', ids1), 0)
+
+        self.assertEqual(InputQueue.renew_lease('worker-1', ids1), 2)
+        self.assertEqual(InputQueue.delete_messages(ids1[:1], 'worker-1'), 1)
+        self.assertEqual(InputQueue.release_messages('worker-1', ids1[1:]), 1)
+
+        batch3 = InputQueue.claim_messages('worker-3', 10)
+        self.assertEqual([msg[1] for msg in batch3], ['message 1', 'message 4'])
+        self.assertEqual(InputQueue.claim_messages('worker-1', 10), [])
+
+    def test_input_queue_lease_expires(self):
+        InputQueue.add_message('foo', time=1)
+        InputQueue.add_message('bar', time=2)
+
+        self.assertEqual(len(InputQueue.claim_messages('worker-1', 10, lease=0.1)), 2)
+        self.assertEqual(InputQueue.claim_messages('worker-2', 10), [])
+
+        sleep(0.2)
+        batch = InputQueue.claim_messages('worker-2', 1)
+        self.assertEqual([msg[1] for msg in batch], ['foo'])
+        self.assertEqual(InputQueue.delete_messages([batch[0][0]], 'worker-1'), 0, msg='lease is lost')
+
+    def test_input_queue_update_id_is_unique(self):
+        self.assertFalse(InputQueue.has_update(42))
+        self.assertTrue(InputQueue.add_message('foo', time=1, update_id=42))
+        self.assertTrue(InputQueue.has_update(42))
+        self.assertFalse(InputQueue.add_message('foo again', time=2, update_id=42))
+
+        self.assertTrue(InputQueue.add_message('/sender delete 1', time=3))
+        self.assertTrue(InputQueue.add_message('/sender delete 2', time=4), msg='no update_id')
+        self.assertEqual(
+            [data for id_, data in InputQueue.get_messages(10)],
+            ['foo', '/sender delete 1', '/sender delete 2'],
+        )
+
+    def test_input_queue_remembers_the_processed_updates(self):
+        InputQueue.add_messages([('foo', 1, 1), ('bar', 2, 2), ('baz', 3, 3)])
+        ids = [msg[0] for msg in InputQueue.claim_messages('worker-1', 10)]
+        self.assertEqual(InputQueue.delete_messages(ids[:2], 'worker-1'), 2)
+        for _ in range(IMQ_MAX_ATTEMPTS):
+            InputQueue.fail_message(ids[2], 'worker-1', 'KeyError')
+            InputQueue.claim_messages('worker-1', 10)
+
+        self.assertEqual(InputQueue.depth(), 0)
+        for update_id in [1, 2, 3]:
+            self.assertTrue(InputQueue.has_update(update_id), msg=update_id)
+        self.assertFalse(InputQueue.add_message('foo again', time=4, update_id=1))
+        self.assertEqual(InputQueue.add_messages([('bar again', 5, 2), ('qux', 6, 4)]), [False, True])
+
+        with IMQ_ENGINE.begin() as conn:
+            conn.execute(text('UPDATE processed_updates SET processed_at = 0'))
+        InputQueue.delete_messages([InputQueue.get_first_message()[0]])
+        self.assertFalse(InputQueue.has_update(1), msg='forgotten after the retention time')
+        self.assertTrue(InputQueue.has_update(4), msg='deleted in the same transaction')
+
+    def test_input_queue_remember_update(self):
+        InputQueue.add_message('foo', time=1, update_id=1)
+        self.assertFalse(InputQueue.remember_update(1), msg='in the queue')
+        self.assertTrue(InputQueue.remember_update(2))
+        self.assertFalse(InputQueue.remember_update(2), msg='processed')
+        self.assertTrue(InputQueue.has_update(2))
+        self.assertFalse(InputQueue.add_message('bar', time=2, update_id=2))
+
+    def test_input_queue_add_messages(self):
+        InputQueue.add_message('foo', time=1, update_id=1)
+        result = InputQueue.add_messages([
+            ('foo', 1, 1), ('bar', 2, 2), ('bar again', 3, 2), ('/sender delete 1', None, None),
+        ])
+        self.assertEqual(result, [False, True, False, True])
+        self.assertEqual(
+            [data for id_, data in InputQueue.get_messages(10)],
+            ['foo', 'bar', '/sender delete 1'],
+        )
+        self.assertEqual(InputQueue.add_messages([]), [])
+
+    def test_input_queue_traces(self):
+        InputQueue.add_message('foo', time=1, trace='a:1.0:2.0')
+        InputQueue.add_messages([('bar', 2, None, 'b:1.0:2.0'), ('baz', 3, None)])
+        self.assertEqual(
+            [msg[1:] for msg in InputQueue.claim_messages('worker-1', 10)],
+            [('foo', 'a:1.0:2.0'), ('bar', 'b:1.0:2.0'), ('baz', None)],
+        )
+
+    def test_input_queue_polling_offset(self):
+        self.assertIsNone(InputQueue.get_offset())
+        self.assertEqual(InputQueue.add_messages([('foo', 1, 10), ('bar', 2, 11)], offset=12), [True, True])
+        self.assertEqual(InputQueue.get_offset(), 12)
+        self.assertEqual(InputQueue.add_messages([], offset=15), [])
+        self.assertEqual(InputQueue.get_offset(), 15)
+
+    def test_input_queue_dead_letters(self):
+        InputQueue.add_message('poison', time=1)
+        InputQueue.add_message('foo', time=2)
+
+        for attempt in range(1, IMQ_MAX_ATTEMPTS + 1):
+            msg_id, data, trace = InputQueue.claim_messages('worker-1', 1)[0]
+            self.assertEqual(data, 'poison')
+            moved = InputQueue.fail_message(msg_id, 'worker-1', 'KeyError')
+            self.assertEqual(moved, attempt == IMQ_MAX_ATTEMPTS, msg=f'attempt {attempt}')
+
+        self.assertEqual([data for id_, data in InputQueue.get_messages(10)], ['foo'])
+        letters = InputQueue.get_dead_letters()
+        self.assertEqual(len(letters), 1)
+        letter_id, time, attempts, error = letters[0]
+        self.assertEqual((time, attempts, error), (1, IMQ_MAX_ATTEMPTS, 'KeyError'))
+
+        self.assertTrue(InputQueue.replay_dead_letter(letter_id))
+        self.assertFalse(InputQueue.replay_dead_letter(letter_id))
+        self.assertEqual([data for id_, data in InputQueue.get_messages(10)], ['poison', 'foo'])
+        self.assertEqual(InputQueue.get_dead_letters(), [])
+
+        msg_id, data, trace = InputQueue.claim_messages('worker-1', 1)[0]
+        self.assertFalse(InputQueue.fail_message(msg_id, 'worker-1', 'KeyError'), msg='clean count')
+        self.assertFalse(InputQueue.drop_dead_letter(letter_id))
+
+    def test_input_queue_depth_and_age(self):
+        self.assertEqual(InputQueue.depth(), 0)
+        self.assertEqual(InputQueue.oldest_message_age(), 0)
+
+        InputQueue.add_message('foo', time=1, update_id=10)
+        InputQueue.add_message('foo', time=1, update_id=10)
+        InputQueue.add_messages([('bar', 2, 11), ('baz', 3, 12)])
+        self.assertEqual(InputQueue.depth(), 3, msg='a duplicate is not counted')
+
+        with IMQ_ENGINE.begin() as conn:
+            conn.execute(text('UPDATE incoming_messages SET queued_at = queued_at - 100 WHERE update_id = 10'))
+        self.assertGreaterEqual(InputQueue.oldest_message_age(), 100)
+
+        msg_id, data = InputQueue.get_first_message()
+        InputQueue.delete_message(msg_id)
+        self.assertLess(InputQueue.oldest_message_age(), 100)
+        ids = [id_ for id_, data in InputQueue.get_messages(10)]
+        InputQueue.delete_messages(ids)
+        self.assertEqual(InputQueue.depth(), 0)
+
+        InputQueue.add_message('foo', time=1)
+        InputQueue.set_up()
+        self.assertEqual(InputQueue.depth(), 1, msg='counted on start')
+
+    def test_input_queue_migration_of_columns(self):
+        with IMQ_ENGINE.begin() as conn:
+            conn.execute(text('DROP TABLE incoming_messages'))
+            conn.execute(text(
+                'CREATE TABLE incoming_messages ('
+                'id INTEGER NOT NULL PRIMARY KEY, '
+                'message_body BLOB NOT NULL, '
+                'message_date INTEGER NOT NULL)'
+            ))
+        InputQueue.set_up()
+
+        columns = [c['name'] for c in inspect(IMQ_ENGINE).get_columns('incoming_messages')]
+        self.assertIn('claimed_by', columns)
+        self.assertIn('lease_until', columns)
+        self.assertIn('update_id', columns)
+        self.assertIn('attempts', columns)
+        self.assertIn('queued_at', columns)
+        self.assertIn('trace', columns)
+
+        InputQueue.add_message('foo', time=1)
+        self.assertEqual(InputQueue.claim_messages('worker-1', 1)[0][1], 'foo')
@@ -1,12 +1,14 @@
 """ python -m unittest tests.units.receiver.test_receiver """
+import unittest
 from unittest.mock import patch, Mock
 
 from lucky_bot.helpers.constants import (
     TestException, ReceiverException,
-    PORT, WEBHOOK_SECRET, WEBHOOK_ENDPOINT,
+    PORT, WEBHOOK_SECRET, WEBHOOK_ENDPOINT, WEBHOOK_THREADS,
 )
 from lucky_bot.helpers.signals import RECEIVER_IS_RUNNING, RECEIVER_IS_STOPPED, EXIT_SIGNAL
 from lucky_bot.receiver import ReceiverThread
+from lucky_bot.receiver.receiver import Receiver
 
 from tests.presets import (
     ThreadTestTemplate, ThreadSmallTestTemplate,
@@ -100,7 +102,7 @@ class TestWebhook(ThreadSmallTestTemplate):
         bot.remove_webhook.assert_called_once()
         bot.set_webhook.assert_called_once_with(
             url='http://0.0.0.0'+WEBHOOK_ENDPOINT,
-            max_connections=10,
+            max_connections=WEBHOOK_THREADS,
             secret_token=WEBHOOK_SECRET
         )
         self.assertTrue(self.thread_obj.receiver.webhook)
@@ -213,3 +215,12 @@ class TestServer(ThreadSmallTestTemplate):
 
         self.assertRaises(ReceiverException, self.thread_obj.merge)
         self.assertIsNone(self.thread_obj.receiver.server)
+
+
+class TestServerSettings(unittest.TestCase):
+    @patch('lucky_bot.receiver.receiver.make_server')
+    @patch('lucky_bot.receiver.receiver.WEBHOOK_THREADS', 1)
+    @patch('lucky_bot.receiver.receiver.WEBHOOK_GROUP_COMMIT', True)
+    def test_receiver_group_commit_needs_the_pool(self, make_server):
+        self.assertRaises(ReceiverException, Receiver()._make_server)
+        make_server.assert_not_called()
@@ -0,0 +1,212 @@
+""" python -m unittest tests.units.sender.test_async_sender """
+import asyncio
+import threading
+import unittest
+from time import time
+from unittest.mock import patch, Mock, AsyncMock
+
+from telebot import asyncio_helper
+from telebot.asyncio_helper import ApiTelegramException, RequestTimeout
+
+from lucky_bot.helpers.constants import (
+    TestException, DispatcherTimeout, DispatcherUndefinedExc,
+    OutputDispatcherException, DispatcherWrongToken, DispatcherNoAccess, StopTheSenderGently,
+    DispatcherUnavailable, SEND_MAX_ATTEMPTS, ASYNC_SENDER_CONCURRENCY,
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+)
+from lucky_bot.helpers.misc import make_hash
+from lucky_bot.sender import async_sender
+from lucky_bot.sender.async_sender import AsyncSender
+from lucky_bot.sender.circuit_breaker import CircuitBreaker, OPEN
+
+
+def api_exception(code: int, description: str, parameters: dict = None) -> ApiTelegramException:
+    result_json = {'error_code': code, 'description': description}
+    if parameters:
+        result_json['parameters'] = parameters
+    return ApiTelegramException(function_name='sendMessage', result='bar', result_json=result_json)
+
+
+@patch('lucky_bot.sender.async_sender.asyncio.sleep', new_callable=AsyncMock)
+@patch('lucky_bot.sender.async_sender.RATE_LIMITER')
+class TestAsyncDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.bot = Mock()
+        self.bot.send_message = AsyncMock()
+
+    def send(self, *args):
+        return asyncio.run(async_sender.send_message(self.bot, *args))
+
+    def test_async_dispatcher_normal_case(self, limiter, sleep):
+        limiter.reserve.return_value = 0.5
+        self.send(42, 'hello', True)
+        self.bot.send_message.assert_awaited_once_with(42, 'hello', parse_mode='HTML')
+        limiter.reserve.assert_called_once_with(42)
+        sleep.assert_awaited_once_with(0.5)
+
+    def test_async_dispatcher_sorts_the_exceptions(self, limiter, sleep):
+        limiter.reserve.return_value = 0
+        cases = [
+            (api_exception(401, 'Unauthorized'), DispatcherWrongToken),
+            (api_exception(400, 'Bad Request: chat not found'), DispatcherNoAccess),
+            (api_exception(403, 'Forbidden: bot was blocked by the user'), DispatcherNoAccess),
+            (TestException('boom'), OutputDispatcherException),
+        ]
+        for exc, expected in cases:
+            with self.subTest(expected=expected.__name__):
+                self.bot.send_message.side_effect = exc
+                self.assertRaises(expected, self.send, 42, 'hello')
+
+    def test_async_dispatcher_timeout(self, limiter, sleep):
+        limiter.reserve.return_value = 0
+        self.bot.send_message.side_effect = api_exception(
+            429, 'Too Many Requests: retry after 7', {'retry_after': 7})
+        with self.assertRaises(DispatcherTimeout) as context:
+            self.send(42, 'hello')
+        self.assertEqual(context.exception.retry_after, 7)
+        sleep.assert_not_awaited()
+
+    def test_async_dispatcher_undefined_exception(self, limiter, sleep):
+        limiter.reserve.return_value = 0
+        self.bot.send_message.side_effect = api_exception(409, 'undefined telegram problem')
+        self.assertRaises(DispatcherUndefinedExc, self.send, 42, 'hello', True)
+        self.bot.send_message.assert_awaited_once()
+        sleep.assert_not_awaited()
+
+    def test_async_dispatcher_telegram_is_unavailable(self, limiter, sleep):
+        limiter.reserve.return_value = 0
+        breaker = CircuitBreaker(window=10, min_calls=2, failure_rate=0.5, cooldown=30)
+        self.bot.send_message.side_effect = RequestTimeout('boom')
+        with patch('lucky_bot.sender.async_sender.CIRCUIT_BREAKER', breaker), \
+                patch('lucky_bot.sender.output_dispatcher.CIRCUIT_BREAKER', breaker):
+            for _ in range(2):
+                with self.assertRaises(DispatcherUnavailable) as context:
+                    self.send(42, 'hello')
+        self.assertEqual(self.bot.send_message.await_count, 2, msg='the breaker opens after 2 failures')
+        self.assertEqual(breaker.state, OPEN)
+        self.assertAlmostEqual(context.exception.retry_after, 30, delta=1)
+
+
+@patch('lucky_bot.sender.async_sender.InputQueue')
+@patch('lucky_bot.sender.async_sender.OutputQueue')
+@patch('lucky_bot.sender.async_sender.send_message', new_callable=AsyncMock)
+class TestAsyncSender(unittest.TestCase):
+    def setUp(self):
+        # the sender module postpones the chats and looks for the scheduled messages
+        patcher = patch('lucky_bot.sender.sender.OutputQueue', **{'next_delivery_at.return_value': None})
+        self.sender_omq = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        AsyncSender.retry_at = None
+        AsyncSender.shutdown()
+
+    def test_async_sender_session_settings(self, send, omq, imq):
+        omq.get_messages.return_value = []
+        AsyncSender.process_outgoing_messages()
+
+        self.assertEqual(asyncio_helper.REQUEST_LIMIT, ASYNC_SENDER_CONCURRENCY)
+        self.assertEqual(asyncio_helper.REQUEST_TIMEOUT, HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT)
+
+    def test_async_sender_keeps_the_order_of_a_chat(self, send, omq, imq):
+        messages = [(i, str(i % 3), f'message {i}', False, None) for i in range(30)]
+        omq.get_messages.side_effect = [messages, []]
+        sent = []
+        async def send_message(bot, uid, text, markup=False):
+            await asyncio.sleep(0.01)
+            sent.append((uid, text))
+        send.side_effect = send_message
+
+        AsyncSender.process_outgoing_messages()
+
+        self.assertEqual(sorted(omq.delete_messages.call_args.args[0]), list(range(30)))
+        for chat in '012':
+            self.assertEqual(
+                [text for uid, text in sent if uid == chat],
+                [f'message {i}' for i in range(30) if str(i % 3) == chat],
+            )
+
+    def test_async_sender_postpones_the_chat(self, send, omq, imq):
+        omq.get_messages.side_effect = [[
+            (1, '5', 'foo', False, None),
+            (2, '6', 'bar', False, None),
+            (3, '5', 'baz', False, None),
+            (4, '7', 'qux', False, None),
+        ], []]
+        async def send_message(bot, uid, text, markup=False):
+            if uid == '5':
+                raise DispatcherTimeout('boom', retry_after=30)
+            if uid == '7':
+                raise DispatcherNoAccess('boom')
+        send.side_effect = send_message
+
+        AsyncSender.process_outgoing_messages()
+
+        self.assertEqual(sorted(c.args[1] for c in send.await_args_list), ['5', '6', '7'])
+        self.sender_omq.postpone_chat.assert_called_once_with(make_hash('5'), 30)
+        self.assertEqual(sorted(omq.delete_messages.call_args.args[0]), [2, 4])
+        imq.add_message.assert_called_once_with('/sender delete 7')
+        self.assertIsNotNone(AsyncSender.retry_at)
+
+    def test_async_sender_retries_the_message_later(self, send, omq, imq):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', True, None), (2, '5', 'bar', False, None)], []]
+        omq.retry_message.side_effect = [1, SEND_MAX_ATTEMPTS]
+        send.side_effect = DispatcherUndefinedExc('boom')
+
+        AsyncSender.process_outgoing_messages()
+        omq.retry_message.assert_called_once_with(1, drop_markup=True)
+        self.assertEqual(self.sender_omq.postpone_chat.call_args.args[0], make_hash('5'))
+        omq.delete_messages.assert_called_once_with([])
+
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None)], []]
+        send.side_effect = [DispatcherUndefinedExc('boom'), None]
+        AsyncSender.process_outgoing_messages()
+        self.assertEqual(send.await_args.args[1:], ('5', 'Undefined error while trying to send you a message :C'))
+        omq.delete_messages.assert_called_with([1])
+
+    def test_async_sender_writes_to_the_queue_outside_the_loop(self, send, omq, imq):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '6', 'bar', False, None)], []]
+        other_chat_sent = threading.Event()
+        async def send_message(bot, uid, text, markup=False):
+            if uid == '5':
+                raise DispatcherUndefinedExc('boom')
+            other_chat_sent.set()
+        send.side_effect = send_message
+        def retry_message(*args, **kwargs):
+            # a busy lock: the retry of the chat "5" waits for the send to the chat "6"
+            if not other_chat_sent.wait(1):
+                raise TestException('the loop is blocked')
+            return 1
+        omq.retry_message.side_effect = retry_message
+
+        AsyncSender.process_outgoing_messages()
+
+        omq.retry_message.assert_called_once_with(1, drop_markup=True)
+        self.sender_omq.postpone_chat.assert_called_once()
+        omq.delete_messages.assert_called_once_with([2])
+
+    def test_async_sender_gives_up_when_the_notice_fails(self, send, omq, imq):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '5', 'bar', False, None)], []]
+        omq.retry_message.return_value = SEND_MAX_ATTEMPTS
+        send.side_effect = [DispatcherUndefinedExc('boom'), DispatcherUnavailable('badoom'), None]
+
+        AsyncSender.process_outgoing_messages()
+        omq.delete_messages.assert_called_once_with([1, 2])
+
+    def test_async_sender_stops_gently(self, send, omq, imq):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None)], []]
+        send.side_effect = DispatcherWrongToken('boom')
+        self.assertRaises(StopTheSenderGently, AsyncSender.process_outgoing_messages)
+        omq.delete_messages.assert_called_once_with([])
+
+    def test_async_sender_keeps_the_messages(self, send, omq, imq):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '6', 'bar', False, None)], []]
+        async def send_message(bot, uid, text, markup=False):
+            if uid == '5':
+                raise DispatcherUnavailable('boom', retry_after=30)
+        send.side_effect = send_message
+
+        AsyncSender.process_outgoing_messages()
+        omq.get_messages.assert_called_once()
+        omq.delete_messages.assert_called_once_with([])
+        self.assertAlmostEqual(AsyncSender.retry_at, time() + 30, delta=1)
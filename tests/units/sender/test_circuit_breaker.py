@@ -0,0 +1,92 @@
+""" python -m unittest tests.units.sender.test_circuit_breaker """
+import unittest
+import threading
+from unittest.mock import patch
+
+from lucky_bot.helpers.metrics import render
+from lucky_bot.sender import circuit_breaker
+from lucky_bot.sender.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+@patch('lucky_bot.sender.circuit_breaker.monotonic')
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=10, min_calls=4, failure_rate=0.5, cooldown=30)
+
+    def test_circuit_breaker_opens_on_the_failure_rate(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED, msg='fewer than min_calls')
+
+        self.breaker.record_success()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN, msg='4 of 6')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+    def test_circuit_breaker_window_slides(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(6):
+            self.breaker.record_success()
+        for _ in range(4):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED, msg='4 of 10')
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN, msg='5 of the last 10')
+
+    def test_circuit_breaker_half_open_probe(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(4):
+            self.breaker.record_failure()
+
+        monotonic.return_value = 130.0
+        self.assertTrue(self.breaker.allow(), msg='the probe')
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow(), msg='one probe at a time')
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+        monotonic.return_value = 160.0
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.retry_in(), 0)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED, msg='a clean window')
+
+    def test_circuit_breaker_lost_probe(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(4):
+            self.breaker.record_failure()
+        monotonic.return_value = 130.0
+        self.assertTrue(self.breaker.allow())
+
+        monotonic.return_value = 160.0
+        self.assertTrue(self.breaker.allow(), msg='the next probe after another cooldown')
+
+    def test_circuit_breaker_one_probe_between_threads(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(4):
+            self.breaker.record_failure()
+        monotonic.return_value = 130.0
+
+        allowed = []
+        barrier = threading.Barrier(8)
+        def allow():
+            barrier.wait()
+            allowed.append(self.breaker.allow())
+        threads = [threading.Thread(target=allow) for _ in range(8)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        self.assertEqual(allowed.count(True), 1)
+
+    def test_circuit_breaker_metric(self, monotonic):
+        monotonic.return_value = 100.0
+        with patch('lucky_bot.sender.circuit_breaker.CIRCUIT_BREAKER', self.breaker):
+            for _ in range(4):
+                self.breaker.record_failure()
+            self.assertIn('lucky_bot_circuit_breaker_state 1\n', render([circuit_breaker.BREAKER_STATE]))
@@ -1,7 +1,13 @@
 """ python -m unittest tests.units.sender.test_omq """
 import unittest
+from time import time
 
+from sqlalchemy import inspect, text
+
+from lucky_bot.helpers.constants import SCHEDULED, BULK
+from lucky_bot.helpers.misc import encrypt, make_hash
 from lucky_bot.sender import OutputQueue
+from lucky_bot.sender.output_mq import OMQ_ENGINE, share_the_batch
 
 
 class TestSenderMessageQueue(unittest.TestCase):
@@ -40,3 +46,146 @@ class TestSenderMessageQueue(unittest.TestCase):
             self.assertTrue(OutputQueue.delete_message(message_id))
 
         self.assertIsNone(OutputQueue.get_first_message())
+
+    def test_output_queue_depth_and_age(self):
+        self.assertEqual(OutputQueue.depth(), 0)
+        self.assertEqual(OutputQueue.oldest_message_age(), 0)
+
+        OutputQueue.add_message(1, 'foo', time=int(time()) - 100)
+        OutputQueue.add_message(2, 'bar')
+        OutputQueue.add_message(3, 'baz')
+        self.assertEqual(OutputQueue.depth(), 3)
+        self.assertGreaterEqual(OutputQueue.oldest_message_age(), 100)
+
+        ids = [msg[0] for msg in OutputQueue.get_messages(10)]
+        OutputQueue.delete_message(ids[0])
+        self.assertLess(OutputQueue.oldest_message_age(), 100)
+        OutputQueue.delete_messages(ids)
+        self.assertEqual(OutputQueue.depth(), 0)
+
+        OutputQueue.add_message(1, 'foo')
+        OutputQueue.set_up()
+        self.assertEqual(OutputQueue.depth(), 1, msg='counted on start')
+
+    def test_output_queue_postponed_chat(self):
+        OutputQueue.add_message('5', 'foo', time=1)
+        OutputQueue.add_message('6', 'bar', time=2)
+        OutputQueue.add_message(encrypt('5'), encrypt('baz'), time=3, encrypted=True)
+
+        self.assertEqual(OutputQueue.postpone_chat(make_hash('5'), 30), 2)
+        self.assertEqual([msg[2] for msg in OutputQueue.get_messages(10)], ['bar'])
+        self.assertEqual(OutputQueue.get_first_message()[2], 'bar')
+
+        OutputQueue.postpone_chat(make_hash('5'), -1)
+        self.assertEqual([msg[2] for msg in OutputQueue.get_messages(10)], ['foo', 'bar', 'baz'])
+
+    def test_output_queue_retry_message(self):
+        OutputQueue.add_message('5', 'foo', time=1, markup=True)
+        message_id = OutputQueue.get_first_message()[0]
+
+        self.assertEqual(OutputQueue.retry_message(message_id), 1)
+        self.assertEqual(OutputQueue.retry_message(message_id, drop_markup=True), 2)
+        self.assertEqual(OutputQueue.retry_message(42), 0)
+        self.assertFalse(OutputQueue.get_first_message()[3], msg='no markup')
+
+        OutputQueue.postpone_chat(make_hash('5'), 30)
+        OutputQueue.add_message('5', 'bar', time=2)
+        self.assertIsNone(OutputQueue.get_first_message(), msg='waits behind the retried one')
+
+        OutputQueue.set_up()
+        self.assertEqual(OutputQueue.retry_message(message_id), 3, msg='survives a restart')
+
+    def test_output_queue_lanes(self):
+        for i in range(20):
+            OutputQueue.add_message(str(i), f'bulk {i}', time=1, priority=BULK)
+            OutputQueue.add_message(str(i), f'scheduled {i}', time=2, priority=SCHEDULED)
+        OutputQueue.add_message('42', 'reply', time=3)
+
+        self.assertEqual(OutputQueue.get_first_message()[2], 'reply')
+        batch = [msg[2] for msg in OutputQueue.get_messages(10)]
+        self.assertEqual(batch[0], 'reply', msg='the higher lanes first')
+        self.assertEqual(len(batch), 10)
+        self.assertEqual(batch[1:9], [f'scheduled {i}' for i in range(8)], msg='the spare room of the first lane')
+        self.assertEqual(batch[9], 'bulk 0', msg='the bulk lane is not starved')
+
+        self.assertEqual(share_the_batch([[], [], list(range(20))], 10), [[], [], list(range(10))])
+        self.assertEqual(share_the_batch([[], [], []], 10), [[], [], []])
+
+    def test_output_queue_share_a_small_batch(self):
+        lanes = [list(range(5)), list(range(5)), list(range(5))]
+        self.assertEqual(share_the_batch(lanes, 1), [[0], [], []])
+        self.assertEqual(share_the_batch(lanes, 2), [[0, 1], [], []])
+        self.assertEqual(share_the_batch(lanes, 3), [[0, 1], [0], []], msg='the rest to the heavier lanes')
+        self.assertEqual(share_the_batch([[], [0], [0]], 1), [[], [0], []])
+        for limit in range(1, 16):
+            self.assertEqual(sum(len(rows) for rows in share_the_batch(lanes, limit)), limit)
+
+    def test_output_queue_scheduled_message(self):
+        now = int(time())
+        self.assertIsNone(OutputQueue.next_delivery_at())
+        OutputQueue.add_message('5', 'note', time=1, priority=SCHEDULED, deliver_after=now + 60)
+        OutputQueue.add_message('6', 'note', time=1, priority=SCHEDULED, deliver_after=now + 30)
+        OutputQueue.add_message('7', 'note', time=1, priority=SCHEDULED, deliver_after=now - 1)
+        OutputQueue.add_message('5', 'reply', time=2)
+
+        self.assertEqual([msg[1:3] for msg in OutputQueue.get_messages(10)], [('5', 'reply'), ('7', 'note')],
+                         msg='a scheduled message does not hold its chat')
+        self.assertEqual(OutputQueue.next_delivery_at(), now + 30)
+
+        OutputQueue.postpone_chat(make_hash('7'), 10)
+        self.assertEqual(OutputQueue.next_delivery_at(), now + 10, msg='a postponed chat')
+
+    def test_output_queue_scheduled_lane_order(self):
+        now = int(time())
+        OutputQueue.add_message('5', 'first', time=1, priority=SCHEDULED, deliver_after=now - 1)
+        OutputQueue.add_message('6', 'second', time=2, priority=SCHEDULED)
+        OutputQueue.add_message('7', 'third', time=3, priority=SCHEDULED, deliver_after=now - 1)
+        OutputQueue.add_message('8', 'later', time=0, priority=SCHEDULED, deliver_after=now + 60)
+
+        self.assertEqual([msg[2] for msg in OutputQueue.get_messages(10)], ['first', 'second', 'third'])
+        self.assertEqual([msg[2] for msg in OutputQueue.get_messages(2)], ['first', 'second'])
+
+    def test_output_queue_scheduled_lane_uses_the_index(self):
+        with OMQ_ENGINE.connect() as conn:
+            plan = conn.execute(text(
+                'EXPLAIN QUERY PLAN SELECT id FROM messages_to_telegram '
+                'WHERE priority = 1 AND deliver_after <= 100 ORDER BY date, id LIMIT 10'
+            )).fetchall()
+        self.assertIn('ix_messages_to_telegram_lane_due (priority=? AND deliver_after<?)', str(plan))
+
+    def test_output_queue_fifo_tie_break(self):
+        for message in ['first', 'second', 'third']:
+            OutputQueue.add_message('42', message, time=42)
+
+        for message in ['first', 'second', 'third']:
+            message_id, uid, text, markup = OutputQueue.get_first_message()
+            self.assertEqual(text, message)
+            OutputQueue.delete_message(message_id)
+
+    def test_output_queue_migration(self):
+        with OMQ_ENGINE.begin() as conn:
+            conn.execute(text('DROP INDEX ix_messages_to_telegram_fifo'))
+
+        OutputQueue.add_message('42', 'old message', time=1)
+        OutputQueue.set_up()
+
+        indexes = [i['name'] for i in inspect(OMQ_ENGINE).get_indexes('messages_to_telegram')]
+        self.assertIn('ix_messages_to_telegram_fifo', indexes)
+        self.assertEqual(OutputQueue.get_first_message()[2], 'old message')
+
+    def test_output_queue_batches(self):
+        self.assertEqual(OutputQueue.get_messages(10), [])
+        self.assertEqual(OutputQueue.delete_messages([]), 0)
+
+        OutputQueue.add_message('1', 'foo', time=2, markup=True)
+        OutputQueue.add_message('2', 'bar', time=1)
+        OutputQueue.add_message('3', 'baz', time=3, trace='a:1.0:2.0')
+
+        batch = OutputQueue.get_messages(2)
+        self.assertEqual([msg[1:] for msg in batch], [('2', 'bar', False, None), ('1', 'foo', True, None)])
+        self.assertEqual(OutputQueue.delete_messages([msg[0] for msg in batch]), 2)
+
+        batch = OutputQueue.get_messages(2)
+        self.assertEqual([msg[1:] for msg in batch], [('3', 'baz', False, 'a:1.0:2.0')])
+        self.assertEqual(OutputQueue.delete_messages([batch[0][0]]), 1)
+        self.assertEqual(OutputQueue.get_messages(2), [])
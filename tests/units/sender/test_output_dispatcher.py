@@ -1,45 +1,62 @@
 """ python -m unittest tests.units.sender.test_output_dispatcher """
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
+from requests.exceptions import ConnectionError
 from telebot.apihelper import ApiTelegramException
 
 from lucky_bot.helpers.constants import (
     TestException, DispatcherTimeout,
     DispatcherUndefinedExc, OutputDispatcherException,
-    DispatcherWrongToken, DispatcherNoAccess,
+    DispatcherWrongToken, DispatcherNoAccess, DispatcherUnavailable, SEND_RETRY_AFTER,
 )
 from lucky_bot.sender import output_dispatcher as dispatcher
+from lucky_bot.sender.circuit_breaker import CircuitBreaker, CLOSED, OPEN
 
 
-@patch('lucky_bot.sender.output_dispatcher.time')
+@patch('lucky_bot.sender.output_dispatcher.RATE_LIMITER', Mock())
 @patch('lucky_bot.sender.output_dispatcher.BOT')
 class TestOutputDispatcher(unittest.TestCase):
     def test_dispatcher_normal_case(self, bot, *args):
         dispatcher.send_message(42, 'hello')
         bot.send_message.assert_called_once_with(42, 'hello')
 
+    def test_dispatcher_waits_for_the_rate_limiter(self, bot, *args):
+        with patch('lucky_bot.sender.output_dispatcher.RATE_LIMITER') as limiter:
+            limiter.wait.side_effect = lambda uid: bot.send_message.assert_not_called()
+            dispatcher.send_message(42, 'hello')
+        limiter.wait.assert_called_once_with(42)
+        bot.send_message.assert_called_once()
+
     def test_dispatcher_normal_exception(self, bot, *args):
         bot.send_message.side_effect = TestException('boom')
         self.assertRaises(OutputDispatcherException, dispatcher.send_message, 42, 'hello')
 
-    def test_dispatcher_undefined_exception(self, bot, time):
+    def test_dispatcher_undefined_exception(self, bot):
         exc = ApiTelegramException(
             function_name='foo', result='bar',
             result_json={'error_code': 409, 'description': 'undefined telegram problem'}
         )
         bot.send_message.side_effect = exc
         self.assertRaises(DispatcherUndefinedExc, dispatcher.send_message, 42, 'hello')
-        self.assertEqual(time.sleep.call_count, 2)
+        bot.send_message.assert_called_once()  # the sender schedules the next attempt
 
-    def test_dispatcher_timeout_exception(self, bot, time):
+    def test_dispatcher_timeout_exception(self, bot):
         exc = ApiTelegramException(
             function_name='foo', result='bar',
-            result_json={'error_code': 429, 'description': 'Too many requests'}
+            result_json={'error_code': 429, 'description': 'Too Many Requests: retry after 7',
+                         'parameters': {'retry_after': 7}}
         )
         bot.send_message.side_effect = exc
-        self.assertRaises(DispatcherTimeout, dispatcher.send_message, 42, 'hello')
-        self.assertEqual(time.sleep.call_count, 2)
+        with self.assertRaises(DispatcherTimeout) as context:
+            dispatcher.send_message(42, 'hello')
+        self.assertEqual(context.exception.retry_after, 7)
+        bot.send_message.assert_called_once()
+
+        exc.result_json.pop('parameters')
+        with self.assertRaises(DispatcherTimeout) as context:
+            dispatcher.send_message(42, 'hello')
+        self.assertEqual(context.exception.retry_after, SEND_RETRY_AFTER)
 
     def test_dispatcher_blocked_exception(self, bot, *args):
         exc = ApiTelegramException(
@@ -64,3 +81,51 @@ class TestOutputDispatcher(unittest.TestCase):
         )
         bot.send_message.side_effect = exc
         self.assertRaises(DispatcherWrongToken, dispatcher.send_message, 42, 'hello')
+
+
+@patch('lucky_bot.sender.output_dispatcher.RATE_LIMITER', Mock())
+@patch('lucky_bot.sender.output_dispatcher.BOT')
+class TestOutputDispatcherCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=10, min_calls=4, failure_rate=0.5, cooldown=30)
+        patcher = patch('lucky_bot.sender.output_dispatcher.CIRCUIT_BREAKER', self.breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dispatcher_telegram_is_unavailable(self, bot):
+        bot.send_message.side_effect = ConnectionError('boom')
+        for _ in range(3):
+            with self.assertRaises(DispatcherUnavailable) as context:
+                dispatcher.send_message(42, 'hello')
+        self.assertEqual(bot.send_message.call_count, 3)
+        self.assertEqual(context.exception.retry_after, 0, msg='the breaker is still closed')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+        self.assertRaises(DispatcherUnavailable, dispatcher.send_message, 42, 'hello')
+        self.assertEqual(bot.send_message.call_count, 4, msg='opened after the 4th failure')
+        self.assertEqual(self.breaker.state, OPEN)
+
+        bot.send_message.reset_mock()
+        with self.assertRaises(DispatcherUnavailable) as context:
+            dispatcher.send_message(42, 'hello')
+        bot.send_message.assert_not_called()
+        self.assertAlmostEqual(context.exception.retry_after, 30, delta=1)
+
+    def test_dispatcher_server_errors_open_the_breaker(self, bot):
+        bot.send_message.side_effect = ApiTelegramException(
+            function_name='foo', result='bar',
+            result_json={'error_code': 502, 'description': 'Bad Gateway'}
+        )
+        for _ in range(4):
+            self.assertRaises(DispatcherUnavailable, dispatcher.send_message, 42, 'hello')
+        self.assertEqual(bot.send_message.call_count, 4)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_dispatcher_client_errors_keep_the_breaker_closed(self, bot):
+        bot.send_message.side_effect = ApiTelegramException(
+            function_name='foo', result='bar',
+            result_json={'error_code': 403, 'description': 'Forbidden: bot blocked by user'}
+        )
+        for _ in range(10):
+            self.assertRaises(DispatcherNoAccess, dispatcher.send_message, 42, 'hello')
+        self.assertEqual(self.breaker.state, CLOSED)
@@ -0,0 +1,80 @@
+""" python -m unittest tests.units.sender.test_rate_limiter """
+import unittest
+import threading
+from unittest.mock import patch
+
+from lucky_bot.sender import rate_limiter
+from lucky_bot.sender.rate_limiter import RateLimiter
+
+
+@patch('lucky_bot.sender.rate_limiter.monotonic')
+class TestRateLimiter(unittest.TestCase):
+    def test_rate_limiter_global_bucket(self, monotonic):
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(rate=30, burst=30, chat_rate=1, chat_burst=1)
+
+        delays = [limiter.reserve(chat) for chat in range(60)]
+        self.assertEqual(delays[:30], [0] * 30, msg='the burst')
+        self.assertAlmostEqual(delays[30], 1 / 30)
+        self.assertAlmostEqual(delays[59], 1)
+
+        monotonic.return_value = 102.0
+        self.assertEqual(limiter.reserve('new chat'), 0, msg='refilled')
+
+    def test_rate_limiter_chat_bucket(self, monotonic):
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(rate=30, burst=30, chat_rate=1, chat_burst=1)
+
+        self.assertEqual(limiter.reserve(42), 0)
+        self.assertAlmostEqual(limiter.reserve('42'), 1, msg='the same chat')
+        self.assertAlmostEqual(limiter.reserve(42), 2)
+        self.assertEqual(limiter.reserve(43), 0, msg='another chat')
+
+        monotonic.return_value = 103.0
+        self.assertEqual(limiter.reserve(42), 0)
+
+    @patch('lucky_bot.sender.rate_limiter.CHAT_BUCKETS_LIMIT', 3)
+    def test_rate_limiter_drops_idle_chats(self, monotonic):
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(rate=30, burst=30, chat_rate=1, chat_burst=1)
+        for chat in range(3):
+            limiter.reserve(chat)
+
+        monotonic.return_value = 100.5
+        limiter.reserve(3)
+        self.assertEqual(len(limiter._chats), 4, msg='no idle chats yet')
+
+        monotonic.return_value = 102.0
+        limiter.reserve(4)
+        self.assertEqual(sorted(limiter._chats), ['4'])
+
+    @patch('lucky_bot.sender.rate_limiter.EXIT_SIGNAL')
+    def test_rate_limiter_wait(self, exit_signal, monotonic):
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(rate=30, burst=30, chat_rate=1, chat_burst=1)
+
+        limiter.wait(42)
+        exit_signal.wait.assert_not_called()
+        limiter.wait(42)
+        exit_signal.wait.assert_called_once()
+        self.assertAlmostEqual(exit_signal.wait.call_args.args[0], 1)
+
+    def test_rate_limiter_is_thread_safe(self, monotonic):
+        monotonic.return_value = 100.0
+        limiter = RateLimiter(rate=30, burst=30, chat_rate=1, chat_burst=1)
+        delays = []
+
+        def reserve():
+            for _ in range(100):
+                delays.append(limiter.reserve(42))
+
+        threads = [threading.Thread(target=reserve) for _ in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        self.assertAlmostEqual(max(delays), 399, msg='each call got its own token')
+
+
+class TestRateLimiterInstance(unittest.TestCase):
+    def test_rate_limiter_defaults(self):
+        self.assertIsInstance(rate_limiter.RATE_LIMITER, RateLimiter)
+        self.assertEqual(rate_limiter.RATE_LIMITER.chat_rate, 1)
@@ -1,22 +1,25 @@
 """ python -m unittest tests.units.sender.test_sender """
 import unittest
 from unittest.mock import patch
-from time import sleep
+from time import sleep, time
 
 from lucky_bot.helpers.constants import (
-    TestException, DispatcherTimeout, IMQException,
+    TestException, DispatcherTimeout, IMQException, SEND_MAX_ATTEMPTS, SEND_BACKOFF_BASE, SEND_BACKOFF_MAX,
     DispatcherUndefinedExc, OutputDispatcherException,
-    StopTheSenderGently, DispatcherWrongToken, DispatcherNoAccess,
+    StopTheSenderGently, DispatcherWrongToken, DispatcherNoAccess, DispatcherUnavailable,
 )
 from lucky_bot.helpers.signals import (
     SENDER_IS_RUNNING, SENDER_IS_STOPPED,
     EXIT_SIGNAL, NEW_MESSAGE_TO_SEND, INCOMING_MESSAGE,
 )
-from lucky_bot.sender.sender import Sender
+from lucky_bot.helpers.misc import make_hash
+from lucky_bot.sender.sender import Sender, backoff
 from lucky_bot.sender import SenderThread
 
 from tests.presets import ThreadTestTemplate, ThreadSmallTestTemplate
 
+NO_SCHEDULED = {'next_delivery_at.return_value': None}
+
 
 @patch('lucky_bot.sender.sender.Sender.process_outgoing_messages')
 class TestSenderThreadBase(ThreadTestTemplate):
@@ -38,7 +41,7 @@ class TestSenderThreadBase(ThreadTestTemplate):
 
 @patch('lucky_bot.sender.sender.SenderThread._test_sender_cycle')
 @patch('lucky_bot.sender.sender.output_dispatcher')
-@patch('lucky_bot.sender.sender.OutputQueue')
+@patch('lucky_bot.sender.sender.OutputQueue', **NO_SCHEDULED)
 @patch('lucky_bot.sender.sender.InputQueue')
 class TestSenderExecution(ThreadSmallTestTemplate):
     thread_class = SenderThread
@@ -50,8 +53,8 @@ class TestSenderExecution(ThreadSmallTestTemplate):
         uid = '42'
         text = 'hello'
         markup = True
-        message = (id_, uid, text, markup)
-        omq.get_first_message.side_effect = [message, None]
+        message = (id_, uid, text, markup, None)
+        omq.get_messages.side_effect = [[message], []]
         NEW_MESSAGE_TO_SEND.set()
 
         self.thread_obj.start()
@@ -62,17 +65,17 @@ class TestSenderExecution(ThreadSmallTestTemplate):
         self.assertFalse(NEW_MESSAGE_TO_SEND.is_set(), msg='first msg')
         self.assertFalse(EXIT_SIGNAL.is_set(), msg='first msg')
         disp.send_message.assert_called_once_with(uid, text, markup)
-        omq.delete_message.assert_called_once_with(id_)
+        omq.delete_messages.assert_called_once_with([id_])
         imq.assert_not_called()
         sender_cycle.assert_not_called()
 
-        omq.get_first_message.side_effect = [message, None]
+        omq.get_messages.side_effect = [[message], []]
         NEW_MESSAGE_TO_SEND.set()
         sleep(0.2)
         self.assertFalse(NEW_MESSAGE_TO_SEND.is_set(), msg='cycle')
         self.assertFalse(EXIT_SIGNAL.is_set(), msg='cycle')
         self.assertEqual(disp.send_message.call_count, 2, msg='cycle')
-        self.assertEqual(omq.delete_message.call_count, 2, msg='cycle')
+        self.assertEqual(omq.delete_messages.call_count, 2, msg='cycle')
         imq.assert_not_called()
         sender_cycle.assert_called_once()
 
@@ -87,8 +90,9 @@ class TestSenderExecution(ThreadSmallTestTemplate):
 
     @patch('lucky_bot.sender.sender.Sender._handle_a_delivery')
     def test_sender_exception_stop_gently(self, func, imq, omq, disp, sender_cycle):
-        omq.get_first_message.side_effect = [(1, '9', 'foobar', False), None]
-        func.side_effect = StopTheSenderGently('pretty please')
+        omq.get_messages.side_effect = [[(1, '9', 'foobar', False, None), (2, '6', 'bazqux', False, None)], []]
+        func.side_effect = lambda uid, *args: (_ for _ in ()).throw(StopTheSenderGently('pretty please')) \
+            if uid == '6' else True
 
         self.thread_obj.start()
         if not SENDER_IS_STOPPED.wait(10):
@@ -98,10 +102,11 @@ class TestSenderExecution(ThreadSmallTestTemplate):
         self.assertFalse(SENDER_IS_RUNNING.is_set(), msg='exception before this signal')
         sender_cycle.assert_not_called()
         self.assertTrue(EXIT_SIGNAL.is_set())
+        omq.delete_messages.assert_called_once_with([1])
         self.thread_obj.merge()  # no exceptions, just stops
 
     def test_sender_exception_in_dispatcher(self, imq, omq, disp, sender_cycle):
-        omq.get_first_message.side_effect = [(2, '33', 'bazqux', False), None]
+        omq.get_messages.side_effect = [[(2, '33', 'bazqux', False, None)], []]
         disp.send_message.side_effect = OutputDispatcherException('boom')
 
         self.thread_obj.start()
@@ -128,14 +133,12 @@ class TestSenderCallToDispatcher(unittest.TestCase):
         self.assertRaises(StopTheSenderGently, Sender._handle_a_delivery, 1, 'foo', False)
 
     def test_sender_call_exception_timeout(self, disp, imq):
-        disp.send_message.side_effect = DispatcherTimeout('boom')
-        self.assertRaises(StopTheSenderGently, Sender._handle_a_delivery, 2, 'bar', False)
+        disp.send_message.side_effect = DispatcherTimeout('boom', retry_after=5)
+        self.assertRaises(DispatcherTimeout, Sender._handle_a_delivery, 2, 'bar', False)
 
     def test_sender_call_exception_undefined(self, disp, imq):
-        disp.send_message.side_effect = [DispatcherUndefinedExc('boom'), None]
-        Sender._handle_a_delivery(3, 'baz', False)
-        text = 'Undefined error while trying to send you a message :C'
-        disp.send_message.assert_called_with(3, text)
+        disp.send_message.side_effect = DispatcherUndefinedExc('boom')
+        self.assertRaises(DispatcherUndefinedExc, Sender._handle_a_delivery, 3, 'baz', False)
 
     def test_sender_call_exception_no_access(self, disp, imq):
         disp.send_message.side_effect = DispatcherNoAccess('boom')
@@ -162,3 +165,185 @@ class TestSenderCallToDispatcher(unittest.TestCase):
     def test_sender_call_dispatcher_normal(self, disp, imq):
         Sender._handle_a_delivery(8, 'garply')
         disp.send_message.assert_called_once_with(8, 'garply', False)
+
+
+@patch('lucky_bot.sender.sender.output_dispatcher')
+@patch('lucky_bot.sender.sender.OutputQueue', **NO_SCHEDULED)
+class TestSenderRateLimitedChat(unittest.TestCase):
+    def tearDown(self):
+        Sender.retry_at = None
+        Sender.shutdown()
+
+    def test_sender_postpones_the_chat(self, omq, disp):
+        omq.get_messages.side_effect = [[
+            (1, '5', 'foo', False, None),
+            (2, '6', 'bar', False, None),
+            (3, '5', 'baz', False, None),
+        ], []]
+        disp.send_message.side_effect = lambda uid, *args: \
+            (_ for _ in ()).throw(DispatcherTimeout('boom', retry_after=30)) if uid == '5' else None
+
+        Sender.process_outgoing_messages()
+
+        self.assertEqual(sorted(c.args[0] for c in disp.send_message.call_args_list), ['5', '6'],
+                         msg='the next message to the limited chat is skipped')
+        omq.postpone_chat.assert_called_once_with(make_hash('5'), 30)
+        omq.delete_messages.assert_called_once_with([2])
+        self.assertAlmostEqual(Sender.retry_at, time() + 30, delta=1)
+
+        thread = SenderThread()
+        self.assertAlmostEqual(thread._time_to_wait(), 30, delta=1)
+        Sender.retry_at = None
+        self.assertEqual(thread._time_to_wait(), 3600)
+
+
+@patch('lucky_bot.sender.sender.output_dispatcher')
+@patch('lucky_bot.sender.sender.OutputQueue', **NO_SCHEDULED)
+class TestSenderWorkers(unittest.TestCase):
+    def tearDown(self):
+        Sender.shutdown()
+
+    def test_sender_workers_keep_the_order_of_a_chat(self, omq, disp):
+        messages = [(i, str(i % 3), f'message {i}', False, None) for i in range(30)]
+        omq.get_messages.side_effect = [messages, []]
+        sent = []
+        disp.send_message.side_effect = lambda uid, text, markup: sleep(0.01) or sent.append((uid, text))
+
+        start = time()
+        Sender.process_outgoing_messages()
+        self.assertLess(time() - start, 0.25, msg='the chats go in parallel')
+
+        self.assertEqual(sorted(omq.delete_messages.call_args.args[0]), list(range(30)))
+        for chat in '012':
+            self.assertEqual(
+                [text for uid, text in sent if uid == chat],
+                [f'message {i}' for i in range(30) if str(i % 3) == chat],
+            )
+
+    def test_sender_workers_stop_after_an_exception(self, omq, disp):
+        omq.get_messages.side_effect = [[
+            (1, '5', 'foo', False, None),
+            (2, '6', 'bar', False, None),
+            (3, '5', 'baz', False, None),
+        ], []]
+        def send_message(uid, *args):
+            if uid == '6':
+                raise OutputDispatcherException('boom')
+            sleep(0.1)
+        disp.send_message.side_effect = send_message
+
+        self.assertRaises(OutputDispatcherException, Sender.process_outgoing_messages)
+        omq.delete_messages.assert_called_once_with([1])
+        self.assertEqual(disp.send_message.call_count, 2, msg='the chat "5" stops before its next message')
+
+
+@patch('lucky_bot.sender.sender.output_dispatcher')
+@patch('lucky_bot.sender.sender.OutputQueue', **NO_SCHEDULED)
+class TestSenderTelegramUnavailable(unittest.TestCase):
+    def tearDown(self):
+        Sender.retry_at = None
+        Sender.shutdown()
+
+    def test_sender_keeps_the_messages(self, omq, disp):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '5', 'bar', False, None)], []]
+        disp.send_message.side_effect = DispatcherUnavailable('boom', retry_after=30)
+
+        Sender.process_outgoing_messages()
+
+        disp.send_message.assert_called_once()
+        omq.delete_messages.assert_called_once_with([])
+        omq.get_messages.assert_called_once()
+        self.assertAlmostEqual(Sender.retry_at, time() + 30, delta=1)
+
+    def test_sender_postpones_the_chats_when_the_breaker_opens(self, omq, disp):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '6', 'bar', False, None)], []]
+        def send_message(uid, *args):
+            if uid == '5':
+                raise DispatcherTimeout('boom', retry_after=30)
+            sleep(0.05)
+            raise DispatcherUnavailable('badoom', retry_after=60)
+        disp.send_message.side_effect = send_message
+
+        Sender.process_outgoing_messages()
+
+        omq.postpone_chat.assert_called_once_with(make_hash('5'), 30)
+        omq.delete_messages.assert_called_once_with([])
+        omq.get_messages.assert_called_once()
+        self.assertAlmostEqual(Sender.retry_at, time() + 30, delta=1)
+
+    def test_sender_wakes_up_for_the_scheduled_message(self, omq, disp):
+        omq.get_messages.return_value = []
+        omq.next_delivery_at.return_value = time() + 40
+        Sender.process_outgoing_messages()
+        self.assertAlmostEqual(SenderThread()._time_to_wait(), 40, delta=1)
+
+    @patch('lucky_bot.sender.sender.CIRCUIT_BREAKER')
+    def test_sender_waits_for_the_circuit_breaker(self, breaker, omq, disp):
+        breaker.retry_in.return_value = 20
+        Sender.process_outgoing_messages()
+
+        omq.get_messages.assert_not_called()
+        self.assertAlmostEqual(SenderThread()._time_to_wait(), 20, delta=1)
+
+
+@patch('lucky_bot.sender.sender.output_dispatcher')
+@patch('lucky_bot.sender.sender.OutputQueue', **NO_SCHEDULED)
+class TestSenderRetries(unittest.TestCase):
+    def tearDown(self):
+        Sender.retry_at = None
+        Sender.shutdown()
+
+    def test_sender_backoff(self, *args):
+        for attempts in range(1, 5):
+            delay = SEND_BACKOFF_BASE * 2 ** (attempts - 1)
+            self.assertTrue(delay / 2 <= backoff(attempts) <= delay, msg=attempts)
+        self.assertLessEqual(backoff(100), SEND_BACKOFF_MAX)
+
+    @patch('lucky_bot.sender.sender.backoff')
+    def test_sender_retries_the_message_later(self, backoff_, omq, disp):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', True, None), (2, '5', 'bar', False, None)], []]
+        omq.retry_message.return_value = 1
+        backoff_.return_value = 2.5
+        disp.send_message.side_effect = DispatcherUndefinedExc('boom')
+
+        Sender.process_outgoing_messages()
+
+        disp.send_message.assert_called_once()
+        omq.retry_message.assert_called_once_with(1, drop_markup=True)
+        backoff_.assert_called_once_with(1)
+        omq.postpone_chat.assert_called_once_with(make_hash('5'), 2.5)
+        omq.delete_messages.assert_called_once_with([])
+
+    def test_sender_gives_up_after_the_last_attempt(self, omq, disp):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '5', 'bar', False, None)], []]
+        omq.retry_message.return_value = SEND_MAX_ATTEMPTS
+        disp.send_message.side_effect = [DispatcherUndefinedExc('boom'), None, None]
+
+        Sender.process_outgoing_messages()
+
+        self.assertEqual(disp.send_message.call_args_list[1].args,
+                         ('5', 'Undefined error while trying to send you a message :C'))
+        omq.delete_messages.assert_called_once_with([1, 2])
+        omq.postpone_chat.assert_not_called()
+
+    def test_sender_gives_up_when_the_notice_fails(self, omq, disp):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None), (2, '5', 'bar', False, None)], []]
+        omq.retry_message.return_value = SEND_MAX_ATTEMPTS
+        disp.send_message.side_effect = [DispatcherUndefinedExc('boom'), DispatcherNoAccess('badoom'), None]
+
+        Sender.process_outgoing_messages()
+
+        omq.delete_messages.assert_called_once_with([1, 2])
+        self.assertFalse(EXIT_SIGNAL.is_set())
+
+    def test_sender_retries_while_the_breaker_is_closed(self, omq, disp):
+        omq.get_messages.side_effect = [[(1, '5', 'foo', False, None)], []]
+        omq.retry_message.return_value = 2
+        disp.send_message.side_effect = DispatcherUnavailable('boom', retry_after=0)
+
+        Sender.process_outgoing_messages()
+
+        omq.retry_message.assert_called_once_with(1)
+        seconds = omq.postpone_chat.call_args.args[1]
+        self.assertTrue(SEND_BACKOFF_BASE <= seconds <= SEND_BACKOFF_BASE * 2)
+        omq.delete_messages.assert_called_once_with([])
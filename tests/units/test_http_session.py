@@ -0,0 +1,83 @@
+""" python -m unittest tests.units.test_http_session """
+import json
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from telebot import apihelper
+
+from lucky_bot.helpers.constants import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from lucky_bot.helpers.metrics import HTTP_REQUESTS, HTTP_CONNECTIONS
+from lucky_bot.helpers.http_session import HTTPSession, HTTP_SESSION
+from lucky_bot import BOT
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = json.dumps({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bot'}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPSession(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever, kwargs={'poll_interval': 0.1})
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_http_session_reuses_the_connection(self):
+        session = HTTPSession(pool_size=2)
+        requests, connections = HTTP_REQUESTS.value, HTTP_CONNECTIONS.value
+        for _ in range(5):
+            self.assertEqual(session.request('get', f'{self.url}/botX/getMe').json()['ok'], True)
+        session.close()
+
+        self.assertEqual(HTTP_REQUESTS.value - requests, 5)
+        self.assertEqual(HTTP_CONNECTIONS.value - connections, 1)
+
+    def test_http_session_is_shared_between_the_threads(self):
+        session = HTTPSession(pool_size=4)
+        connections = HTTP_CONNECTIONS.value
+        barrier = threading.Barrier(4)
+        def calls():
+            barrier.wait()
+            for _ in range(10):
+                session.request('get', f'{self.url}/botX/getMe')
+        threads = [threading.Thread(target=calls) for _ in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join(10) for thread in threads]
+        session.close()
+
+        self.assertLessEqual(HTTP_CONNECTIONS.value - connections, 4, msg='not more than the pool')
+
+    def test_http_session_is_used_by_the_bot(self):
+        self.assertEqual(apihelper.CUSTOM_REQUEST_SENDER, HTTP_SESSION.request)
+        self.assertEqual((apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT),
+                         (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+        api_url = apihelper.API_URL
+        apihelper.API_URL = f'{self.url}/bot{{0}}/{{1}}'
+        requests = HTTP_REQUESTS.value
+        try:
+            self.assertEqual(BOT.get_me().first_name, 'bot')
+        finally:
+            apihelper.API_URL = api_url
+        self.assertEqual(HTTP_REQUESTS.value - requests, 1)
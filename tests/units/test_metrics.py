@@ -0,0 +1,68 @@
+""" python -m unittest tests.units.test_metrics """
+import unittest
+import threading
+
+from lucky_bot.helpers.metrics import Counter, Gauge, Histogram, render
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = []
+
+    def test_counter(self):
+        counter = Counter('foo_total', 'Foo.', registry=self.registry)
+        threads = [threading.Thread(target=lambda: [counter.increment() for _ in range(1000)])
+                   for _ in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        counter.increment(2)
+        self.assertEqual(counter.value, 4002)
+
+    def test_counter_with_labels(self):
+        counter = Counter('errors_total', 'Errors.', labels=('error',), registry=self.registry)
+        counter.labels(error='timeout').increment()
+        counter.labels(error='timeout').increment()
+        counter.labels(error='blocked').increment()
+        self.assertEqual(render(self.registry), (
+            '# HELP errors_total Errors.\n'
+            '# TYPE errors_total counter\n'
+            'errors_total{error="blocked"} 1\n'
+            'errors_total{error="timeout"} 2\n'
+        ))
+
+    def test_gauge(self):
+        gauge = Gauge('depth', 'Depth.', registry=self.registry)
+        gauge.set(5)
+        self.assertEqual(gauge.value, 5)
+        Gauge('age', 'Age.', function=lambda: 42, registry=self.registry)
+        Gauge('running', 'Running.', labels=('thread',),
+              function=lambda: {('sender',): 1, ('receiver',): 0}, registry=self.registry)
+        self.assertEqual(render(self.registry), (
+            '# HELP depth Depth.\n# TYPE depth gauge\ndepth 5\n'
+            '# HELP age Age.\n# TYPE age gauge\nage 42\n'
+            '# HELP running Running.\n# TYPE running gauge\n'
+            'running{thread="receiver"} 0\nrunning{thread="sender"} 1\n'
+        ))
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency.', labels=('stage',),
+                              buckets=(0.1, 1), registry=self.registry)
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.labels(stage='sender').observe(value)
+        with histogram.labels(stage='sender').timer():
+            pass
+
+        self.assertEqual(render(self.registry), (
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{stage="sender",le="0.1"} 2\n'
+            'latency_seconds_bucket{stage="sender",le="1"} 4\n'
+            'latency_seconds_bucket{stage="sender",le="+Inf"} 5\n'
+            f'latency_seconds_sum{{stage="sender"}} {histogram.labels(stage="sender").sum}\n'
+            'latency_seconds_count{stage="sender"} 5\n'
+        ))
+
+    def test_label_escaping(self):
+        Counter('foo_total', 'Foo.', labels=('error',), registry=self.registry)\
+            .labels(error='a "b"\n').increment()
+        self.assertIn('foo_total{error="a \\"b\\"\\n"} 1\n', render(self.registry))
@@ -0,0 +1,84 @@
+""" python -m unittest tests.units.test_misc """
+import unittest
+import threading
+
+from sqlalchemy import text
+
+from lucky_bot.helpers.constants import PROJECT_DIR, SQLITE_PRAGMAS, SQLITE_POOL_SIZE
+from lucky_bot.helpers.misc import (
+    encrypt, decrypt, encrypt_many, decrypt_many, make_engine,
+)
+
+
+class TestCryptography(unittest.TestCase):
+    def test_encrypt_decrypt(self):
+        self.assertEqual(decrypt(encrypt('hello')), 'hello')
+        self.assertEqual(decrypt(encrypt(b'hello')), 'hello')
+        self.assertEqual(decrypt(encrypt(42)), '42')
+        self.assertEqual(decrypt(encrypt('hello').decode()), 'hello')
+
+    def test_encrypt_decrypt_many(self):
+        data = ['foo', b'bar', 42, 'Привет']
+        tokens = encrypt_many(data)
+        self.assertEqual(len(tokens), 4)
+        self.assertTrue(all(isinstance(token, bytes) for token in tokens))
+        self.assertEqual(decrypt_many(tokens), ['foo', 'bar', '42', 'Привет'])
+        self.assertEqual(decrypt_many([tokens[0].decode()]), ['foo'])
+        self.assertEqual(encrypt_many([]), [])
+        self.assertEqual(decrypt_many([]), [])
+
+    def test_tokens_are_compatible(self):
+        self.assertEqual(decrypt(encrypt_many(['foo'])[0]), 'foo')
+        self.assertEqual(decrypt_many([encrypt('bar')]), ['bar'])
+
+
+class TestEngineFactory(unittest.TestCase):
+    db_file = PROJECT_DIR / 'tests' / 'fixtures' / 'test_engine.sqlite3'
+
+    def tearDown(self):
+        for engine in getattr(self, 'engines', []):
+            engine.dispose()
+        for suffix in ['', '-wal', '-shm']:
+            f = self.db_file.with_name(self.db_file.name + suffix)
+            f.unlink() if f.exists() else None
+
+    def pragma(self, engine, name):
+        with engine.connect() as conn:
+            return conn.execute(text(f'PRAGMA {name}')).scalar()
+
+    def test_engine_storage_profile(self):
+        strict = make_engine(self.db_file, 'strict')
+        relaxed = make_engine(self.db_file, 'relaxed')
+        self.engines = [strict, relaxed]
+
+        self.assertEqual(self.pragma(strict, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(strict, 'busy_timeout'), SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(self.pragma(strict, 'cache_size'), SQLITE_PRAGMAS['cache_size'])
+        self.assertEqual(self.pragma(strict, 'synchronous'), 2)  # FULL
+        self.assertEqual(self.pragma(relaxed, 'synchronous'), 1)  # NORMAL
+
+    def test_engine_shares_the_connections_between_threads(self):
+        engine = make_engine(self.db_file)
+        self.engines = [engine]
+
+        def connection_id():
+            with engine.connect() as conn:
+                return id(conn.connection.dbapi_connection)
+
+        first = connection_id()
+        self.assertEqual(connection_id(), first)
+
+        result = []
+        for _ in range(SQLITE_POOL_SIZE * 2):
+            thread = threading.Thread(target=lambda: result.append(connection_id()))
+            thread.start()
+            thread.join()
+        self.assertEqual(set(result), {first}, msg='a finished thread leaves its connection to the others')
+
+        with engine.connect() as conn:
+            busy = id(conn.connection.dbapi_connection)
+            thread = threading.Thread(target=lambda: result.append(connection_id()))
+            thread.start()
+            thread.join()
+        self.assertNotEqual(result[-1], busy, msg='a connection in use is not shared')
+        self.assertLessEqual(engine.pool.checkedin(), SQLITE_POOL_SIZE)
@@ -0,0 +1,63 @@
+""" python -m unittest tests.units.test_records """
+import json
+import unittest
+
+from lucky_bot.helpers.constants import PROJECT_DIR
+from lucky_bot.helpers.misc import encrypt
+from lucky_bot.helpers.records import MessageRecord, pack_update, unpack_record, is_record
+
+
+class TestRecords(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        fixture = PROJECT_DIR / 'tests' / 'fixtures' / 'telegram_request.json'
+        with open(fixture) as f:
+            cls.telegram_request = f.read().strip()
+
+    def test_record_round_trip(self):
+        update = json.loads(self.telegram_request)
+        update['message']['text'] = 'привет, /add\nmultiline'
+
+        record = pack_update(update)
+
+        self.assertTrue(is_record(record))
+        self.assertLess(len(encrypt(record)), len(encrypt(self.telegram_request)))
+        self.assertEqual(unpack_record(record), MessageRecord(
+            update_id=906994025, message_id=6, date=1672410421,
+            chat_id=1266575762, user_id=1266575762,
+            username='john_doe', text='привет, /add\nmultiline',
+        ))
+
+    def test_record_without_username(self):
+        update = json.loads(self.telegram_request)
+        del update['message']['chat']['username']
+        self.assertEqual(unpack_record(pack_update(update)).username, '')
+
+    def test_record_only_for_private_text_messages(self):
+        update = json.loads(self.telegram_request)
+        update['message']['chat']['type'] = 'group'
+        self.assertIsNone(pack_update(update))
+
+        update = json.loads(self.telegram_request)
+        del update['message']['text']
+        self.assertIsNone(pack_update(update))
+
+        self.assertIsNone(pack_update({'update_id': 1, 'edited_message': {}}))
+
+    def test_record_with_missing_fields(self):
+        update = json.loads(self.telegram_request)
+        del update['message']['chat']['id']
+        self.assertIsNone(pack_update(update))
+
+        update = json.loads(self.telegram_request)
+        update['message']['text'] = 5
+        self.assertIsNone(pack_update(update))
+
+        update = json.loads(self.telegram_request)
+        del update['message']['date']
+        self.assertIsNone(pack_update(update))
+
+    def test_not_a_record(self):
+        self.assertFalse(is_record(self.telegram_request))
+        self.assertFalse(is_record(self.telegram_request.encode()))
+        self.assertFalse(is_record('/sender delete 42'))
@@ -0,0 +1,66 @@
+""" python -m unittest tests.units.test_tracing """
+import json
+import unittest
+import threading
+from unittest.mock import patch
+
+from lucky_bot.helpers import tracing
+from lucky_bot.helpers.tracing import Trace, STAGES
+
+
+class TestTracing(unittest.TestCase):
+    def tearDown(self):
+        tracing.set_current(None)
+
+    def test_trace_marks(self):
+        trace = Trace.start()
+        self.assertEqual(len(trace.trace_id), 16)
+        self.assertEqual(len(trace.marks), 1)
+
+        for stage in STAGES[:3]:
+            trace = trace.mark()
+        self.assertEqual(len(trace.marks), 4)
+        self.assertEqual(list(trace.durations()), ['receiver', 'imq', 'controller'])
+        self.assertTrue(all(value >= 0 for value in trace.durations().values()))
+
+    def test_trace_dumps_loads(self):
+        trace = Trace.start().mark()
+        loaded = Trace.loads(trace.dumps())
+        self.assertEqual(loaded.trace_id, trace.trace_id)
+        self.assertEqual([round(m, 6) for m in loaded.marks], [round(m, 6) for m in trace.marks])
+        self.assertIsNone(Trace.loads(None))
+        self.assertIsNone(tracing.forward(None))
+
+    @patch('lucky_bot.helpers.tracing.TRACE_LATENCY')
+    def test_trace_stages_are_observed(self, histogram):
+        trace = Trace.start()
+        trace = Trace.loads(tracing.forward(trace))
+        histogram.labels.assert_called_once_with(stage='receiver')
+
+        for stage in STAGES[1:]:
+            trace = trace.mark()
+        tracing.finish(trace)
+        stages = [call.kwargs['stage'] for call in histogram.labels.call_args_list]
+        self.assertEqual(stages, list(STAGES) + ['total'])
+
+    @patch('lucky_bot.helpers.tracing.trace_logger')
+    def test_trace_file(self, trace_logger):
+        trace = Trace.start().mark().mark().mark().mark()
+        tracing.finish(trace)
+        trace_logger.info.assert_not_called()
+
+        with patch('lucky_bot.helpers.tracing.TRACE_TO_FILE', True):
+            tracing.finish(trace)
+        line = json.loads(trace_logger.info.call_args.args[0])
+        self.assertEqual(line['trace'], trace.trace_id)
+        self.assertEqual(list(line)[2:], list(STAGES) + ['total'])
+
+    def test_current_trace_is_per_thread(self):
+        trace = Trace.start()
+        tracing.set_current(trace)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(tracing.current()))
+        thread.start()
+        thread.join()
+        self.assertEqual(tracing.current(), trace)
+        self.assertEqual(other, [None])
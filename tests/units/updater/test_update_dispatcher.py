@@ -3,6 +3,9 @@ import unittest
 from unittest.mock import Mock, patch
 from time import time
 
+from lucky_bot.helpers.constants import SCHEDULED, UPDATER_SPREAD_WINDOW
+from lucky_bot.helpers.misc import make_hash
+from lucky_bot.helpers.signals import NEW_MESSAGE_TO_SEND
 from lucky_bot.updater import update_dispatcher
 
 
@@ -15,6 +18,9 @@ class TestUpdateDispatcher(unittest.TestCase):
         self.current_time.first_update = False
         self.current_time.second_update = False
 
+    def tearDown(self):
+        NEW_MESSAGE_TO_SEND.clear()
+
     def test_clear_all_flags(self, db, arg):
         update_dispatcher.clear_all_users_flags(self.current_time)
         db.clear_all_users_flags.assert_not_called()
@@ -64,7 +70,8 @@ class TestUpdateDispatcher(unittest.TestCase):
         update_dispatcher.notifications_dispatcher(self.current_time)
         func.assert_not_called()
 
-    def test_dispatcher_first_update(self, db, omq):
+    @patch('lucky_bot.updater.update_dispatcher.time')
+    def test_dispatcher_first_update(self, clock, db, omq):
         user = Mock()
         user.tg_id = 'uid-1'
         user.c_id = b'1'
@@ -78,15 +85,20 @@ class TestUpdateDispatcher(unittest.TestCase):
         db.get_notifications_for_the_updater.return_value = [note]
 
         t = int(time())
+        clock.return_value = t
         update_dispatcher.notifications_dispatcher(self.current_time)
 
         db.get_users_with_notes.assert_called_once()
         db.get_notifications_for_the_updater.assert_called_once_with(user)
-        omq.add_message.assert_called_once_with(user.c_id, note.text, markup=True, encrypted=True)
+        omq.add_message.assert_called_once_with(user.c_id, note.text, markup=True, encrypted=True,
+                                                chat=user.tg_id, priority=SCHEDULED,
+                                                deliver_after=t + update_dispatcher.spread_offset(user.tg_id))
         db.update_user_last_notes_list.assert_called_once_with(user.tg_id, note.number)
         db.set_user_flag.assert_called_once_with(user.tg_id, 'first update')
+        self.assertTrue(NEW_MESSAGE_TO_SEND.is_set())
 
-    def test_dispatcher_second_update(self, db, omq):
+    @patch('lucky_bot.updater.update_dispatcher.time')
+    def test_dispatcher_second_update(self, clock, db, omq):
         user = Mock()
         user.tg_id = 'uid-2'
         user.c_id = b'2'
@@ -101,14 +113,28 @@ class TestUpdateDispatcher(unittest.TestCase):
         db.get_notifications_for_the_updater.return_value = [note]
 
         t = int(time())
+        clock.return_value = t
         update_dispatcher.notifications_dispatcher(self.current_time)
 
         db.get_users_with_notes.assert_called_once()
         db.get_notifications_for_the_updater.assert_called_once_with(user)
-        omq.add_message.assert_called_once_with(user.c_id, note.text, markup=True, encrypted=True)
+        omq.add_message.assert_called_once_with(user.c_id, note.text, markup=True, encrypted=True,
+                                                chat=user.tg_id, priority=SCHEDULED,
+                                                deliver_after=t + update_dispatcher.spread_offset(user.tg_id))
         db.update_user_last_notes_list.assert_called_once_with(user.tg_id, note.number)
         db.set_user_flag.assert_called_once_with(user.tg_id, 'second update')
 
+    def test_dispatcher_spreads_the_round(self, *args):
+        offsets = [update_dispatcher.spread_offset(make_hash(uid)) for uid in range(1000)]
+        self.assertEqual(offsets[:10], [update_dispatcher.spread_offset(make_hash(uid)) for uid in range(10)],
+                         msg='the same for a user')
+        self.assertTrue(all(0 <= offset < UPDATER_SPREAD_WINDOW for offset in offsets))
+        self.assertGreater(len({offset // 60 for offset in offsets}), UPDATER_SPREAD_WINDOW // 60 * 0.9,
+                           msg='nearly every minute of the window')
+
+        with patch('lucky_bot.updater.update_dispatcher.UPDATER_SPREAD_WINDOW', 0):
+            self.assertEqual(update_dispatcher.spread_offset(make_hash(1)), 0)
+
     @patch('lucky_bot.updater.update_dispatcher.set_update_flag')
     @patch('lucky_bot.updater.update_dispatcher.is_waiting_for_update')
     def test_dispatcher_user_without_notes_error(self, is_waiting, set_flag, db, omq):